@@ -56,3 +56,6 @@ ALTER TABLE comments ADD CONSTRAINT comments_fk2 FOREIGN KEY (auctions_auction_i
 ALTER TABLE notifications ADD CONSTRAINT notifications_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
 ALTER TABLE tokens ADD UNIQUE (token);
 ALTER TABLE tokens ADD CONSTRAINT tokens_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
+
+-- The expired token reaper deletes by exp_date
+CREATE INDEX tokens_exp_date_idx ON tokens (exp_date);
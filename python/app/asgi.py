@@ -0,0 +1,1276 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Async serving mode (ASGI)
+##
+## The same routes and JSON responses as demo-proj.py, served by Quart (the asyncio implementation
+## of the Flask API) on psycopg 3's native async driver and pool. A request waiting on the database
+## holds no thread, so one process keeps thousands of requests in flight while the pool bounds the
+## queries actually running. SQL, settings, pagination, response cache, bid results, request metrics
+## and the query profile are shared with demo-proj.py; see that file for the documentation of every endpoint.
+##
+## Queries go through client-side binding cursors, which compose the SQL exactly like psycopg2,
+## so the statements of demo-proj.py run unchanged.
+##
+## Requirements: pip install quart "psycopg[binary]" psycopg-pool uvicorn
+##
+## To use it (one event loop per process, DB_POOL_MAX connections per process):
+##
+## python migrate.py && uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+##
+## Migrations are not applied on start (run migrate.py first), the background workers run on threads as in demo-proj.py.
+
+import asyncio
+import importlib.util
+import logging, os, random, sys, time
+import hashlib, json, queue, secrets
+from functools import wraps
+
+import psycopg
+import quart
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+if 'demo_proj' not in sys.modules:
+    _spec = importlib.util.spec_from_file_location('demo_proj', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo-proj.py'))
+    sys.modules['demo_proj'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['demo_proj'])
+
+import demo_proj
+from demo_proj import (StatusCodes, DB_CONFIG, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME,
+                       DB_POOL_HEALTH_CHECK, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, TOKEN_TTL, token_digest,
+                       RATE_LIMITS, rate_limit_response, PASSWORD_TIMEOUT, PasswordPoolBusy, hash_password, check_password, DUMMY_PASSWORD_HASH, MAX_PAGE_SIZE, STREAM_ITERSIZE,
+                       USER_FIELDS, AUCTION_FIELDS, AUCTION_TOP_BIDS, AUCTION_RECENT_COMMENTS,
+                       page_args, keyset_args, field_args, keyset_page, offset_page, field_statement, stream_format, stream_limit,
+                       search_statement, search_content, auction_content, bid_content, comment_content, notification_content,
+                       record_stream, auction_namespace, invalidate_responses, bid_result, BULK_BID_MAX, parse_bids,
+                       SSE_KEEPALIVE, SSE_MAX_DURATION, SSE_MAX_STREAMS, SSE_HEADERS, sse_message, snapshot_content)
+
+api = quart.Blueprint('api', __name__)
+
+logger = logging.getLogger('logger')
+
+##########################################################
+## DATABASE ACCESS
+##########################################################
+
+_pool = None
+
+
+def db_pool():
+    # created in before_serving, inside the event loop of the worker process
+    if _pool is None:
+        raise RuntimeError('the database pool is not open')
+    return _pool
+
+
+async def open_pool():
+    global _pool
+    _pool = AsyncConnectionPool(
+        make_conninfo(**{'dbname' if k == 'database' else k: v for k, v in DB_CONFIG.items()}),
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        timeout=DB_POOL_TIMEOUT,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        check=AsyncConnectionPool.check_connection if DB_POOL_HEALTH_CHECK else None,
+        kwargs={'cursor_factory': TimedCursor},
+        open=False)
+    await _pool.open()
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def db_transaction():
+    # async with db_transaction() as conn: commits when the block succeeds, rolls back otherwise
+    return db_pool().connection()
+
+
+def pool_metrics():
+    # the gauges and counters of demo-proj.py's pool_metrics(), read from the async pool
+    if _pool is None:
+        return ''
+    stats = _pool.get_stats()
+    return '\n'.join([
+        '# HELP db_pool_connections Connections of the pool by state',
+        '# TYPE db_pool_connections gauge',
+        f'db_pool_connections{{state="idle"}} {stats.get("pool_available", 0)}',
+        f'db_pool_connections{{state="in_use"}} {stats.get("pool_size", 0) - stats.get("pool_available", 0)}',
+        '# HELP db_pool_max_connections Maximum size of the pool',
+        '# TYPE db_pool_max_connections gauge',
+        f'db_pool_max_connections {stats.get("pool_max", DB_POOL_MAX)}',
+        '# HELP db_pool_timeouts_total Checkouts that gave up waiting for a connection',
+        '# TYPE db_pool_timeouts_total counter',
+        f'db_pool_timeouts_total {stats.get("requests_errors", 0)}',
+        '# HELP db_pool_wait_seconds_total Time spent waiting for a free connection',
+        '# TYPE db_pool_wait_seconds_total counter',
+        f'db_pool_wait_seconds_total {stats.get("requests_wait_ms", 0) / 1000}'
+    ]) + '\n'
+
+##########################################################
+## METRICS
+##########################################################
+
+def request_metrics():
+    # the measurements of the current request, None outside of a request
+    if quart.has_request_context():
+        return quart.g.get('metrics')
+    return None
+
+
+class TimedCursor(psycopg.AsyncClientCursor):
+    # Cursor that adds the time of every statement to the metrics of the current request
+    # and to the query profile of demo-proj.py
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            demo_proj.record_query(request_metrics(), self, query, time.perf_counter() - started)
+
+
+@api.before_app_request
+async def start_request_metrics():
+    quart.g.metrics = demo_proj.new_request_metrics(quart.request.endpoint)
+
+
+@api.after_app_request
+async def record_request_metrics(response):
+    current = request_metrics()
+    if current is None:
+        return response
+
+    route = quart.request.url_rule.rule if quart.request.url_rule is not None else 'unmatched'
+    demo_proj.observe_request(current, quart.request.method, route, response.status_code, response.content_length)
+    if demo_proj.query_profiler is not None:
+        demo_proj.query_profiler.check_repeats(current['endpoint'] or route, current['statements'])
+    return response
+
+
+def debug_only(f):
+    # endpoints that expose internals answer 404 unless DEBUG_ENDPOINTS=1
+    @wraps(f)
+    async def decorator(*args, **kwargs):
+        if not demo_proj.DEBUG_ENDPOINTS:
+            quart.abort(404)
+        return await f(*args, **kwargs)
+
+    return decorator
+
+##########################################################
+## TOKEN VERIFICATION
+##########################################################
+
+class AsyncTokenCache(demo_proj.TokenCache):
+    # TokenCache for coroutines: concurrent misses on a token await one lookup instead of blocking a thread.
+    # The lock only guards dictionary updates, it is never held across an await.
+
+    async def get(self, token, loader):
+        # loader(token) is a coroutine returning (user_id, seconds_until_expiry) or None
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(token)
+                    self._stats['hits'] += 1
+                    return entry[0]
+                del self._entries[token]
+                self._stats['expirations'] += 1
+
+            self._stats['misses'] += 1
+            lookup = self._lookups.get(token)
+            leader = lookup is None
+            if leader:
+                lookup = self._lookups[token] = asyncio.get_running_loop().create_future()
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            return await asyncio.shield(lookup)
+
+        try:
+            user_id = None
+            row = await loader(token)
+            if row is not None:
+                user_id, remaining = row
+                self.put(token, user_id, remaining)
+            lookup.set_result(user_id)
+        except BaseException as error:
+            # also on cancellation (client gone), so that waiting requests are never left hanging
+            lookup.set_exception(error if isinstance(error, Exception) else RuntimeError('token lookup cancelled'))
+            lookup.exception()  # retrieved, even when nobody was waiting
+            raise
+        finally:
+            with self._lock:
+                self._lookups.pop(token, None)
+
+        return user_id
+
+
+token_cache = AsyncTokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+async def load_token(token):
+    async with db_transaction() as conn:
+        cur = await conn.execute(demo_proj.STATEMENTS['token_lookup'], (token_digest(token),))
+        row = await cur.fetchone()
+
+    if row is None:
+        return None
+    return row[0], row[1]
+
+
+async def issue_token(conn, user_id):
+    # async counterpart of demo_proj.token_store.issue()
+    if demo_proj.token_store.mode == 'signed':
+        return demo_proj.token_store.issue(None, user_id)
+
+    token = secrets.token_urlsafe(32)
+    await conn.execute(demo_proj.STATEMENTS['token_insert'], (user_id, token_digest(token), TOKEN_TTL))
+    return token
+
+
+async def run_password(f, *args):
+    # f(*args) on demo_proj.password_pool, the event loop keeps serving while scrypt runs
+    return await asyncio.wait_for(asyncio.wrap_future(demo_proj.password_pool.submit(f, *args)), PASSWORD_TIMEOUT)
+
+
+def password_busy_response():
+    response = {'status': StatusCodes['unavailable'], 'results': 'too many logins in progress, retry later'}
+    return quart.jsonify(response), StatusCodes['unavailable'], {'Retry-After': '1'}
+
+
+async def verify_token(token):
+    # signed tokens are checked in CPU (no await needed), opaque ones through the async cache
+    if demo_proj.token_store.mode == 'signed':
+        return demo_proj.token_store.verify(token)
+    return await token_cache.get(token, load_token)
+
+
+async def revoke_token(token):
+    store = demo_proj.token_store
+    if store.mode == 'signed':
+        claims = store.claims(token)
+        if claims is None:
+            return 0
+        user_id, expires_at, token_id = claims
+        async with db_transaction() as conn:
+            await conn.execute(demo_proj.STATEMENTS['token_revoke'], (token_id, user_id, expires_at))
+        store.revocations.add(token_id, expires_at)
+        return 1
+
+    async with db_transaction() as conn:
+        cur = await conn.execute(demo_proj.STATEMENTS['token_delete'], (token_digest(token),))
+        revoked = cur.rowcount
+
+    token_cache.invalidate(token)
+    demo_proj.token_cache.invalidate(token)
+    return revoked
+
+
+def token_required(f):
+    @wraps(f)
+    async def decorator(*args, **kwargs):
+        token = quart.request.headers.get('access-token')
+
+        if not token:
+            return quart.jsonify({'message': 'invalid token'})
+
+        try:
+            current_user = await verify_token(token)
+
+            if current_user is None:
+                return quart.jsonify({'message': 'invalid token'})
+        except (Exception) as error:
+            logger.error(f'token_required - error: {str(error)}')
+
+            return quart.jsonify({'message': 'invalid token'})
+
+        return await f(current_user, *args, **kwargs)
+
+    return decorator
+
+##########################################################
+## RATE LIMITING
+##########################################################
+
+def rate_limited(route, by_user=True):
+    # async counterpart of demo_proj.rate_limited, on the same limiter (and buckets)
+    rate, burst = RATE_LIMITS[route]
+
+    def wrapper(f):
+        @wraps(f)
+        async def decorator(*args, **kwargs):
+            limiter = demo_proj.rate_limiter
+            if limiter is None:
+                return await f(*args, **kwargs)
+
+            key = f"{route}:{f'user:{args[0]}' if by_user else f'ip:{quart.request.remote_addr}'}"
+            if isinstance(limiter.backend, demo_proj.LocalRateLimitBackend):
+                allowed, retry_after = limiter.take(key, rate, burst)
+            else:
+                # a round trip to the shared backend, off the event loop
+                allowed, retry_after = await asyncio.to_thread(limiter.take, key, rate, burst)
+
+            if not allowed:
+                response, headers = rate_limit_response(retry_after)
+                return quart.jsonify(response), StatusCodes['too_many_requests'], headers
+            return await f(*args, **kwargs)
+
+        return decorator
+
+    return wrapper
+
+##########################################################
+## STREAMING
+##########################################################
+
+def stream_response(fmt, sections):
+    # async counterpart of demo_proj.stream_response, rows are read from a server-side cursor
+    started = time.monotonic()
+    path = quart.request.path
+    dumps = quart.current_app.json.dumps
+
+    async def generate():
+        rows = 0
+        ttfb = None
+        error = 0
+        try:
+            async with db_transaction() as conn:
+                if fmt == 'json':
+                    yield '{"status": %d' % StatusCodes['success']
+
+                for key, query, values, to_content in sections:
+                    cur = conn.cursor(name='stream')
+                    cur.itersize = STREAM_ITERSIZE
+                    await cur.execute(query, values)
+
+                    if fmt == 'json':
+                        yield ', %s: [' % dumps(key)
+                    separator = ''
+                    async for row in cur:
+                        content = to_content(row)
+                        if fmt == 'json':
+                            chunk = separator + dumps(content)
+                            separator = ', '
+                        else:
+                            if len(sections) > 1:
+                                content['section'] = key
+                            chunk = dumps(content) + '\n'
+                        if ttfb is None:
+                            ttfb = time.monotonic() - started
+                        rows += 1
+                        yield chunk
+                    if fmt == 'json':
+                        yield ']'
+                    await cur.close()
+
+                if fmt == 'json':
+                    yield '}'
+        except (Exception, psycopg.DatabaseError) as error_:
+            logger.error(f'{path} stream - error: {error_}')
+            error = 1
+            if fmt == 'ndjson':
+                yield dumps({'status': StatusCodes['internal_error'], 'errors': str(error_)}) + '\n'
+        finally:
+            record_stream(rows, ttfb, error)
+
+    mimetype = 'application/json' if fmt == 'json' else 'application/x-ndjson'
+    return quart.Response(generate(), mimetype=mimetype)
+
+##########################################################
+## AUCTION EVENTS
+##########################################################
+
+async def publish_events(conn, events):
+    # async counterpart of demo_proj.publish_events, delivered when the transaction commits
+    if events:
+        await conn.execute(demo_proj.STATEMENTS['auction_notify'], ([json.dumps(event, default=str) for event in events],))
+
+
+class AsyncSubscriber:
+    # Subscriber of demo_proj.auction_events for a stream served on the event loop: the listener
+    # thread hands every event over to the loop, where it is queued (or dropped when the queue is full)
+
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.queue = asyncio.Queue(size)
+
+    def put_nowait(self, event):
+        if self.queue.full():
+            raise queue.Full
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+async def enqueue_notification(conn, kind, audience, auction_id, content, recipient_id=None, exclude_id=None):
+    # async counterpart of demo_proj.enqueue_notification, one queued event in the transaction of conn
+    await conn.execute(demo_proj.STATEMENTS['notification_enqueue'], (kind, audience, auction_id, recipient_id, exclude_id, content))
+
+
+async def load_snapshot(auction_id):
+    async with db_transaction() as conn:
+        cur = await conn.execute(demo_proj.STATEMENTS['auction_snapshot'], (auction_id,))
+        row = await cur.fetchone()
+    return snapshot_content(row) if row is not None else None
+
+##########################################################
+## RESPONSE CACHE
+##########################################################
+
+def cached_response(namespaces):
+    # async counterpart of demo_proj.cached_response, on the same cache (and keys)
+    def wrapper(f):
+        @wraps(f)
+        async def decorator(*args, **kwargs):
+            response_cache = demo_proj.response_cache
+            request = quart.request
+            if response_cache is None or 'stream' in request.args \
+                    or 'application/x-ndjson' in request.headers.get('Accept', ''):
+                return await f(*args, **kwargs)
+
+            try:
+                key = response_cache.key(f.__name__, namespaces(**kwargs), kwargs, request.args)
+                cached = response_cache.get(key)
+            except Exception as error:
+                logger.error(f'response cache - error: {error}')
+                response_cache._count('errors')
+                return await f(*args, **kwargs)
+
+            if cached is None:
+                response = await quart.make_response(await f(*args, **kwargs))
+                if response.status_code != 200 or response.mimetype != 'application/json' \
+                        or ((await response.get_json(silent=True)) or {}).get('status') != StatusCodes['success']:
+                    return response
+                body = await response.get_data(as_text=True)
+                etag = hashlib.sha1(body.encode()).hexdigest()
+                try:
+                    response_cache.set(key, etag, body)
+                except Exception as error:
+                    logger.error(f'response cache - error: {error}')
+                    response_cache._count('errors')
+            else:
+                etag, body = cached
+
+            if etag in request.if_none_match:
+                response_cache._count('not_modified')
+                response = quart.Response('', status=304)
+            else:
+                response = quart.Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            return response
+
+        return decorator
+
+    return wrapper
+
+##########################################################
+## ENDPOINTS
+##########################################################
+
+@api.route('/')
+async def landing_page():
+    return """
+
+    Hello World (Python, async)!  <br/>
+    <br/>
+    Check the sources for instructions on how to use the endpoints!<br/>
+    <br/>
+    ITCS 3160-002, Spring 2024<br/>
+    <br/>
+    """
+
+
+@api.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    # the metrics of demo-proj.py, recorded by this process; the pool is the async one
+    body = demo_proj.metrics.render() + pool_metrics() + demo_proj.logging_metrics()
+    return quart.Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api.route('/debug/queries/', methods=['GET', 'DELETE'])
+@debug_only
+async def query_profile():
+    logger.info(f'{quart.request.method} /debug/queries')
+
+    return quart.jsonify(demo_proj.query_profile_response(quart.request.method, quart.request.args))
+
+
+def token_stats():
+    if demo_proj.token_store.mode == 'signed':
+        return demo_proj.token_store.stats()
+    stats = token_cache.stats()
+    stats['mode'] = 'opaque'
+    return stats
+
+
+# the components of demo-proj.py, with the async pool and token cache of this process
+STATS = dict(demo_proj.STATS, pool=lambda: {'driver': 'psycopg-async', **db_pool().get_stats()}, tokens=token_stats)
+
+
+@api.route('/stats/<component>/', methods=['GET'])
+@debug_only
+async def component_stats(component):
+    logger.info(f'GET /stats/{component}')
+
+    return quart.jsonify(demo_proj.stats_response(STATS, component))
+
+
+@api.route('/users/', methods=['GET'])
+async def get_all_users():
+    logger.info('GET /users')
+
+    try:
+        fmt = stream_format(quart.request.args, quart.request.headers)
+        after, limit = keyset_args(quart.request.args)
+        fields = field_args(USER_FIELDS, quart.request.args)
+        if fmt is not None:
+            limit = stream_limit(quart.request.args)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    query = field_statement('users_page', USER_FIELDS, fields)
+
+    if fmt is not None:
+        return stream_response(fmt, [('results', query, (after, limit), lambda row: dict(zip(fields, row[1:])))])
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(query, (after, limit + 1))
+            response = keyset_page(await cur.fetchall(), limit, lambda row: dict(zip(fields, row[1:])))
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /users - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/users/<username>/', methods=['GET'])
+async def get_user(username):
+    logger.info('GET /users/<username>')
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['user_get'], (username,))
+            row = await cur.fetchone()
+
+            content = {'username': row[0], 'email': row[1]}
+
+            response = {'status': StatusCodes['success'], 'results': content}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /users/<username> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/users/<username>', methods=['PUT'])
+async def update_users(username):
+    logger.info('PUT /users/<username>')
+    payload = await quart.request.get_json()
+
+    if 'city' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'city is required to update'}
+        return quart.jsonify(response)
+
+    values = (payload['city'], username)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['user_update_city'], values)
+            response = {'status': StatusCodes['success'], 'results': f'Updated: {cur.rowcount}'}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(error)
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/users/', methods=['POST'])
+async def add_users():
+    logger.info('POST /users')
+    payload = await quart.request.get_json()
+
+    if not payload or 'username' not in payload or 'email' not in payload or 'password' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'values missing from payload'}
+        return quart.jsonify(response)
+
+    try:
+        password = await run_password(hash_password, payload['password'])
+        values = (payload['username'], payload['email'], password)
+
+        async with db_transaction() as conn:
+            await conn.execute(demo_proj.STATEMENTS['user_insert'], values)
+
+            response = {'status': StatusCodes['success'], 'results': f'Inserted users {payload["username"]}'}
+
+    except PasswordPoolBusy:
+        return password_busy_response()
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /users - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/login/', methods=['POST'])
+@rate_limited('login', by_user=False)
+async def user_login():
+    logger.info('POST /login')
+    payload = await quart.request.get_json()
+
+    if not payload \
+        or 'username' not in payload \
+        or 'password' not in payload :
+        response = {'status': StatusCodes['unauthorized'], 'results': 'missing credentials from payload'}
+        return quart.jsonify(response)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['user_login'], (payload['username'],))
+            row = await cur.fetchone()
+
+        user_id, stored = row if row is not None else (None, DUMMY_PASSWORD_HASH)
+        valid, new_hash = await run_password(check_password, payload['password'], stored)
+
+        if user_id is None or not valid:
+            response = ('could not verify', 401)
+        else:
+            async with db_transaction() as conn:
+                if new_hash is not None:
+                    await conn.execute(demo_proj.STATEMENTS['user_rehash'], (new_hash, user_id, stored))
+
+                response = await issue_token(conn, user_id)
+
+    except PasswordPoolBusy:
+        return password_busy_response()
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /login - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return response
+
+
+@api.route('/logout/', methods=['POST'])
+@token_required
+async def user_logout(current_user):
+    logger.info('POST /logout')
+
+    try:
+        await revoke_token(quart.request.headers['access-token'])
+        response = {'status': StatusCodes['success'], 'results': 'Logged out'}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /logout - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/', methods=['POST'])
+@token_required
+async def create_auction(current_user):
+    logger.info('POST /auctions')
+    payload = await quart.request.get_json()
+
+    if not payload or 'end_date_time' not in payload \
+        or 'item_id' not in payload or 'min_price' not in payload \
+        or 'title' not in payload or 'item_desc' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'values missing from payload'}
+        return quart.jsonify(response)
+
+    values = (payload['item_id'], payload['min_price'], payload['title'], payload['item_desc'], payload['end_date_time'], current_user)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['auction_insert'], values)
+
+            auction_id = (await cur.fetchone())[0]
+
+            response = {'auction_id': auction_id}
+
+        invalidate_responses('auctions')
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /auctions - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/', methods=['GET'])
+@token_required
+@cached_response(lambda: ['auctions'])
+async def get_all_auctions(current_user):
+    logger.info('GET /auctions')
+
+    try:
+        fmt = stream_format(quart.request.args, quart.request.headers)
+        after, limit = keyset_args(quart.request.args)
+        fields = field_args(AUCTION_FIELDS, quart.request.args)
+        if fmt is not None:
+            limit = stream_limit(quart.request.args)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    query = field_statement('auctions_page', AUCTION_FIELDS, fields)
+
+    if fmt is not None:
+        return stream_response(fmt, [('results', query, (after, limit), lambda row: dict(zip(fields, row[1:])))])
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(query, (after, limit + 1))
+            response = keyset_page(await cur.fetchall(), limit, lambda row: dict(zip(fields, row[1:])))
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/items/<keyword>/', methods=['GET'])
+@token_required
+@rate_limited('search')
+@cached_response(lambda keyword: ['auctions'])
+async def search_existing(current_user, keyword):
+    logger.info('GET /items')
+
+    try:
+        fmt = stream_format(quart.request.args, quart.request.headers)
+        limit, offset = page_args(quart.request.args)
+        if fmt is not None:
+            limit = stream_limit(quart.request.args)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    # one row more than requested tells if there is a next page
+    statement, values = search_statement(keyword, limit + 1 if fmt is None else limit, offset)
+
+    if fmt is not None:
+        return stream_response(fmt, [('results', demo_proj.STATEMENTS[statement], values, search_content)])
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS[statement], values)
+            response = offset_page(await cur.fetchall(), limit, offset, search_content)
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /items/<keyword> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/<auction_id>/', methods=['GET'])
+@token_required
+@cached_response(lambda auction_id: [auction_namespace(auction_id)])
+async def retrieve_auction(current_user, auction_id):
+    logger.info('GET auctions/<auction_id>')
+
+    try:
+        top_bids = min(int(quart.request.args.get('bids', AUCTION_TOP_BIDS)), MAX_PAGE_SIZE)
+        recent_comments = min(int(quart.request.args.get('comments', AUCTION_RECENT_COMMENTS)), MAX_PAGE_SIZE)
+        if top_bids < 0 or recent_comments < 0:
+            raise ValueError('bids and comments cannot be negative')
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['auction_detail'], (top_bids, recent_comments, auction_id))
+            auction_info = await cur.fetchone()
+
+        if auction_info is None:
+            response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+            return quart.jsonify(response)
+
+        response = {'status': StatusCodes['success'], 'results': auction_content(auction_info)}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions/<auction_id> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/<int:auction_id>/bids/', methods=['GET'])
+@token_required
+async def list_auction_bids(current_user, auction_id):
+    logger.info('GET /auctions/<auction_id>/bids')
+
+    try:
+        limit, offset = page_args(quart.request.args)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['auction_bids'], (auction_id, limit + 1, offset))
+            response = offset_page(await cur.fetchall(), limit, offset, bid_content)
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions/<auction_id>/bids - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/<int:auction_id>/comments/', methods=['GET'])
+@token_required
+async def list_auction_comments(current_user, auction_id):
+    logger.info('GET /auctions/<auction_id>/comments')
+
+    try:
+        limit, offset = page_args(quart.request.args)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['auction_comments'], (auction_id, limit + 1, offset))
+            response = offset_page(await cur.fetchall(), limit, offset, comment_content)
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions/<auction_id>/comments - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/<int:auction_id>/stream', methods=['GET'])
+@token_required
+async def stream_auction(current_user, auction_id):
+    logger.info('GET /auctions/<auction_id>/stream')
+
+    auction_events = demo_proj.auction_events
+    subscriber = auction_events.subscribe(auction_id, AsyncSubscriber(asyncio.get_running_loop(), auction_events.queue_size),
+                                          SSE_MAX_STREAMS)
+    if subscriber is None:
+        response = {'status': StatusCodes['unavailable'], 'results': 'too many open streams, retry later'}
+        return quart.jsonify(response), StatusCodes['unavailable']
+    try:
+        snapshot = await load_snapshot(auction_id)
+    except (Exception, psycopg.DatabaseError) as error:
+        auction_events.unsubscribe(auction_id, subscriber)
+        logger.error(f'GET /auctions/<auction_id>/stream - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return quart.jsonify(response)
+
+    if snapshot is None:
+        auction_events.unsubscribe(auction_id, subscriber)
+        response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+        return quart.jsonify(response)
+
+    async def generate():
+        # same events as demo_proj.stream_auction
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        try:
+            yield 'retry: 3000\n\n'
+            yield sse_message('snapshot', snapshot)
+            if snapshot['closed_at'] is not None:
+                return
+
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = await subscriber.get(min(SSE_KEEPALIVE, remaining))
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if event['type'] == 'sync':
+                    yield sse_message('snapshot', await load_snapshot(auction_id))
+                    continue
+                yield sse_message(event['type'], event)
+                if event['type'] == 'closed':
+                    return
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'GET /auctions/<auction_id>/stream - error: {error}')
+        finally:
+            auction_events.unsubscribe(auction_id, subscriber)
+
+    response = quart.Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+    response.timeout = None   # the stream is bounded by SSE_MAX_DURATION
+    return response
+
+
+@api.route('/auctions/<auction_id>/', methods=['PUT'])
+@token_required
+async def edit_properties(current_user, auction_id):
+    logger.info('PUT /auctions/<auction_id>/')
+    payload = await quart.request.get_json()
+
+    if not payload or 'item_desc' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'item_description is required to update'}
+        return quart.jsonify(response)
+
+    values = (payload['item_desc'], auction_id)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['auction_owner'], (auction_id,))
+            auction = await cur.fetchone()
+
+            if auction is None:
+                response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+                return quart.jsonify(response)
+
+            if not (auction[0] == current_user):
+                response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
+                return quart.jsonify(response)
+
+            await cur.execute(demo_proj.STATEMENTS['auction_describe'], values)
+            response = {'status': StatusCodes['success'], 'results': f'Updated: {cur.rowcount}'}
+
+        invalidate_responses('auctions', auction_namespace(auction_id))
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'PUT /auctions/<auction_id> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/user/activity/', methods=['GET'])
+@token_required
+async def list_user_auctions(current_user):
+    logger.info(f'GET /user/activity/')
+
+    try:
+        fmt = stream_format(quart.request.args, quart.request.headers)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    def to_content(auction):
+        return {'auction_id': auction[0], 'item_id': auction[1], 'end_date_time': auction[2], 'title': auction[3],
+                'highest_bid': auction[4], 'bid_count': auction[5]}
+
+    created = demo_proj.STATEMENTS['user_auctions_created']
+    bidded = demo_proj.STATEMENTS['user_auctions_bids']
+
+    if fmt is not None:
+        return stream_response(fmt, [
+            ('auctions_summary', created, (current_user,), to_content),
+            ('bids_summary', bidded, (current_user,), to_content)
+        ])
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(created, (current_user,))
+            auctions_summary = [to_content(auction) for auction in await cur.fetchall()]
+
+            await cur.execute(bidded, (current_user,))
+            bids_summary = [to_content(auction) for auction in await cur.fetchall()]
+
+            response = {'status': StatusCodes['success'], 'auctions_summary': auctions_summary, 'bids_summary' : bids_summary}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET user/<username>/auctions - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/notifications/', methods=['GET'])
+@token_required
+async def list_notifications(current_user):
+    logger.info('GET /notifications')
+
+    try:
+        after, limit = keyset_args(quart.request.args)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return quart.jsonify(response)
+
+    before = after or 2 ** 31 - 1
+    statement = 'notifications_unread_page' if quart.request.args.get('unread') == '1' else 'notifications_page'
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS[statement], (current_user, before, limit + 1))
+            rows = await cur.fetchall()
+
+            await cur.execute(demo_proj.STATEMENTS['notifications_unread_count'], (current_user,))
+            unread = (await cur.fetchone())[0]
+
+            response = keyset_page(rows, limit, notification_content)
+            response['unread_count'] = unread
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /notifications - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/notifications/read', methods=['POST'])
+@token_required
+async def read_notifications(current_user):
+    logger.info('POST /notifications/read')
+    payload = await quart.request.get_json(silent=True) or {}
+
+    try:
+        up_to = int(payload.get('notif_id', 2 ** 31 - 1))
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'results': 'notif_id must be a number'}
+        return quart.jsonify(response)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['notifications_mark_read'], (current_user, up_to))
+            response = {'status': StatusCodes['success'], 'results': {'marked_read': cur.rowcount}}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /notifications/read - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/bid/', methods=['POST'])
+@token_required
+@rate_limited('bid')
+async def place_bid(current_user):
+    logger.info(f'PUT /bid')
+
+    payload = await quart.request.get_json()
+
+    if not payload or 'auction_id' not in payload or 'bid_amount' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'missing information'}
+        return quart.jsonify(response)
+
+    try:
+        auction_id = int(payload['auction_id'])
+        amount = float(payload['bid_amount'])
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'results': 'auction_id and bid_amount must be numbers'}
+        return quart.jsonify(response)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['place_bid'], (auction_id, current_user, amount))
+            accepted, reason, bid_id, high_bid = await cur.fetchone()
+
+            if accepted:
+                await publish_events(conn, [{'type': 'bid', 'auction_id': auction_id, 'bid_id': bid_id, 'amount': amount, 'user_id': current_user}])
+
+            response = bid_result(accepted, reason, bid_id, high_bid, payload['bid_amount'])
+
+        if accepted:
+            invalidate_responses(auction_namespace(auction_id))
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /bid - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/bids/', methods=['POST'])
+@token_required
+@rate_limited('bid')
+async def place_bids(current_user):
+    logger.info('POST /bids')
+
+    payload = await quart.request.get_json(silent=True)
+
+    if not payload or not isinstance(payload.get('bids'), list) or not payload['bids']:
+        response = {'status': StatusCodes['api_error'], 'results': 'bids must be a non-empty list'}
+        return quart.jsonify(response)
+
+    if len(payload['bids']) > BULK_BID_MAX:
+        response = {'status': StatusCodes['api_error'], 'results': f'at most {BULK_BID_MAX} bids per request'}
+        return quart.jsonify(response)
+
+    bids = parse_bids(payload['bids'])
+
+    try:
+        if bids.auction_ids:
+            async with db_transaction() as conn:
+                cur = await conn.execute(demo_proj.STATEMENTS['place_bids'], (current_user, bids.auction_ids, bids.amounts))
+                events = bids.decide(await cur.fetchall(), current_user)
+
+                await publish_events(conn, events)
+
+            invalidate_responses(*{auction_namespace(event['auction_id']) for event in events})
+
+        response = bids.response()
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /bids - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/comments/', methods=['POST'])
+@token_required
+async def auction_board(current_user):
+    logger.info('POST /comments')
+    payload = await quart.request.get_json()
+
+    if not payload or 'comment_content' not in payload or 'auction_id' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'value not in payload'}
+        return quart.jsonify(response)
+
+    values = (payload['comment_content'], payload['auction_id'], current_user)
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['comment_insert'], values)
+            comment_id, auction_id = await cur.fetchone()
+
+            await publish_events(conn, [{'type': 'comment', 'auction_id': auction_id, 'comment_id': comment_id,
+                                         'comm_content': payload['comment_content'], 'user_id': current_user}])
+            await enqueue_notification(conn, 'comment', 'board', auction_id,
+                                       f"New comment on auction {auction_id}: {payload['comment_content']}", exclude_id=current_user)
+
+            response = {'status': StatusCodes['success'], 'results': f'Inserted comments: {payload["comment_content"]}'}
+
+        invalidate_responses(auction_namespace(payload['auction_id']))
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /comments - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/<int:auction_id>/close/', methods=['GET'])
+@token_required
+async def close_auction(current_user, auction_id):
+    logger.info(f'GET /auctions/{auction_id}/close')
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['auction_result'], (auction_id,))
+            auction = await cur.fetchone()
+
+            if auction is None:
+                response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+                return quart.jsonify(response)
+
+            if not (auction[0] == current_user):
+                response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
+                return quart.jsonify(response)
+
+            # same checks (and responses) as the threaded implementation
+            if auction[1] is None:
+                response = {'status': StatusCodes['api_error'], 'results': 'Auction has not yet closed'}
+                return quart.jsonify(response)
+
+            if auction[4] is not None:
+                response = {'status': StatusCodes['api_error'], 'results': 'Auction was canceled'}
+                return quart.jsonify(response)
+
+            if auction[2] is None:
+                response = {'status': StatusCodes['api_error'], 'results': 'No bids found for this auction'}
+                return quart.jsonify(response)
+
+            results = {
+                'Winner Username' : auction[2],
+                'Winning Bid'     : auction[3],
+                'Closed At'       : auction[1]
+            }
+
+            response = {'status': StatusCodes['success'], 'results': results}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(error)
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@api.route('/auctions/<int:auction_id>/cancel', methods=['POST'])
+@token_required
+async def cancel_auction(current_user, auction_id):
+    logger.info(f'POST /auctions/{auction_id}/cancel')
+
+    try:
+        async with db_transaction() as conn:
+            cur = await conn.execute(demo_proj.STATEMENTS['auction_owner'], (auction_id,))
+            auction = await cur.fetchone()
+
+            if auction is None:
+                response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+                return quart.jsonify(response)
+
+            if not (auction[0] == current_user):
+                response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
+                return quart.jsonify(response)
+
+            if auction[2]:
+                response = {'status': StatusCodes['api_error'], 'results': 'Auction has already ended'}
+                return quart.jsonify(response)
+
+            await cur.execute(demo_proj.STATEMENTS['auction_cancel'], (auction_id,))
+            await enqueue_notification(conn, 'canceled', 'bidders', auction_id, f'Auction {auction_id} was canceled by the seller')
+
+            response = {'status': StatusCodes['success'], 'results': 'Auction canceled successfully'}
+
+        invalidate_responses('auctions', auction_namespace(auction_id))
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(error)
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+##########################################################
+## APPLICATION
+##########################################################
+
+def create_app():
+    demo_proj.setup_logging()
+
+    app = quart.Quart(__name__)
+    app.register_blueprint(api)
+
+    @app.before_serving
+    async def startup():
+        # once per worker process, inside its event loop
+        await open_pool()
+        # the workers of demo_proj run on threads of their own, off the event loop, on its psycopg2
+        # pool: the token reaper, the revocation list (TOKEN_MODE=signed), the auction closer and the
+        # notification writer; the auction events listener starts with the first stream
+        demo_proj.start_background_workers()
+
+    @app.after_serving
+    async def shutdown():
+        demo_proj.shutdown_worker()
+        await close_pool()
+
+    return app
+
+
+app = create_app()
@@ -0,0 +1,97 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Auction summary verification
+##
+## auction_stats (migrations/0005_auction_stats.sql) is maintained by triggers on bids and comments.
+## This script compares it with the aggregates of the bids and comments tables and rebuilds the
+## auctions that drifted (or all of them). last_activity is not checked, it cannot be recomputed.
+##
+## To use it (inside the api container, or with DB_HOST=localhost from the host):
+##
+## python auction_stats.py verify                 list auctions whose summary differs, exit 1 if any
+## python auction_stats.py verify --fix           and rebuild them
+## python auction_stats.py rebuild                recompute the summary of every auction
+## python auction_stats.py rebuild 12 15          recompute the summary of auctions 12 and 15
+
+import sys
+
+import psycopg2
+
+from migrate import DB_CONFIG
+
+# Reported (and rebuilt by "verify --fix") at most this many auctions per run
+VERIFY_LIMIT = 1000
+
+DRIFT_QUERY = """
+    SELECT a.auction_id, s.auctions_auction_id IS NULL,
+           s.current_high_bid, top.amount, s.high_bidder_id, top.users_user_id,
+           s.bid_count, COALESCE(b.bid_count, 0), s.comment_count, COALESCE(c.comment_count, 0)
+    FROM auctions a
+    LEFT JOIN auction_stats s ON s.auctions_auction_id = a.auction_id
+    LEFT JOIN (SELECT auctions_auction_id, COUNT(*) AS bid_count FROM bids GROUP BY auctions_auction_id) b
+           ON b.auctions_auction_id = a.auction_id
+    LEFT JOIN (SELECT DISTINCT ON (auctions_auction_id) auctions_auction_id, amount, users_user_id FROM bids
+               ORDER BY auctions_auction_id, amount DESC, bid_id) top ON top.auctions_auction_id = a.auction_id
+    LEFT JOIN (SELECT auctions_auction_id, COUNT(*) AS comment_count FROM comments GROUP BY auctions_auction_id) c
+           ON c.auctions_auction_id = a.auction_id
+    WHERE s.auctions_auction_id IS NULL
+       OR s.current_high_bid IS DISTINCT FROM top.amount
+       OR s.high_bidder_id IS DISTINCT FROM top.users_user_id
+       OR s.bid_count <> COALESCE(b.bid_count, 0)
+       OR s.comment_count <> COALESCE(c.comment_count, 0)
+    ORDER BY a.auction_id
+    LIMIT %s"""
+
+
+def drifted(conn, limit=VERIFY_LIMIT):
+    with conn.cursor() as cur:
+        cur.execute(DRIFT_QUERY, (limit,))
+        return cur.fetchall()
+
+
+def rebuild(conn, auction_ids=None):
+    # all auctions when auction_ids is None
+    with conn.cursor() as cur:
+        cur.execute('SELECT rebuild_auction_stats(%s)', (auction_ids,))
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def verify(conn, fix=False):
+    rows = drifted(conn)
+    for row in rows:
+        if row[1]:
+            print(f'auction {row[0]}: no summary row')
+            continue
+        print(f'auction {row[0]}: high bid {row[2]} (expected {row[3]}), bidder {row[4]} (expected {row[5]}), '
+              f'bids {row[6]} (expected {row[7]}), comments {row[8]} (expected {row[9]})')
+
+    if not rows:
+        print('auction_stats is consistent')
+    elif fix:
+        print(f'{rebuild(conn, [row[0] for row in rows])} auction(s) rebuilt')
+    conn.rollback()
+    return len(rows)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'verify'
+    if command not in ('verify', 'rebuild') or (command == 'verify' and sys.argv[2:] not in ([], ['--fix'])):
+        print(f'usage: python {sys.argv[0]} verify [--fix] | rebuild [AUCTION_ID ...]')
+        sys.exit(2)
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        if command == 'verify':
+            sys.exit(1 if verify(conn, '--fix' in sys.argv) else 0)
+        try:
+            auction_ids = [int(a) for a in sys.argv[2:]] or None
+        except ValueError:
+            print('auction ids must be numbers')
+            sys.exit(2)
+        print(f'{rebuild(conn, auction_ids)} auction(s) rebuilt')
+    finally:
+        conn.close()
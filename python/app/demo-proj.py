@@ -6,84 +6,2272 @@
 ## It is in this file that yiu should implement the functionalities/transactions   
 
 import flask
-import logging, psycopg2, time
+import logging, logging.handlers, psycopg2, time
+import os, queue, re, select, threading
+import atexit, base64, bisect, hashlib, hmac, itertools, json, math, secrets, uuid
 import random
 import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 from flask import request
 from datetime import datetime
 
-app = flask.Flask(__name__)
+import migrate
+
+# Every endpoint is registered on this blueprint, create_app() builds the Flask application
+api = flask.Blueprint('api', __name__)
+
+logger = logging.getLogger('logger')
 
 StatusCodes = {
     'success': 200,
     'api_error': 400,
     'unauthorized': 401,
     'not_found': 404,
-    'internal_error': 500
+    'too_many_requests': 429,
+    'internal_error': 500,
+    'unavailable': 503
 }
 
 ##########################################################
-## DATABASE ACCESS
+## DATABASE ACCESS
+##########################################################
+
+# Connection settings, can be overridden through the environment
+DB_CONFIG = {
+    'user': os.environ.get('DB_USER', 'scott'),
+    'password': os.environ.get('DB_PASSWORD', 'tiger'),
+    'host': os.environ.get('DB_HOST', 'db'),
+    'port': os.environ.get('DB_PORT', '5432'),
+    'database': os.environ.get('DB_NAME', 'dbproj')
+}
+
+# Pool settings
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 20))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))           # seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))  # seconds before a connection is recycled
+DB_POOL_HEALTH_CHECK = os.environ.get('DB_POOL_HEALTH_CHECK', '1') == '1'  # ping with SELECT 1 on checkout
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    # Cursor that adds the time of every statement to the metrics of the current request
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            observe_query(self, query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            observe_query(self, query, time.perf_counter() - started)
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    # Connection that remembers which STATEMENTS are prepared in its session
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def db_connection():
+    db = psycopg2.connect(**DB_CONFIG, connection_factory=PreparedConnection, cursor_factory=TimedCursor)
+    observe_connection()
+
+    return db
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    # Thread-safe pool of psycopg2 connections.
+    # Connections are opened lazily up to maxconn, checked before being handed out
+    # and closed once they are older than max_lifetime.
+
+    def __init__(self, connect, minconn, maxconn, timeout, max_lifetime, health_check=True):
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+
+        self._cond = threading.Condition()
+        self._idle = []        # [(conn, created_at)]
+        self._created = {}     # id(conn) -> created_at, for every open connection
+        self._pending = 0      # connections being opened
+        self._in_use = 0
+        self._closed = False
+
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'health_check_failures': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0
+        }
+
+        for _ in range(minconn):
+            try:
+                conn = self._open()
+            except psycopg2.Error:
+                break  # the database may still be starting, connections will be opened on demand
+            self._idle.append((conn, self._created[id(conn)]))
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+            self._stats['connections_opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._created.pop(id(conn), None)
+            self._stats['connections_closed'] += 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _expired(self, created_at):
+        return self.max_lifetime > 0 and time.monotonic() - created_at > self.max_lifetime
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+
+        while True:
+            conn = None
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError('connection pool is closed')
+
+                while not self._idle and len(self._created) + self._pending >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f'no database connection available after {self.timeout}s')
+                    waited = True
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, created_at = self._idle.pop()
+                else:
+                    # reserve a slot, the connection itself is opened outside the lock
+                    self._pending += 1
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                finally:
+                    with self._cond:
+                        self._pending -= 1
+                        self._cond.notify()
+            elif self._expired(created_at):
+                self._discard(conn)
+                continue
+            elif not self._healthy(conn):
+                self._stats['health_check_failures'] += 1
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use += 1
+                self._stats['checkouts'] += 1
+                if waited:
+                    wait = time.monotonic() - start
+                    self._stats['waits'] += 1
+                    self._stats['wait_time_total'] += wait
+                    self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait)
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            self._in_use -= 1
+            created_at = self._created.get(id(conn))
+
+        if close or conn.closed or self._closed or created_at is None or self._expired(created_at):
+            self._discard(conn)
+            return
+
+        # never hand out a connection in the middle of a transaction
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+
+        with self._cond:
+            self._idle.append((conn, created_at))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = len(self._created)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._in_use
+            stats['min_size'] = self.minconn
+            stats['max_size'] = self.maxconn
+        stats['saturation'] = stats['in_use'] / self.maxconn if self.maxconn else 0.0
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def db_pool():
+    # The pool is created on first use so that every process gets its own connections
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(db_connection, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                       DB_POOL_MAX_LIFETIME, DB_POOL_HEALTH_CHECK)
+    return _pool
+
+
+@contextmanager
+def db_transaction():
+    # Borrow a pooled connection for the duration of a transaction.
+    # Commits when the block exits normally, rolls back (and re-raises) on error.
+    pool = db_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+
+##########################################################
+## PREPARED STATEMENTS
+##########################################################
+
+# PREPARED_STATEMENTS=0 sends the SQL text of every statement instead (to measure the difference)
+PREPARED_STATEMENTS = os.environ.get('PREPARED_STATEMENTS', '1') == '1'
+
+# The hot statements of the endpoints, by name. Each one is prepared (parsed, and planned once
+# PostgreSQL settles on a generic plan) the first time a pooled connection runs it, afterwards
+# only EXECUTE name (values) is sent. Placeholders are %s as in every other query.
+# Statements with {columns} list the fields chosen with ?fields= (field_statement()) and are sent as text.
+STATEMENTS = {
+    'users_page': "SELECT user_id, {columns} FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s",
+    'user_get': "SELECT username, email FROM users WHERE username = %s",
+    'user_update_city': "UPDATE users SET city = %s WHERE username = %s",
+    'user_insert': "INSERT INTO users (username, email, password) VALUES (%s, %s, %s)",
+    'token_lookup': "SELECT users_user_id, EXTRACT(EPOCH FROM exp_date - current_timestamp) FROM tokens WHERE token= %s AND exp_date > current_timestamp",
+    'token_delete': "DELETE FROM tokens WHERE token = %s",
+    'token_insert': "INSERT INTO tokens (users_user_id, token, exp_date) VALUES (%s, %s, current_timestamp + make_interval(secs => %s))",
+    'token_revoke': "INSERT INTO token_revocations (token_id, users_user_id, expires_at) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+    'token_revocations': "SELECT revocation_id, token_id, expires_at FROM token_revocations "
+                         "WHERE revocation_id > %s AND expires_at > EXTRACT(EPOCH FROM current_timestamp) ORDER BY revocation_id",
+    'token_expired_lag': "SELECT EXTRACT(EPOCH FROM current_timestamp - MIN(exp_date)) FROM tokens WHERE exp_date < current_timestamp",
+    'token_reap': "DELETE FROM tokens WHERE ctid IN (SELECT ctid FROM tokens WHERE exp_date < current_timestamp LIMIT %s)",
+    'revocation_reap': "DELETE FROM token_revocations WHERE expires_at < EXTRACT(EPOCH FROM current_timestamp)",
+    'user_login': "SELECT user_id, password FROM users WHERE username = %s",
+    'user_rehash': "UPDATE users SET password = %s WHERE user_id = %s AND password = %s",
+    'auctions_page': "SELECT auction_id, {columns} FROM auctions LEFT JOIN auction_stats ON auctions_auction_id = auction_id "
+                     "WHERE end_date_time > current_timestamp AND auction_id > %s ORDER BY auction_id LIMIT %s",
+    'auction_insert': "INSERT INTO auctions (item_id, min_price, title, item_desc, end_date_time, users_user_id) VALUES (%s, %s, %s, %s, %s, %s) RETURNING auction_id",
+    'auction_owner': "SELECT users_user_id, end_date_time, closed_at IS NOT NULL OR end_date_time < current_timestamp "
+                     "FROM auctions WHERE auction_id = %s",
+    'auction_describe': "UPDATE auctions SET item_desc = %s WHERE auction_id = %s",
+    'auction_cancel': "UPDATE auctions SET end_date_time = current_timestamp, canceled_at = current_timestamp WHERE auction_id = %s",
+    'auction_detail': """
+    SELECT a.auction_id, a.item_id, a.title, a.min_price, a.end_date_time, a.item_desc,
+           s.current_high_bid, COALESCE(s.bid_count, 0), tb.bids, COALESCE(s.comment_count, 0), rc.comments,
+           s.high_bidder_id, s.last_activity, a.closed_at
+    FROM auctions a
+    LEFT JOIN auction_stats s ON s.auctions_auction_id = a.auction_id
+    CROSS JOIN LATERAL (SELECT COALESCE(json_agg(json_build_object('bid_id', bid_id, 'amount', amount, 'user_id', users_user_id)
+                                                 ORDER BY amount DESC, bid_id), '[]') AS bids
+                        FROM (SELECT bid_id, amount, users_user_id FROM bids WHERE auctions_auction_id = a.auction_id
+                              ORDER BY amount DESC, bid_id LIMIT %s) top_bids) tb
+    CROSS JOIN LATERAL (SELECT COALESCE(json_agg(json_build_object('comment_id', comment_id, 'comm_content', comm_content, 'user_id', users_user_id)
+                                                 ORDER BY comment_id DESC), '[]') AS comments
+                        FROM (SELECT comment_id, comm_content, users_user_id FROM comments WHERE auctions_auction_id = a.auction_id
+                              ORDER BY comment_id DESC LIMIT %s) recent_comments) rc
+    WHERE a.auction_id = %s""",
+    'auction_bids': "SELECT bid_id, amount, users_user_id FROM bids WHERE auctions_auction_id = %s ORDER BY amount DESC, bid_id LIMIT %s OFFSET %s",
+    'auction_comments': "SELECT comment_id, comm_content, users_user_id FROM comments WHERE auctions_auction_id = %s ORDER BY comment_id DESC LIMIT %s OFFSET %s",
+    'auction_result': "SELECT a.users_user_id, a.closed_at, u.username, a.winning_bid, a.canceled_at FROM auctions a "
+                      "LEFT JOIN users u ON u.user_id = a.winner_id WHERE a.auction_id = %s",
+    'auction_close_due': "SELECT auction_id, winner_id, winning_bid FROM close_due_auctions(%s)",
+    'auction_close_lag': "SELECT EXTRACT(EPOCH FROM current_timestamp - MIN(end_date_time)) FROM auctions "
+                         "WHERE closed_at IS NULL AND end_date_time < current_timestamp",
+    'search_item': "SELECT auction_id, item_desc, title, NULL FROM auctions WHERE item_id = %s ORDER BY auction_id LIMIT %s OFFSET %s",
+    'search_text': "SELECT auction_id, item_desc, title, ts_rank(search_vector, query) AS rank "
+                   "FROM auctions, websearch_to_tsquery('english', %s) query "
+                   "WHERE search_vector @@ query OR item_desc ILIKE %s OR title ILIKE %s "
+                   "ORDER BY rank DESC, auction_id LIMIT %s OFFSET %s",
+    'user_auctions_created': "SELECT auction_id, item_id, end_date_time, title, current_high_bid, COALESCE(bid_count, 0) "
+                             "FROM auctions LEFT JOIN auction_stats ON auctions_auction_id = auction_id WHERE users_user_id = %s",
+    'user_auctions_bids': "SELECT auction_id, item_id, end_date_time, title, current_high_bid, COALESCE(bid_count, 0) "
+                          "FROM auctions LEFT JOIN auction_stats ON auctions_auction_id = auction_id "
+                          "WHERE auction_id IN (SELECT auctions_auction_id FROM bids WHERE users_user_id = %s)",
+    'place_bid': "SELECT accepted, reason, bid_id, high_bid FROM place_bid(%s, %s, %s)",
+    'place_bids': "SELECT ord, auction_id, accepted, reason, bid_id, high_bid FROM place_bids(%s, %s::INTEGER[], %s::FLOAT(8)[])",
+    'comment_insert': "INSERT INTO comments (comm_content, auctions_auction_id, users_user_id) VALUES (%s, %s, %s) "
+                      "RETURNING comment_id, auctions_auction_id",
+    'auction_snapshot': "SELECT a.auction_id, a.end_date_time, a.closed_at, s.current_high_bid, s.high_bidder_id, "
+                        "COALESCE(s.bid_count, 0), COALESCE(s.comment_count, 0) "
+                        "FROM auctions a LEFT JOIN auction_stats s ON s.auctions_auction_id = a.auction_id WHERE a.auction_id = %s",
+    'auction_notify': "SELECT pg_notify('auction_events', payload) FROM unnest(%s::TEXT[]) AS payload",
+    'notification_enqueue': "INSERT INTO notification_queue (kind, audience, auctions_auction_id, recipient_id, exclude_id, content) "
+                            "VALUES (%s, %s, %s, %s, %s, left(%s, 512))",
+    'notification_deliver': "SELECT events, delivered FROM deliver_notifications(%s)",
+    'notification_backlog': "SELECT COUNT(*), EXTRACT(EPOCH FROM current_timestamp - MIN(created_at)) FROM notification_queue",
+    'notifications_page': "SELECT notif_id, notif_content, auctions_auction_id, created_at, read_at FROM notifications "
+                          "WHERE users_user_id = %s AND notif_id < %s ORDER BY notif_id DESC LIMIT %s",
+    'notifications_unread_page': "SELECT notif_id, notif_content, auctions_auction_id, created_at, read_at FROM notifications "
+                                 "WHERE users_user_id = %s AND notif_id < %s AND read_at IS NULL ORDER BY notif_id DESC LIMIT %s",
+    'notifications_unread_count': "SELECT COUNT(*) FROM notifications WHERE users_user_id = %s AND read_at IS NULL",
+    'notifications_mark_read': "UPDATE notifications SET read_at = current_timestamp "
+                               "WHERE users_user_id = %s AND notif_id <= %s AND read_at IS NULL"
+}
+
+_placeholders = re.compile(r'%%|%s')
+
+
+def positional(query):
+    # %s placeholders to $1, $2... as PREPARE expects them
+    counter = itertools.count(1)
+    return _placeholders.sub(lambda m: '%' if m.group() == '%%' else f'${next(counter)}', query)
+
+
+def execute_statement(cur, name, values=()):
+    # Runs STATEMENTS[name] with values, prepared once per connection.
+    # Prepared statements belong to the session, so they survive commits and rollbacks and
+    # disappear with the connection (a recycled connection simply prepares them again).
+    conn = cur.connection
+    prepared = getattr(conn, 'prepared', None)
+    if not PREPARED_STATEMENTS or prepared is None:
+        return cur.execute(STATEMENTS[name], values)
+
+    if name not in prepared:
+        cur.execute(f'PREPARE {name} AS {positional(STATEMENTS[name])}')
+        prepared.add(name)
+
+    try:
+        if values:
+            return cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})", values)
+        return cur.execute(f'EXECUTE {name}')
+    except psycopg2.errors.InvalidSqlStatementName:
+        # deallocated behind our back (e.g. DISCARD ALL), prepared again on the next call
+        prepared.discard(name)
+        raise
+
+
+def field_statement(name, columns, fields):
+    # STATEMENTS[name] listing the SQL columns (a dict of response key -> SQL column) of fields;
+    # column names come from USER_FIELDS/AUCTION_FIELDS, never from the request
+    return STATEMENTS[name].format(columns=', '.join(columns[f] for f in fields))
+
+
+
+##########################################################
+## BACKGROUND WORKERS
+##########################################################
+
+class PeriodicWorker:
+    # Daemon thread calling run_once() every interval seconds until stop() is called.
+    # Subclasses implement run_once() and may extend stats().
+
+    name = 'worker'
+
+    def __init__(self, interval):
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self._stats = {
+            'runs': 0,
+            'errors': 0,
+            'last_run_at': None,
+            'last_duration': 0.0,
+            'max_duration': 0.0
+        }
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as error:
+                logger.error(f'{self.name} - error: {error}')
+                with self._lock:
+                    self._stats['errors'] += 1
+            duration = time.monotonic() - start
+
+            with self._lock:
+                self._stats['runs'] += 1
+                self._stats['last_run_at'] = time.time()
+                self._stats['last_duration'] = duration
+                self._stats['max_duration'] = max(self._stats['max_duration'], duration)
+
+            self._stop.wait(self.interval)
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['interval'] = self.interval
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+
+
+##########################################################
+## LOGGING
+##########################################################
+
+# Logging settings (LOG_LEVEL=DEBUG LOG_ASYNC=0 LOG_FORMAT=text is the original synchronous, per row logging)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')                # json (one object per line) or text
+LOG_FILE = os.environ.get('LOG_FILE', 'logs/log_file.log')
+LOG_ASYNC = os.environ.get('LOG_ASYNC', '1') == '1'               # records are written by a background thread
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))     # records waiting to be written, more are dropped
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', 100))   # 1 in N sampled records is written
+
+# extra= of high volume records (e.g. one per row fetched), only 1 in LOG_SAMPLE_EVERY of them is written
+SAMPLED = {'sampled': True}
+
+_request_id = re.compile(r'^[\w.-]{1,64}$')
+
+
+class RequestContextFilter(logging.Filter):
+    # Tags every record with the id of the current request and samples the high volume ones.
+    # Runs in the thread that logs, only for records whose level is enabled.
+
+    def __init__(self, sample_every):
+        super().__init__()
+        self.sample_every = max(sample_every, 1)
+        self._sampled = itertools.count()
+
+    def filter(self, record):
+        if getattr(record, 'sampled', False) and next(self._sampled) % self.sample_every:
+            return False
+        record.request_id = flask.g.get('request_id', '-') if flask.has_request_context() else '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per record
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'request_id': getattr(record, 'request_id', '-'),
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Hands records to the writer thread, never blocks: when the queue is full the record is dropped
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_log_handler = None
+_log_listener = None
+
+
+def log_handlers():
+    # the handlers that actually write, a file and the console
+    os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(request_id)s:  %(message)s', '%H:%M:%S')
+
+    handlers = [logging.FileHandler(LOG_FILE), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def start_log_writer():
+    # (Re)starts the writer thread on a new queue: after a fork, the parent's thread does not exist in the child
+    global _log_listener
+    if _log_handler is None:
+        return
+    _log_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, *log_handlers())
+    _log_listener.start()
+
+
+def stop_log_writer():
+    # writes the records still queued
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def logging_metrics():
+    dropped = _log_handler.dropped if _log_handler is not None else 0
+    return '\n'.join([
+        '# HELP log_records_dropped_total Log records dropped because the writer could not keep up',
+        '# TYPE log_records_dropped_total counter',
+        f'log_records_dropped_total {dropped}'
+    ]) + '\n'
+
+
+@api.before_app_request
+def assign_request_id():
+    # a well formed X-Request-ID from the client (or a proxy) is kept, otherwise a new one is generated
+    request_id = flask.request.headers.get('X-Request-ID', '')
+    flask.g.request_id = request_id if _request_id.match(request_id) else uuid.uuid4().hex
+
+
+@api.after_app_request
+def return_request_id(response):
+    if 'request_id' in flask.g:
+        response.headers['X-Request-ID'] = flask.g.request_id
+    return response
+
+
+
+##########################################################
+## METRICS
+##########################################################
+
+# Histogram buckets (upper bounds) of the request metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)  # bytes
+
+# Methods outside this set are reported as "other", so that labels stay bounded
+METRIC_METHODS = {'GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS'}
+
+
+class Histogram:
+    # Counts of observations per bucket (not cumulative, the exposition adds them up), sum and count
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    # Counters and histograms keyed by a tuple of label values, rendered in the Prometheus text format.
+    # Labels are only ever route templates, methods and status codes, never raw URLs or user input.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()   # name -> (type, help, label names, buckets, {label values -> value})
+
+    def counter(self, name, help, labels=()):
+        self._metrics[name] = ('counter', help, labels, None, {})
+
+    def histogram(self, name, help, labels, buckets):
+        self._metrics[name] = ('histogram', help, labels, buckets, {})
+
+    def inc(self, name, labels=(), amount=1):
+        series = self._metrics[name][4]
+        with self._lock:
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        _, _, _, buckets, series = self._metrics[name]
+        with self._lock:
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help, label_names, buckets, series) in self._metrics.items():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in series.items():
+                    pairs = [f'{k}="{escape_label(v)}"' for k, v in zip(label_names, labels)]
+                    if kind == 'counter':
+                        lines.append(f'{name}{format_labels(pairs)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), value.counts):
+                        cumulative += count
+                        le = 'le="%s"' % bound
+                        lines.append(f'{name}_bucket{format_labels(pairs + [le])} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(pairs)} {value.sum}')
+                    lines.append(f'{name}_count{format_labels(pairs)} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(pairs):
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+metrics = MetricsRegistry()
+metrics.histogram('http_request_duration_seconds', 'Time to produce the response', ('method', 'route'), LATENCY_BUCKETS)
+metrics.histogram('http_request_db_seconds', 'Time spent executing SQL statements per request', ('method', 'route'), LATENCY_BUCKETS)
+metrics.histogram('http_request_python_seconds', 'Time spent outside SQL statements per request', ('method', 'route'), LATENCY_BUCKETS)
+metrics.histogram('http_request_queries', 'SQL statements executed per request', ('method', 'route'), QUERY_BUCKETS)
+metrics.histogram('http_response_size_bytes', 'Size of the response body (streamed responses are not counted)', ('method', 'route'), SIZE_BUCKETS)
+metrics.counter('http_requests_total', 'Requests answered', ('method', 'route', 'status'))
+metrics.counter('db_connections_opened_total', 'Database connections opened, by the route that needed them', ('route',))
+
+
+def request_metrics():
+    # the measurements of the current request, None outside of a request (e.g. background workers)
+    if flask.has_request_context():
+        return flask.g.get('metrics')
+    return None
+
+
+def observe_query(cur, query, duration):
+    record_query(request_metrics(), cur, query, duration)
+
+
+def record_query(current, cur, query, duration):
+    # current: the measurements of the request that ran the statement, None outside of a request
+    if current is not None:
+        current['db_time'] += duration
+        current['queries'] += 1
+
+    if query_profiler is not None:
+        statement = query_profiler.record(cur, query, duration, current)
+        if current is not None:
+            current['statements'][statement] = current['statements'].get(statement, 0) + 1
+
+
+def observe_connection():
+    current = request_metrics()
+    if current is not None:
+        current['connections'] += 1
+    else:
+        metrics.inc('db_connections_opened_total', ('background',))
+
+
+def new_request_metrics(endpoint):
+    return {'started': time.perf_counter(), 'endpoint': endpoint, 'db_time': 0.0, 'queries': 0, 'connections': 0, 'statements': {}}
+
+
+def observe_request(current, method, route, status, size):
+    # a finished request, route is its template (/auctions/<auction_id>/), never the URL itself;
+    # size is None when the length of the body is not known (streamed responses). Shared with asgi.py.
+    duration = time.perf_counter() - current['started']
+    method = method if method in METRIC_METHODS else 'other'
+    labels = (method, route)
+
+    metrics.observe('http_request_duration_seconds', labels, duration)
+    metrics.observe('http_request_db_seconds', labels, current['db_time'])
+    metrics.observe('http_request_python_seconds', labels, max(duration - current['db_time'], 0.0))
+    metrics.observe('http_request_queries', labels, current['queries'])
+    if size is not None:
+        metrics.observe('http_response_size_bytes', labels, size)
+    metrics.inc('http_requests_total', (method, route, str(status)))
+    if current['connections']:
+        metrics.inc('db_connections_opened_total', (route,), current['connections'])
+
+
+@api.before_app_request
+def start_request_metrics():
+    flask.g.metrics = new_request_metrics(flask.request.endpoint)
+
+
+@api.after_app_request
+def record_request_metrics(response):
+    current = request_metrics()
+    if current is None:
+        return response
+
+    route = flask.request.url_rule.rule if flask.request.url_rule is not None else 'unmatched'
+    observe_request(current, flask.request.method, route, response.status_code, None if response.is_streamed else response.content_length)
+    if query_profiler is not None:
+        query_profiler.check_repeats(current['endpoint'] or route, current['statements'])
+
+    return response
+
+
+def pool_metrics():
+    # gauges and counters of the connection pool, read when /metrics is scraped
+    if _pool is None:
+        return ''
+    stats = _pool.stats()
+    return '\n'.join([
+        '# HELP db_pool_connections Connections of the pool by state',
+        '# TYPE db_pool_connections gauge',
+        f'db_pool_connections{{state="idle"}} {stats["idle"]}',
+        f'db_pool_connections{{state="in_use"}} {stats["in_use"]}',
+        '# HELP db_pool_max_connections Maximum size of the pool',
+        '# TYPE db_pool_max_connections gauge',
+        f'db_pool_max_connections {stats["max_size"]}',
+        '# HELP db_pool_timeouts_total Checkouts that gave up waiting for a connection',
+        '# TYPE db_pool_timeouts_total counter',
+        f'db_pool_timeouts_total {stats["timeouts"]}',
+        '# HELP db_pool_wait_seconds_total Time spent waiting for a free connection',
+        '# TYPE db_pool_wait_seconds_total counter',
+        f'db_pool_wait_seconds_total {stats["wait_time_total"]}'
+    ]) + '\n'
+
+
+
+##########################################################
+## SQL PROFILER
+##########################################################
+
+# Profiler settings: SQL_PROFILE=0 disables it
+SQL_PROFILE = os.environ.get('SQL_PROFILE', '1') == '1'
+SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 200))      # statements slower than this are logged
+SQL_SLOW_LOG_SIZE = int(os.environ.get('SQL_SLOW_LOG_SIZE', 100))        # slow statements kept for /debug/queries/
+SQL_REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', 5))    # same statement this often in one request is an N+1
+SQL_PROFILE_MAX_STATEMENTS = int(os.environ.get('SQL_PROFILE_MAX_STATEMENTS', 2000))  # (endpoint, statement) pairs tracked
+
+# Debug endpoints (/debug/...) are only served when DEBUG_ENDPOINTS=1
+DEBUG_ENDPOINTS = os.environ.get('DEBUG_ENDPOINTS', '0') == '1'
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s|%\(\w+\)s")
+_spaces = re.compile(r'\s+')
+
+
+def normalize_statement(query):
+    # literals and placeholders become ?, whitespace is collapsed:
+    # "WHERE auction_id = %s" and "WHERE auction_id = 42" are the same statement
+    return _spaces.sub(' ', _literals.sub('?', query)).strip()
+
+
+class QueryProfiler:
+    # Per (endpoint, normalized statement): calls, total/max time and rows, like pg_stat_statements
+    # but attributed to the endpoint (or background thread) that ran the statement.
+    # Also keeps the most recent slow statements and counts requests repeating a statement (N+1).
+
+    def __init__(self, slow_ms, slow_log_size, repeat_threshold, max_statements):
+        self.slow = slow_ms / 1000.0
+        self.repeat_threshold = repeat_threshold
+        self.max_statements = max_statements
+
+        self._lock = threading.Lock()
+        self._normalized = {}      # raw query text -> normalized, the handlers only issue a few hundred distinct texts
+        self._statements = {}      # (endpoint, statement) -> [calls, total, max, rows]
+        self._repeats = {}         # (endpoint, statement) -> [requests, max executions in one request]
+        self._slow_log = deque(maxlen=slow_log_size)
+        self.dropped = 0
+
+    def normalize(self, cur, query):
+        if not isinstance(query, str):
+            query = query.decode() if isinstance(query, bytes) else query.as_string(cur)
+        statement = self._normalized.get(query)
+        if statement is None:
+            statement = normalize_statement(query)
+            if len(self._normalized) < self.max_statements:
+                self._normalized[query] = statement
+        return statement
+
+    def record(self, cur, query, duration, current):
+        statement = self.normalize(cur, query)
+        endpoint = current['endpoint'] if current is not None else threading.current_thread().name
+        rows = max(cur.rowcount, 0)
+
+        with self._lock:
+            entry = self._statements.get((endpoint, statement))
+            if entry is None:
+                if len(self._statements) >= self.max_statements:
+                    self.dropped += 1
+                    entry = None
+                else:
+                    entry = self._statements[(endpoint, statement)] = [0, 0.0, 0.0, 0]
+            if entry is not None:
+                entry[0] += 1
+                entry[1] += duration
+                entry[2] = max(entry[2], duration)
+                entry[3] += rows
+
+            if duration >= self.slow:
+                self._slow_log.append({'endpoint': endpoint, 'statement': statement, 'ms': duration * 1000,
+                                       'rows': rows, 'at': time.time()})
+
+        if duration >= self.slow:
+            logger.warning(f'slow query {duration * 1000:.1f}ms in {endpoint}: {statement}')
+        return statement
+
+    def check_repeats(self, endpoint, statements):
+        # statements is {normalized statement: executions} for one request
+        for statement, count in statements.items():
+            if count < self.repeat_threshold:
+                continue
+            with self._lock:
+                entry = self._repeats.setdefault((endpoint, statement), [0, 0])
+                entry[0] += 1
+                entry[1] = max(entry[1], count)
+            logger.warning(f'repeated query in {endpoint}: {count} executions of {statement}')
+
+    def top(self, n, order):
+        keys = {'total': lambda e: e[1][1], 'mean': lambda e: e[1][1] / e[1][0], 'calls': lambda e: e[1][0], 'max': lambda e: e[1][2]}
+        with self._lock:
+            entries = sorted(self._statements.items(), key=keys[order], reverse=True)[:n]
+        return [{'endpoint': endpoint, 'statement': statement, 'calls': calls, 'total_ms': total * 1000,
+                 'mean_ms': total * 1000 / calls, 'max_ms': max_ * 1000, 'rows': rows}
+                for (endpoint, statement), (calls, total, max_, rows) in entries]
+
+    def repeats(self):
+        with self._lock:
+            return [{'endpoint': endpoint, 'statement': statement, 'requests': requests, 'max_executions': most}
+                    for (endpoint, statement), (requests, most) in self._repeats.items()]
+
+    def slow_log(self):
+        with self._lock:
+            return list(self._slow_log)
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._repeats.clear()
+            self._slow_log.clear()
+            self.dropped = 0
+
+
+query_profiler = QueryProfiler(SQL_SLOW_QUERY_MS, SQL_SLOW_LOG_SIZE, SQL_REPEAT_THRESHOLD,
+                               SQL_PROFILE_MAX_STATEMENTS) if SQL_PROFILE else None
+
+
+def debug_only(f):
+    # endpoints that expose internals answer 404 unless DEBUG_ENDPOINTS=1
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        if not DEBUG_ENDPOINTS:
+            flask.abort(404)
+        return f(*args, **kwargs)
+
+    return decorator
+
+
+
+##########################################################
+## TOKEN VERIFICATION
+##########################################################
+
+# Token settings
+TOKEN_MODE = os.environ.get('TOKEN_MODE', 'opaque')    # opaque (random, stored hashed) or signed (HMAC, verified without the database)
+TOKEN_TTL = int(os.environ.get('TOKEN_TTL', 86400))     # seconds a token is valid
+TOKEN_SECRET = os.environ.get('TOKEN_SECRET', '')       # HMAC key of signed tokens, the same in every server process
+TOKEN_REVOCATION_REFRESH = float(os.environ.get('TOKEN_REVOCATION_REFRESH', 5))  # seconds between loads of new revocations
+
+# Token cache settings (opaque tokens)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 60))  # seconds a validated token is trusted without a lookup
+
+
+class _Lookup:
+    # A token lookup in progress, shared by every request waiting on the same token
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TokenCache:
+    # Bounded LRU cache of validated tokens: token -> (user_id, expires_at).
+    # An entry expires at the token's own expiry date or after ttl seconds, whichever comes first,
+    # so a token revoked by another process is trusted for at most ttl seconds.
+    # Concurrent misses on the same token are coalesced into a single lookup.
+    # clock returns the current time in seconds, the tests replace it.
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._lookups = {}
+
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+
+    def get(self, token, loader):
+        # loader(token) returns (user_id, seconds_until_expiry) or None for an unknown/expired token
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(token)
+                    self._stats['hits'] += 1
+                    return entry[0]
+                del self._entries[token]
+                self._stats['expirations'] += 1
+
+            self._stats['misses'] += 1
+            lookup = self._lookups.get(token)
+            leader = lookup is None
+            if leader:
+                lookup = self._lookups[token] = _Lookup()
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            lookup.done.wait()
+            if lookup.error is not None:
+                raise lookup.error
+            return lookup.result
+
+        try:
+            row = loader(token)
+            if row is not None:
+                user_id, remaining = row
+                lookup.result = user_id
+                self.put(token, user_id, remaining)
+        except Exception as error:
+            lookup.error = error
+            raise
+        finally:
+            with self._lock:
+                self._lookups.pop(token, None)
+            lookup.done.set()
+
+        return lookup.result
+
+    def put(self, token, user_id, remaining):
+        expires_at = self.clock() + min(float(remaining), self.ttl)
+        with self._lock:
+            self._entries[token] = (user_id, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, token):
+        with self._lock:
+            if self._entries.pop(token, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['max_size'] = self.maxsize
+            stats['ttl'] = self.ttl
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+def token_digest(token):
+    # opaque tokens are stored as their SHA-256 (migrations/0008_token_storage.sql)
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def load_token(token):
+    # expired rows are left for the TokenReaper, they are just never matched
+    with db_transaction() as conn:
+        cur = conn.cursor()
+        execute_statement(cur, 'token_lookup', (token_digest(token),))
+        row = cur.fetchone()
+
+    if row is None:
+        return None
+    return row[0], row[1]
+
+
+class OpaqueTokens:
+    # Random tokens (256 bits from secrets), stored hashed in the tokens table. A token is looked
+    # up in the database when it is not in token_cache, at most every TOKEN_CACHE_TTL seconds.
+
+    mode = 'opaque'
+
+    def issue(self, cur, user_id):
+        token = secrets.token_urlsafe(32)
+        execute_statement(cur, 'token_insert', (user_id, token_digest(token), TOKEN_TTL))
+        return token
+
+    def verify(self, token):
+        # user id, or None for an unknown, expired or revoked token
+        return token_cache.get(token, load_token)
+
+    def revoke(self, token):
+        with db_transaction() as conn:
+            cur = conn.cursor()
+            execute_statement(cur, 'token_delete', (token_digest(token),))
+            revoked = cur.rowcount
+
+        token_cache.invalidate(token)
+        return revoked
+
+    def stats(self):
+        stats = token_cache.stats()
+        stats['mode'] = self.mode
+        return stats
+
+
+class RevocationList(PeriodicWorker):
+    # Ids of the revoked signed tokens that have not expired yet: token_id -> expires_at (epoch).
+    # Every process loads the revocations made by the others every interval seconds (only the rows
+    # added since its last load), its own ones are added at once. Lookups take no lock.
+
+    name = 'token-revocations'
+
+    def __init__(self, interval):
+        super().__init__(interval)
+        self._revoked = {}
+        self._last_id = 0
+        self._stats.update({
+            'loaded': 0,
+            'pruned': 0
+        })
+
+    def __contains__(self, token_id):
+        return token_id in self._revoked
+
+    def add(self, token_id, expires_at):
+        with self._lock:
+            self._revoked[token_id] = expires_at
+
+    def run_once(self):
+        with db_transaction() as conn:
+            cur = conn.cursor()
+            execute_statement(cur, 'token_revocations', (self._last_id,))
+            rows = cur.fetchall()
+
+        now = time.time()
+        with self._lock:
+            # a new dict, lookups never see one being resized
+            revoked = {token_id: expires_at for token_id, expires_at in self._revoked.items() if expires_at > now}
+            pruned = len(self._revoked) - len(revoked)
+            for revocation_id, token_id, expires_at in rows:
+                revoked[token_id] = expires_at
+                self._last_id = max(self._last_id, revocation_id)
+            self._revoked = revoked
+            self._stats['loaded'] += len(rows)
+            self._stats['pruned'] += pruned
+
+    def stats(self):
+        stats = super().stats()
+        stats['size'] = len(self._revoked)
+        return stats
+
+
+class SignedTokens:
+    # Stateless tokens: v1.<user_id>.<expires_at>.<token_id>.<signature>, where the signature is
+    # the HMAC-SHA256 of everything before it under TOKEN_SECRET. Verifying one is CPU only: no
+    # database, no cache. Logging out revokes the token id in token_revocations and in the
+    # RevocationList, other processes honour it within TOKEN_REVOCATION_REFRESH seconds.
+
+    mode = 'signed'
+
+    def __init__(self, secret, revocations):
+        if not secret:
+            raise RuntimeError('TOKEN_MODE=signed needs TOKEN_SECRET')
+        # keyed once, every signature starts from a copy
+        self._mac = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+        self.revocations = revocations
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'verified': 0,
+            'rejected': 0,
+            'revoked': 0
+        }
+
+    def _sign(self, claims):
+        mac = self._mac.copy()
+        mac.update(claims.encode())
+        return base64.urlsafe_b64encode(mac.digest()).rstrip(b'=').decode()
+
+    def issue(self, cur, user_id):
+        # nothing is written, cur is only there for the OpaqueTokens interface
+        claims = f'v1.{user_id}.{int(time.time()) + TOKEN_TTL}.{secrets.token_urlsafe(12)}'
+        return f'{claims}.{self._sign(claims)}'
+
+    def claims(self, token):
+        # (user_id, expires_at, token_id) of a token signed with our key, None otherwise
+        claims, _, signature = token.rpartition('.')
+        parts = claims.split('.')
+        if len(parts) != 4 or parts[0] != 'v1' or not hmac.compare_digest(signature, self._sign(claims)):
+            return None
+        try:
+            return int(parts[1]), int(parts[2]), parts[3]
+        except ValueError:
+            return None
+
+    def verify(self, token):
+        claims = self.claims(token)
+        valid = claims is not None and claims[1] > time.time() and claims[2] not in self.revocations
+        with self._lock:
+            self._stats['verified' if valid else 'rejected'] += 1
+        return claims[0] if valid else None
+
+    def revoke(self, token):
+        claims = self.claims(token)
+        if claims is None:
+            return 0
+
+        user_id, expires_at, token_id = claims
+        with db_transaction() as conn:
+            cur = conn.cursor()
+            execute_statement(cur, 'token_revoke', (token_id, user_id, expires_at))
+
+        self.revocations.add(token_id, expires_at)
+        with self._lock:
+            self._stats['revoked'] += 1
+        return 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['mode'] = self.mode
+        stats['revocations'] = self.revocations.stats()
+        return stats
+
+
+def create_token_store(mode):
+    if mode == 'signed':
+        return SignedTokens(TOKEN_SECRET, revocation_list)
+    return OpaqueTokens()
+
+
+revocation_list = RevocationList(TOKEN_REVOCATION_REFRESH)
+token_store = create_token_store(TOKEN_MODE)
+
+
+def revoke_token(token):
+    return token_store.revoke(token)
+
+
+# Expired token reaper settings
+TOKEN_REAPER_INTERVAL = float(os.environ.get('TOKEN_REAPER_INTERVAL', 300))  # seconds between runs
+TOKEN_REAPER_BATCH = int(os.environ.get('TOKEN_REAPER_BATCH', 1000))        # rows deleted per transaction
+
+
+class TokenReaper(PeriodicWorker):
+    # Deletes expired tokens in small batches, each in its own short transaction,
+    # so the purge never holds many row locks or competes with request traffic
+
+    name = 'token-reaper'
+
+    def __init__(self, interval, batch_size):
+        super().__init__(interval)
+        self.batch_size = batch_size
+        self._stats.update({
+            'rows_deleted': 0,
+            'last_rows_deleted': 0,
+            'lag': 0.0
+        })
+
+    def run_once(self):
+        with db_transaction() as conn:
+            cur = conn.cursor()
+            # how long the oldest expired token has been waiting to be removed
+            execute_statement(cur, 'token_expired_lag')
+            lag = cur.fetchone()[0]
+
+        deleted = 0
+        while not self._stop.is_set():
+            with db_transaction() as conn:
+                cur = conn.cursor()
+                execute_statement(cur, 'token_reap', (self.batch_size,))
+                count = cur.rowcount
+            deleted += count
+            if count < self.batch_size:
+                break
+
+        with db_transaction() as conn:
+            cur = conn.cursor()
+            # revocations of signed tokens are only needed until the token expires
+            execute_statement(cur, 'revocation_reap')
+
+        with self._lock:
+            self._stats['rows_deleted'] += deleted
+            self._stats['last_rows_deleted'] = deleted
+            self._stats['lag'] = float(lag or 0.0)
+
+        if deleted:
+            logger.info(f'{self.name} - deleted {deleted} expired tokens')
+
+
+token_reaper = TokenReaper(TOKEN_REAPER_INTERVAL, TOKEN_REAPER_BATCH)
+
+
+def token_required(f):
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        token = None
+
+        if 'access-token' in flask.request.headers:
+            token = flask.request.headers['access-token']
+
+        if not token:
+            return flask.jsonify({'message': 'invalid token'})
+
+        try:
+            current_user = token_store.verify(token)
+
+            if current_user is None:
+                return flask.jsonify({'message': 
+                   'invalid token'})
+        except (Exception) as error:
+            logger.error(f'POST /users - error: {str(error)}')
+
+            return flask.jsonify({'message': 'invalid token'})
+
+        return f(current_user, *args, **kwargs)
+
+    return decorator
+
+##########################################################
+## PASSWORDS
+##########################################################
+
+# Password hashing settings (scrypt)
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))  # CPU and memory cost, a power of two (memory is 128 * N * r bytes)
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))        # block size
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))        # parallelization
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', max(1, (os.cpu_count() or 2) // 2)))  # hashes computed at once per process
+PASSWORD_QUEUE = int(os.environ.get('PASSWORD_QUEUE', 8))               # hashes waiting for a worker, more are refused (503)
+PASSWORD_TIMEOUT = float(os.environ.get('PASSWORD_TIMEOUT', 10))        # seconds a request waits for its hash
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def hash_password(password, n=None, r=None, p=None):
+    # scrypt$N$r$p$salt$hash, the cost parameters travel with the hash so they can be changed later
+    n, r, p = n or PASSWORD_SCRYPT_N, r or PASSWORD_SCRYPT_R, p or PASSWORD_SCRYPT_P
+    salt = os.urandom(16)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32)
+    return f'scrypt${n}${r}${p}${base64.b64encode(salt).decode()}${base64.b64encode(key).decode()}'
+
+
+def check_password(password, stored):
+    # Returns (valid, new_hash): new_hash replaces stored when the password is valid but stored
+    # is in clear (rows from before hashing) or was hashed with other cost parameters.
+    parts = stored.split('$')
+    if len(parts) != 6 or parts[0] != 'scrypt':
+        valid = hmac.compare_digest(password.encode(), stored.encode())
+        return valid, hash_password(password) if valid else None
+
+    n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+    salt, key = base64.b64decode(parts[4]), base64.b64decode(parts[5])
+    valid = hmac.compare_digest(key, hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=len(key)))
+    if valid and (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P):
+        return valid, hash_password(password)
+    return valid, None
+
+
+class PasswordPool:
+    # Runs hash_password/check_password on a few threads of their own (scrypt releases the GIL).
+    # A login surge then uses at most `workers` cores and waits in a short queue; past it, requests
+    # are refused at once (PasswordPoolBusy) instead of holding every server thread, so bids and
+    # browsing keep their threads. The executor is created on first use, after the fork.
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+        self._stats = {
+            'hashed': 0,
+            'rejected_busy': 0,
+            'in_use': 0,
+            'hash_time': 0.0
+        }
+
+    def submit(self, f, *args):
+        # concurrent.futures.Future of f(*args), raises PasswordPoolBusy when the queue is full
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected_busy'] += 1
+            raise PasswordPoolBusy('too many logins in progress, retry later')
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password')
+            executor = self._executor
+            self._stats['in_use'] += 1
+
+        try:
+            return executor.submit(self._run, f, args)
+        except BaseException:
+            # not queued (e.g. the executor was shut down meanwhile), _run will not give the slot back
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+            raise
+
+    def _run(self, f, args):
+        start = time.monotonic()
+        try:
+            return f(*args)
+        finally:
+            with self._lock:
+                self._stats['hashed'] += 1
+                self._stats['in_use'] -= 1
+                self._stats['hash_time'] += time.monotonic() - start
+            self._slots.release()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['queue_size'] = self.queue_size
+        stats['mean_hash_ms'] = 1000 * stats['hash_time'] / stats['hashed'] if stats['hashed'] else 0.0
+        stats['cost'] = {'n': PASSWORD_SCRYPT_N, 'r': PASSWORD_SCRYPT_R, 'p': PASSWORD_SCRYPT_P}
+        return stats
+
+
+password_pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE)
+
+# checked when the user does not exist, so that an unknown username costs the same time
+DUMMY_PASSWORD_HASH = hash_password(secrets.token_urlsafe(16))
+
+
+def password_busy_response():
+    response = {'status': StatusCodes['unavailable'], 'results': 'too many logins in progress, retry later'}
+    return flask.jsonify(response), StatusCodes['unavailable'], {'Retry-After': '1'}
+
+
+def redacted(payload):
+    # the payload as it can be logged: passwords never reach the logs
+    if isinstance(payload, dict) and 'password' in payload:
+        return {**payload, 'password': '***'}
+    return payload
+
+##########################################################
+## PAGINATION
+##########################################################
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+
+def page_args(args=None):
+    # limit/offset query arguments (of the current request unless args is given), raises ValueError when they are not valid
+    args = flask.request.args if args is None else args
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    offset = int(args.get('offset', 0))
+
+    if limit < 1 or offset < 0:
+        raise ValueError('limit must be positive and offset cannot be negative')
+
+    return min(limit, MAX_PAGE_SIZE), offset
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps({'after': key}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))['after'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor')
+
+
+def keyset_args(args=None):
+    # Keyset pagination arguments: ?cursor=<next_cursor> (or ?after=<id>) and ?limit=N.
+    # Returns (after, limit), raises ValueError when they are not valid
+    args = flask.request.args if args is None else args
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+
+    if 'cursor' in args:
+        after = decode_cursor(args['cursor'])
+    else:
+        after = int(args.get('after', 0))
+
+    return after, min(limit, MAX_PAGE_SIZE)
+
+
+def field_args(columns, args=None):
+    # ?fields=a,b projection over columns, a dict of response key -> SQL column.
+    # Returns the selected keys in the order of columns, raises ValueError for unknown fields
+    args = flask.request.args if args is None else args
+    if 'fields' not in args:
+        return list(columns)
+
+    fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+    unknown = [f for f in fields if f not in columns]
+    if unknown or not fields:
+        raise ValueError(f"unknown fields {', '.join(unknown)}, valid fields are {', '.join(columns)}")
+
+    return [key for key in columns if key in fields]
+
+
+def keyset_page(rows, limit, to_content):
+    # The response of a keyset page: rows holds up to limit + 1 rows whose first column is the
+    # key, the extra row only tells that there is a next page
+    results = []
+    for row in rows[:limit]:
+        logger.debug('row %s', row, extra=SAMPLED)
+        results.append(to_content(row))
+
+    next_cursor = encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+    return {'status': StatusCodes['success'], 'results': results, 'next_cursor': next_cursor}
+
+
+def offset_page(rows, limit, offset, to_content):
+    # The same for ?limit=N&offset=M pages
+    results = []
+    for row in rows[:limit]:
+        logger.debug('row %s', row, extra=SAMPLED)
+        results.append(to_content(row))
+
+    next_offset = offset + limit if len(rows) > limit else None
+    return {'status': StatusCodes['success'], 'results': results, 'next_offset': next_offset}
+
+##########################################################
+## STREAMING
+##########################################################
+
+# Rows fetched per round trip by server-side cursors
+STREAM_ITERSIZE = int(os.environ.get('STREAM_ITERSIZE', 2000))
+
+_stream_lock = threading.Lock()
+_stream_stats = {
+    'streams': 0,
+    'rows': 0,
+    'errors': 0,
+    'ttfb_total': 0.0,
+    'ttfb_max': 0.0
+}
+
+
+def stream_format(args=None, headers=None):
+    # ?stream=json or ?stream=ndjson (or Accept: application/x-ndjson), None for a regular response
+    args = flask.request.args if args is None else args
+    headers = flask.request.headers if headers is None else headers
+    fmt = args.get('stream')
+    if fmt is None and 'application/x-ndjson' in headers.get('Accept', ''):
+        fmt = 'ndjson'
+    if fmt not in (None, 'json', 'ndjson'):
+        raise ValueError('stream must be json or ndjson')
+    return fmt
+
+
+def stream_limit(args=None):
+    # streamed results are not bounded unless ?limit= is given, NULL is LIMIT ALL in PostgreSQL
+    args = flask.request.args if args is None else args
+    if 'limit' not in args:
+        return None
+    limit = int(args['limit'])
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return limit
+
+
+def stream_response(fmt, sections):
+    # Streams the rows of one or more queries as they are fetched from a server-side cursor.
+    # sections is a list of (key, query, values, to_content) where to_content maps a row to a dict.
+    # json writes {"status": 200, "<key>": [...], ...}, ndjson writes one object per line
+    # (tagged with "section" when there is more than one).
+    started = time.monotonic()
+    path = flask.request.path
+    dumps = flask.current_app.json.dumps
+
+    def generate():
+        rows = 0
+        ttfb = None
+        error = 0
+        try:
+            with db_transaction() as conn:
+                if fmt == 'json':
+                    yield '{"status": %d' % StatusCodes['success']
+
+                for key, query, values, to_content in sections:
+                    cur = conn.cursor(name='stream')
+                    cur.itersize = STREAM_ITERSIZE
+                    cur.execute(query, values)
+
+                    if fmt == 'json':
+                        yield ', %s: [' % dumps(key)
+                    separator = ''
+                    for row in cur:
+                        content = to_content(row)
+                        if fmt == 'json':
+                            chunk = separator + dumps(content)
+                            separator = ', '
+                        else:
+                            if len(sections) > 1:
+                                content['section'] = key
+                            chunk = dumps(content) + '\n'
+                        if ttfb is None:
+                            ttfb = time.monotonic() - started
+                        rows += 1
+                        yield chunk
+                    if fmt == 'json':
+                        yield ']'
+                    cur.close()
+
+                if fmt == 'json':
+                    yield '}'
+        except (Exception, psycopg2.DatabaseError) as error_:
+            # the status line is already sent, the truncated body is all the client can see
+            logger.error(f'{path} stream - error: {error_}')
+            error = 1
+            if fmt == 'ndjson':
+                yield dumps({'status': StatusCodes['internal_error'], 'errors': str(error_)}) + '\n'
+        finally:
+            record_stream(rows, ttfb, error)
+
+    mimetype = 'application/json' if fmt == 'json' else 'application/x-ndjson'
+    return flask.Response(generate(), mimetype=mimetype)
+
+
+def record_stream(rows, ttfb, error):
+    with _stream_lock:
+        _stream_stats['streams'] += 1
+        _stream_stats['rows'] += rows
+        _stream_stats['errors'] += error
+        if ttfb is not None:
+            _stream_stats['ttfb_total'] += ttfb
+            _stream_stats['ttfb_max'] = max(_stream_stats['ttfb_max'], ttfb)
+
+
+def stream_stats():
+    with _stream_lock:
+        stats = dict(_stream_stats)
+    stats['ttfb_avg'] = stats['ttfb_total'] / stats['streams'] if stats['streams'] else 0.0
+    return stats
+
+
+##########################################################
+## RESPONSE CACHE
+##########################################################
+
+# Response cache settings: RESPONSE_CACHE_BACKEND is local (per process), redis (shared) or off.
+# local is only correct with a single server process: invalidate_responses() clears the cache of the
+# process that handled the write, the others would keep serving (and 304ing) the old response.
+# gunicorn.conf.py turns it off when it starts several workers.
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'local')
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 5000))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 30))  # seconds, bounds staleness between processes with the local backend
+
+
+class LocalCacheBackend:
+    # In-process LRU with a TTL per entry.
+    # Generation counters are kept apart from the LRU so that evicting them can never resurrect stale entries.
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (value, expires_at)
+        self._counters = {}
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def counters(self, names):
+        with self._lock:
+            return [self._counters.get(name, 0) for name in names]
+
+    def incr(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+
+class RedisCacheBackend:
+    # Shared backend on any client with the redis-py get/set/mget/incr interface
+    # (a redis.Redis instance, or an in-memory stand-in such as fakeredis.FakeRedis for local testing)
+
+    def __init__(self, client):
+        self.client = client
+        self.evictions = 0   # evictions happen inside redis
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=ttl)
+
+    def counters(self, names):
+        return [int(value or 0) for value in self.client.mget([f'gen:{name}' for name in names])]
+
+    def incr(self, name):
+        return self.client.incr(f'gen:{name}')
+
+
+class ResponseCache:
+    # Caches serialized JSON bodies keyed by endpoint, path arguments and query string.
+    # Every key embeds the current generation of the namespaces the response depends on
+    # ('auctions' for lists and searches, 'auction:<id>' for one auction);
+    # invalidate() bumps a generation, which makes every dependent entry unreachable at once.
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'stores': 0, 'invalidations': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def key(self, endpoint, namespaces, view_args, args):
+        generations = self.backend.counters(namespaces)
+        raw = json.dumps([endpoint, generations, sorted(view_args.items()), sorted(args.items(multi=True))], default=str)
+        return 'resp:' + hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        if isinstance(value, bytes):
+            value = value.decode()
+        etag, body = value.split('\n', 1)
+        return etag, body
+
+    def set(self, key, etag, body):
+        self.backend.set(key, etag + '\n' + body, self.ttl)
+        self._count('stores')
+
+    def invalidate(self, *namespaces):
+        for name in namespaces:
+            self.backend.incr(name)
+            self._count('invalidations')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['backend'] = type(self.backend).__name__
+        stats['evictions'] = self.backend.evictions
+        stats['ttl'] = self.ttl
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def create_response_cache(backend):
+    if backend == 'off':
+        return None
+    if backend == 'redis':
+        import redis  # optional dependency, only needed for the shared backend
+        return ResponseCache(RedisCacheBackend(redis.Redis.from_url(RESPONSE_CACHE_URL)), RESPONSE_CACHE_TTL)
+    return ResponseCache(LocalCacheBackend(RESPONSE_CACHE_SIZE), RESPONSE_CACHE_TTL)
+
+
+response_cache = create_response_cache(RESPONSE_CACHE_BACKEND)
+
+
+def auction_namespace(auction_id):
+    try:
+        return f'auction:{int(auction_id)}'
+    except (TypeError, ValueError):
+        return f'auction:{auction_id}'
+
+
+def invalidate_responses(*namespaces):
+    # called by the write endpoints once their transaction has committed
+    if response_cache is None:
+        return
+    try:
+        response_cache.invalidate(*namespaces)
+    except Exception as error:
+        logger.error(f'response cache invalidate - error: {error}')
+
+
+def cached_response(namespaces):
+    # Serves a GET endpoint from the response cache, with an ETag so that
+    # a request with a matching If-None-Match gets an empty 304.
+    # namespaces(**view_args) lists the namespaces the response depends on.
+    # Only successful JSON responses are stored, streamed responses bypass the cache.
+    def wrapper(f):
+        @wraps(f)
+        def decorator(*args, **kwargs):
+            if response_cache is None or 'stream' in flask.request.args \
+                    or 'application/x-ndjson' in flask.request.headers.get('Accept', ''):
+                return f(*args, **kwargs)
+
+            try:
+                key = response_cache.key(f.__name__, namespaces(**kwargs), kwargs, flask.request.args)
+                cached = response_cache.get(key)
+            except Exception as error:
+                logger.error(f'response cache - error: {error}')
+                response_cache._count('errors')
+                return f(*args, **kwargs)
+
+            if cached is None:
+                response = flask.make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed or response.mimetype != 'application/json' \
+                        or (response.get_json(silent=True) or {}).get('status') != StatusCodes['success']:
+                    return response
+                body = response.get_data(as_text=True)
+                etag = hashlib.sha1(body.encode()).hexdigest()
+                try:
+                    response_cache.set(key, etag, body)
+                except Exception as error:
+                    logger.error(f'response cache - error: {error}')
+                    response_cache._count('errors')
+            else:
+                etag, body = cached
+
+            if etag in flask.request.if_none_match:
+                response_cache._count('not_modified')
+                response = flask.Response(status=304)
+            else:
+                response = flask.Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            return response
+
+        return decorator
+
+    return wrapper
+
+
+##########################################################
+## RATE LIMITING
+##########################################################
+
+# Rate limiter settings
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'local')   # local (per process), redis (shared) or off
+RATE_LIMIT_URL = os.environ.get('RATE_LIMIT_URL', 'redis://localhost:6379/1')
+RATE_LIMIT_SHARDS = int(os.environ.get('RATE_LIMIT_SHARDS', 16))     # independently locked parts of the local store
+RATE_LIMIT_SIZE = int(os.environ.get('RATE_LIMIT_SIZE', 100000))     # buckets kept by the local store
+
+
+def rate_setting(route, default):
+    # RATE_LIMIT_<ROUTE>=rate/burst: requests per second on average, and at once after being idle
+    rate, burst = os.environ.get(f'RATE_LIMIT_{route.upper()}', default).split('/')
+    return float(rate), float(burst)
+
+
+# Token bucket of each limited route, per user (or per IP address where there is no user yet)
+RATE_LIMITS = {
+    'bid': rate_setting('bid', '5/20'),
+    'search': rate_setting('search', '10/30'),
+    'login': rate_setting('login', '1/10')
+}
+
+
+class LocalRateLimitBackend:
+    # Token buckets in memory, key -> [tokens, updated_at, full_at], split in shards by key hash so
+    # that requests of different clients rarely wait on the same lock. When a shard outgrows its
+    # share of maxsize, full buckets (idle clients, full_at passed) are dropped first, then the least
+    # recently used ones; a dropped bucket reads as full.
+    # clock returns the current time in seconds, the tests replace it.
+
+    def __init__(self, shards, maxsize, clock=time.monotonic):
+        self.shards = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+        self.shard_size = max(1, maxsize // shards)
+        self.clock = clock
+        self.evictions = 0
+
+    def take(self, key, rate, burst):
+        # (allowed, seconds until a token is available)
+        now = self.clock()
+        lock, buckets = self.shards[hash(key) % len(self.shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self.shard_size:
+                    self._evict(buckets, now)
+                bucket = buckets[key] = [burst, now, now]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                buckets.move_to_end(key)
+
+            allowed = bucket[0] >= 1
+            if allowed:
+                bucket[0] -= 1
+            # when the bucket is full again, whatever the rate
+            bucket[2] = now + (burst - bucket[0]) / rate
+            return (True, 0.0) if allowed else (False, (1 - bucket[0]) / rate)
+
+    def _evict(self, buckets, now):
+        for key in [key for key, bucket in buckets.items() if bucket[2] <= now]:
+            del buckets[key]
+        while len(buckets) >= self.shard_size:
+            buckets.popitem(last=False)   # the least recently used bucket
+            self.evictions += 1
+
+    def size(self):
+        return sum(len(buckets) for _, buckets in self.shards)
+
+
+class RedisRateLimitBackend:
+    # Shared token buckets, one hash per key updated by a Lua script (atomic, on the redis clock),
+    # on any client with the redis-py register_script interface (a redis.Redis instance, or
+    # fakeredis.FakeRedis with its lua extra for local testing)
+
+    SCRIPT = """
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + (now - (tonumber(bucket[2]) or now)) * rate)
+        local allowed, wait = 0, 0
+        if tokens >= 1 then
+            tokens, allowed = tokens - 1, 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+        return {allowed, tostring(wait)}"""
+
+    def __init__(self, client):
+        self.client = client
+        self.evictions = 0   # buckets expire inside redis once they are full again
+        self._take = client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, wait = self._take(keys=[f'rate:{key}'], args=[rate, burst])
+        return bool(allowed), float(wait)
+
+    def size(self):
+        return None
+
+
+class RateLimiter:
+    # Counts the decisions of a backend. A backend error lets the request through: the limiter
+    # protects the database, it must not become a reason for requests to fail.
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._stats = {'allowed': 0, 'limited': 0, 'errors': 0}
+
+    def take(self, key, rate, burst):
+        try:
+            allowed, retry_after = self.backend.take(key, rate, burst)
+        except Exception as error:
+            logger.error(f'rate limiter - error: {error}')
+            allowed, retry_after, outcome = True, 0.0, 'errors'
+        else:
+            outcome = 'allowed' if allowed else 'limited'
+
+        with self._lock:
+            self._stats[outcome] += 1
+        return allowed, retry_after
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['backend'] = type(self.backend).__name__
+        stats['buckets'] = self.backend.size()
+        stats['evictions'] = self.backend.evictions
+        stats['limits'] = {route: {'rate': rate, 'burst': burst} for route, (rate, burst) in RATE_LIMITS.items()}
+        return stats
+
+
+def create_rate_limiter(backend):
+    if backend == 'off':
+        return None
+    if backend == 'redis':
+        import redis  # optional dependency, only needed for the shared backend
+        return RateLimiter(RedisRateLimitBackend(redis.Redis.from_url(RATE_LIMIT_URL)))
+    return RateLimiter(LocalRateLimitBackend(RATE_LIMIT_SHARDS, RATE_LIMIT_SIZE))
+
+
+rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND)
+
+
+def rate_limit_response(retry_after):
+    # body and headers of a 429
+    response = {'status': StatusCodes['too_many_requests'], 'results': 'rate limit exceeded, retry later',
+                'retry_after': round(retry_after, 3)}
+    return response, {'Retry-After': str(math.ceil(retry_after))}
+
+
+def rate_limited(route, by_user=True):
+    # Takes a token from the route's bucket of the client before running the endpoint, 429 with
+    # Retry-After when it is empty. by_user: below token_required, keyed on current_user (the
+    # first argument); otherwise keyed on the client address.
+    rate, burst = RATE_LIMITS[route]
+
+    def wrapper(f):
+        @wraps(f)
+        def decorator(*args, **kwargs):
+            if rate_limiter is None:
+                return f(*args, **kwargs)
+
+            client = f'user:{args[0]}' if by_user else f'ip:{flask.request.remote_addr}'
+            allowed, retry_after = rate_limiter.take(f'{route}:{client}', rate, burst)
+            if not allowed:
+                response, headers = rate_limit_response(retry_after)
+                return flask.jsonify(response), StatusCodes['too_many_requests'], headers
+            return f(*args, **kwargs)
+
+        return decorator
+
+    return wrapper
+
+
+##########################################################
+## AUCTION EVENTS
+##########################################################
+
+# Auction event settings
+AUCTION_EVENTS_QUEUE = int(os.environ.get('AUCTION_EVENTS_QUEUE', 100))         # events buffered per subscriber
+AUCTION_EVENTS_RECONNECT = float(os.environ.get('AUCTION_EVENTS_RECONNECT', 1))  # seconds before listening again after an error
+
+
+def publish_events(cur, events):
+    # Sends the events (dicts with an auction_id) on the auction_events channel with pg_notify:
+    # they are delivered when the transaction of cur commits, and never if it rolls back
+    if events:
+        execute_statement(cur, 'auction_notify', ([json.dumps(event, default=str) for event in events],))
+
+
+class AuctionEvents(PeriodicWorker):
+    # One LISTEN connection per process, opened with the first subscriber, fans the auction_events
+    # notifications out to the subscribers of each auction (the open /auctions/<id>/stream requests).
+    # A subscriber is anything with put_nowait(), a queue.Queue by default. When the connection is
+    # (re)established, events may have been missed: every subscriber gets a 'sync' event and
+    # re-reads the state of its auction.
+
+    name = 'auction-events'
+
+    def __init__(self, interval, queue_size):
+        super().__init__(interval)
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._stats.update({
+            'listening': False,
+            'subscribers': 0,
+            'events': 0,
+            'delivered': 0,
+            'dropped': 0
+        })
+
+    def subscribe(self, auction_id, subscriber=None, limit=None):
+        # the subscriber, or None when `limit` subscribers are already registered (checked and
+        # registered under the same lock, so concurrent requests never go over it)
+        subscriber = subscriber if subscriber is not None else queue.Queue(self.queue_size)
+        with self._lock:
+            if limit is not None and self._stats['subscribers'] >= limit:
+                return None
+            self._subscribers.setdefault(auction_id, set()).add(subscriber)
+            self._stats['subscribers'] += 1
+            self.start()   # under the lock, so that concurrent first subscribers start one listener
+        return subscriber
+
+    def unsubscribe(self, auction_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(auction_id, set())
+            if subscriber in subscribers:
+                subscribers.discard(subscriber)
+                self._stats['subscribers'] -= 1
+            if not subscribers:
+                self._subscribers.pop(auction_id, None)
+
+    def dispatch(self, event, auction_id=None):
+        # to the subscribers of auction_id, or to every subscriber
+        with self._lock:
+            if auction_id is None:
+                targets = [s for subscribers in self._subscribers.values() for s in subscribers]
+            else:
+                targets = list(self._subscribers.get(auction_id, ()))
+
+        delivered = dropped = 0
+        for subscriber in targets:
+            try:
+                subscriber.put_nowait(event)
+                delivered += 1
+            except queue.Full:
+                # a client that does not keep up misses events, never blocks the others
+                dropped += 1
+
+        with self._lock:
+            self._stats['delivered'] += delivered
+            self._stats['dropped'] += dropped
+
+    def run_once(self):
+        # listens until stop() or a connection error, _loop retries every interval seconds
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('LISTEN auction_events')
+            with self._lock:
+                self._stats['listening'] = True
+            self.dispatch({'type': 'sync'})
+
+            while not self._stop.is_set():
+                if select.select([conn], [], [], 1.0)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            event = json.loads(notify.payload)
+                            auction_id = int(event['auction_id'])
+                        except (KeyError, TypeError, ValueError):
+                            logger.error(f'{self.name} - invalid event: {notify.payload}')
+                            continue
+                        with self._lock:
+                            self._stats['events'] += 1
+                        self.dispatch(event, auction_id)
+        finally:
+            with self._lock:
+                self._stats['listening'] = False
+            conn.close()
+
+
+auction_events = AuctionEvents(AUCTION_EVENTS_RECONNECT, AUCTION_EVENTS_QUEUE)
+
+
+##########################################################
+## AUCTION CLOSER
 ##########################################################
 
-def db_connection():
-    db = psycopg2.connect(
-        user = "scott",
-        password = "tiger",
-        host = "db",
-        port = "5432",
-        database = "dbproj"
-    )
-    
-    return db
+# Auction closer settings
+AUCTION_CLOSER_INTERVAL = float(os.environ.get('AUCTION_CLOSER_INTERVAL', 5))  # seconds between runs
+AUCTION_CLOSER_BATCH = int(os.environ.get('AUCTION_CLOSER_BATCH', 100))       # auctions closed per transaction
+
+
+class AuctionCloser(PeriodicWorker):
+    # Closes the auctions that are due in batches, each in its own transaction, through
+    # close_due_auctions() (migrations/0009_auction_cancellation.sql): winner and price are recorded
+    # (none for a canceled auction) and the notifications queued with the closed state. Every server
+    # process runs one, SKIP LOCKED makes them share the due auctions instead of waiting for each other.
+
+    name = 'auction-closer'
+
+    def __init__(self, interval, batch_size):
+        super().__init__(interval)
+        self.batch_size = batch_size
+        self._stats.update({
+            'auctions_closed': 0,
+            'last_auctions_closed': 0,
+            'lag': 0.0
+        })
 
+    def run_once(self):
+        with db_transaction() as conn:
+            cur = conn.cursor()
+            # how long the oldest due auction has been waiting to be closed
+            execute_statement(cur, 'auction_close_lag', ())
+            lag = cur.fetchone()[0]
+
+        closed = 0
+        while not self._stop.is_set():
+            with db_transaction() as conn:
+                cur = conn.cursor()
+                execute_statement(cur, 'auction_close_due', (self.batch_size,))
+                rows = cur.fetchall()
+                publish_events(cur, [{'type': 'closed', 'auction_id': row[0], 'winner_id': row[1], 'winning_bid': row[2]}
+                                     for row in rows])
+
+            closed += len(rows)
+            invalidate_responses(*[auction_namespace(row[0]) for row in rows])
+            if len(rows) < self.batch_size:
+                break
+
+        with self._lock:
+            self._stats['auctions_closed'] += closed
+            self._stats['last_auctions_closed'] = closed
+            self._stats['lag'] = float(lag or 0.0)
+
+        if closed:
+            logger.info(f'{self.name} - closed {closed} auctions')
+
+
+auction_closer = AuctionCloser(AUCTION_CLOSER_INTERVAL, AUCTION_CLOSER_BATCH)
 
 
 ##########################################################
-## TOKEN VERIFICATION
+## NOTIFICATIONS
 ##########################################################
 
-def token_required(f):
-    @wraps(f)
-    def decorator(*args, **kwargs):
-        token = None
+# Notification writer settings
+NOTIFICATION_INTERVAL = float(os.environ.get('NOTIFICATION_INTERVAL', 1))   # seconds between runs
+NOTIFICATION_BATCH = int(os.environ.get('NOTIFICATION_BATCH', 500))         # queued events delivered per transaction
 
-        if 'access-token' in flask.request.headers:
-            token = flask.request.headers['access-token']
 
-        if not token:
-            return flask.jsonify({'message': 'invalid token'})
+def enqueue_notification(cur, kind, audience, auction_id, content, recipient_id=None, exclude_id=None):
+    # Queues one event in notification_queue (migrations/0007_notification_pipeline.sql), in the
+    # transaction of cur: the request writes one row whatever the audience, the NotificationWriter
+    # writes the notifications later. audience is user (recipient_id), seller, bidders or board
+    # (seller and commenters), exclude_id (the author) gets no notification.
+    execute_statement(cur, 'notification_enqueue', (kind, audience, auction_id, recipient_id, exclude_id, content))
 
-        try:
-            conn = db_connection()
+
+class NotificationWriter(PeriodicWorker):
+    # Drains notification_queue with deliver_notifications(): a batch of events is claimed with
+    # SKIP LOCKED, fanned out to its recipients and written with one multi-row insert, in one
+    # transaction, until the queue is empty. Every server process runs one.
+
+    name = 'notification-writer'
+
+    def __init__(self, interval, batch_size):
+        super().__init__(interval)
+        self.batch_size = batch_size
+        self._stats.update({
+            'events': 0,
+            'notifications': 0,
+            'last_events': 0,
+            'backlog': 0,
+            'lag': 0.0
+        })
+
+    def run_once(self):
+        with db_transaction() as conn:
             cur = conn.cursor()
-            cur.execute("DELETE FROM tokens WHERE exp_date < current_timestamp")
-            conn.commit()
+            # events waiting and how long the oldest one has been waiting
+            execute_statement(cur, 'notification_backlog', ())
+            backlog, lag = cur.fetchone()
 
-            cur.execute("SELECT users_user_id FROM tokens WHERE token= %s", (token,))
+        events = delivered = 0
+        while backlog and not self._stop.is_set():
+            with db_transaction() as conn:
+                cur = conn.cursor()
+                execute_statement(cur, 'notification_deliver', (self.batch_size,))
+                batch_events, batch_delivered = cur.fetchone()
 
-            if cur.rowcount==0:
-                return flask.jsonify({'message': 
-                   'invalid token'})
-            else:
-                current_user = cur.fetchone()[0]
-        except (Exception) as error:
-            logger.error(f'POST /users - error: {str(error)}')
-            conn.rollback()
+            events += batch_events
+            delivered += batch_delivered
+            if batch_events < self.batch_size:
+                break
 
-            return flask.jsonify({'message': 'invalid token'})
+        with self._lock:
+            self._stats['events'] += events
+            self._stats['notifications'] += delivered
+            self._stats['last_events'] = events
+            self._stats['backlog'] = backlog
+            self._stats['lag'] = float(lag or 0.0)
 
-        return f(current_user, *args, **kwargs)
+        if events:
+            logger.debug(f'{self.name} - {events} events, {delivered} notifications')
+
+
+notification_writer = NotificationWriter(NOTIFICATION_INTERVAL, NOTIFICATION_BATCH)
 
-    return decorator
 
 ##########################################################
 ## ENDPOINTS
 ##########################################################
 
 
-@app.route('/')
+@api.route('/')
 def landing_page():
     return """
 
@@ -95,45 +2283,177 @@ def landing_page():
     <br/>
     """
 
+##
+## Metrics
+##
+## Request latency (total, SQL and Python time), SQL statements per request, response sizes,
+## requests by status and connections opened, per route template, in the Prometheus text format.
+## Every server process keeps its own metrics: with several gunicorn workers, scrape each of them
+## (or run one worker per container) rather than a load balanced address.
+##
+## To use it, access:
+##
+## curl -X GET http://localhost:8080/metrics
+##
+## Status: Complete
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body = metrics.render() + pool_metrics() + logging_metrics()
+    return flask.Response(body, mimetype='text/plain', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+##
+## Query Profile
+##
+## The top ?top=N statements (default 20) by ?order=total|mean|calls|max time, per endpoint,
+## the recent slow statements and the statements repeated within a request (N+1 patterns).
+## DELETE resets the profile. Only served with DEBUG_ENDPOINTS=1.
+##
+## To use it, access:
+##
+## curl -X GET "http://localhost:8080/debug/queries/?top=10&order=mean"
+##
+## Status: Complete
+
+@api.route('/debug/queries/', methods=['GET', 'DELETE'])
+@debug_only
+def query_profile():
+    logger.info(f'{flask.request.method} /debug/queries')
+
+    return flask.jsonify(query_profile_response(flask.request.method, flask.request.args))
+
+
+def query_profile_response(method, args):
+    # shared with asgi.py
+    if query_profiler is None:
+        return {'status': StatusCodes['not_found'], 'results': 'the profiler is disabled (SQL_PROFILE=0)'}
+
+    if method == 'DELETE':
+        query_profiler.reset()
+        return {'status': StatusCodes['success'], 'results': 'profile reset'}
+
+    try:
+        top = min(int(args.get('top', 20)), MAX_PAGE_SIZE)
+        order = args.get('order', 'total')
+        if top < 1 or order not in ('total', 'mean', 'calls', 'max'):
+            raise ValueError('top must be positive and order one of total, mean, calls, max')
+    except ValueError as error:
+        return {'status': StatusCodes['api_error'], 'results': str(error)}
+
+    results = {
+        'statements': query_profiler.top(top, order),
+        'repeated': query_profiler.repeats(),
+        'slow': query_profiler.slow_log(),
+        'slow_threshold_ms': query_profiler.slow * 1000,
+        'dropped': query_profiler.dropped
+    }
+    return {'status': StatusCodes['success'], 'results': results}
+
+##
+## Component Statistics
+##
+## Obtain the counters of one component of this server process:
+##
+##   pool           size, saturation and wait times of the database connection pool
+##   tokens         token mode, and the token cache (opaque) or the tokens verified/rejected/revoked
+##                  and the revocation list (signed)
+##   passwords      scrypt cost parameters, passwords hashed, mean hash time and logins refused (pool busy)
+##   ratelimit      requests allowed and limited (429), the buckets kept and the limits of each route
+##   reaper         rows deleted, run duration and lag of the expired token reaper
+##   closer         auctions closed, run duration and lag of the auction closer
+##   notifications  events and notifications delivered, and the queue backlog and lag
+##   events         listener state, open streams and events delivered (or dropped)
+##   streaming      streamed responses, rows and time to first row
+##   cache          hit/miss/304 counters of the response cache
+##
+## Only served with DEBUG_ENDPOINTS=1.
+##
+## To use it, access:
+##
+## curl -X GET http://localhost:8080/stats/pool/
+##
+## Status: Complete
+
+# component -> function returning its stats (looked up on every call, the components can be replaced)
+STATS = {
+    'pool': lambda: db_pool().stats(),
+    'tokens': lambda: token_store.stats(),
+    'passwords': lambda: password_pool.stats(),
+    'ratelimit': lambda: rate_limiter.stats() if rate_limiter is not None else {'backend': 'off'},
+    'reaper': lambda: token_reaper.stats(),
+    'closer': lambda: auction_closer.stats(),
+    'notifications': lambda: notification_writer.stats(),
+    'events': lambda: auction_events.stats(),
+    'streaming': lambda: stream_stats(),
+    'cache': lambda: response_cache.stats() if response_cache is not None else {'backend': 'off'}
+}
+
+
+def stats_response(stats, component):
+    # shared with asgi.py, which passes its own providers
+    provider = stats.get(component)
+    if provider is None:
+        return {'status': StatusCodes['not_found'], 'results': f"unknown component, valid ones are {', '.join(stats)}"}
+    return {'status': StatusCodes['success'], 'results': provider()}
+
+
+@api.route('/stats/<component>/', methods=['GET'])
+@debug_only
+def component_stats(component):
+    logger.info(f'GET /stats/{component}')
+
+    return flask.jsonify(stats_response(STATS, component))
+
 ##
 ## List All Users
 ##
 ## Obtain all users in JSON format
 ##
+## Results are paginated with ?limit=N, pass the returned next_cursor as ?cursor= to get the
+## next page (next_cursor is null on the last page). ?fields=username,email selects the fields returned.
+## ?stream=json or ?stream=ndjson streams all users (or ?limit=N of them) as they are read.
+##
 ## To use it, access:
 ##
-## http://localhost:8080/users/
+## http://localhost:8080/users/?limit=100&fields=username
 ##
 ## Status: Complete
 
-@app.route('/users/', methods=['GET'])
+USER_FIELDS = {'username': 'username', 'email': 'email'}
+
+@api.route('/users/', methods=['GET'])
 def get_all_users():
     logger.info('GET /users')
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        fmt = stream_format()
+        after, limit = keyset_args()
+        fields = field_args(USER_FIELDS)
+        if fmt is not None:
+            limit = stream_limit()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
 
-        cur.execute('SELECT username, email FROM users')
-        rows = cur.fetchall()
+    query = field_statement('users_page', USER_FIELDS, fields)
 
-        logger.debug('GET /users - parse')
-        Results = []
-        for row in rows:
-            logger.debug(row)
-            content = {'username': row[0], 'email': row[1]}
-            Results.append(content)  # appending to the payload to be returned
+    if fmt is not None:
+        return stream_response(fmt, [('results', query, (after, limit), lambda row: dict(zip(fields, row[1:])))])
+
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
+
+            cur.execute(query, (after, limit + 1))
+            rows = cur.fetchall()
 
-        response = {'status': StatusCodes['success'], 'results': Results}
+            logger.debug('GET /users - parse')
+            response = keyset_page(rows, limit, lambda row: dict(zip(fields, row[1:])))
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /users - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
@@ -148,33 +2468,29 @@ def get_all_users():
 ##
 ## Status: Complete
 
-@app.route('/users/<username>/', methods=['GET'])
+@api.route('/users/<username>/', methods=['GET'])
 def get_user(username):
     logger.info('GET /users/<username>')
 
-    logger.debug('username: {username}')
+    logger.debug('username: %s', username)
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        cur.execute('SELECT username, email FROM users where username = %s', (username,))
-        row = cur.fetchone()
+            execute_statement(cur, 'user_get', (username,))
+            row = cur.fetchone()
 
-        logger.debug('GET /users/<username> - parse')
-        logger.debug(row)
-        content = {'username': row[0], 'email': row[1]}
+            logger.debug('GET /users/<username> - parse')
+            logger.debug('row %s', row)
+            content = {'username': row[0], 'email': row[1]}
 
-        response = {'status': StatusCodes['success'], 'results': content}
+            response = {'status': StatusCodes['success'], 'results': content}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /users/<username> - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
@@ -191,12 +2507,12 @@ def get_user(username):
 ##
 ## Status: Complete
 
-@app.route('/users/<username>', methods=['PUT'])
+@api.route('/users/<username>', methods=['PUT'])
 def update_users(username):
     logger.info('PUT /users/<username>')
     payload = flask.request.get_json()
 
-    logger.debug(f'PUT /users/<username> - payload: {payload}')
+    logger.debug('PUT /users/<username> - payload: %s', payload)
 
     # do not forget to validate every argument, e.g.,:
     if 'city' not in payload:
@@ -204,30 +2520,19 @@ def update_users(username):
         return flask.jsonify(response)
 
     # parameterized queries, good for security and performance
-    statement = 'UPDATE users SET city = %s WHERE username = %s'
     values = (payload['city'], username)
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
-
-        res = cur.execute(statement, values)
-        response = {'status': StatusCodes['success'], 'results': f'Updated: {cur.rowcount}'}
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        # commit the transaction
-        conn.commit()
+            execute_statement(cur, 'user_update_city', values)
+            response = {'status': StatusCodes['success'], 'results': f'Updated: {cur.rowcount}'}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(error)
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-        # an error occurred, rollback
-        conn.rollback()
-
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
@@ -249,45 +2554,39 @@ def update_users(username):
 ##
 ## Status: Complete
 
-@app.route('/users/', methods=['POST'])
+@api.route('/users/', methods=['POST'])
 def add_users():
     logger.info('POST /users')
     payload = flask.request.get_json()
 
     
 
-    logger.debug(f'POST /users - payload: {payload}')
+    logger.debug('POST /users - payload: %s', redacted(payload))
 
     # do not forget to validate every argument, e.g.,:
     if not payload or 'username' not in payload or 'email' not in payload or 'password' not in payload:
         response = {'status': StatusCodes['api_error'], 'results': 'values missing from payload'}
         return flask.jsonify(response)
     
-    # parameterized queries, good for security and performance
-    statement = 'INSERT INTO users (username, email, password) VALUES (%s, %s, %s)'
-    values = (payload['username'], payload['email'], payload['password'])
-
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        # hashed on the password pool, before taking a database connection
+        password = password_pool.submit(hash_password, payload['password']).result(PASSWORD_TIMEOUT)
+        values = (payload['username'], payload['email'], password)
+
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        cur.execute(statement, values)
+            # parameterized queries, good for security and performance
+            execute_statement(cur, 'user_insert', values)
 
-        # commit the transaction
-        conn.commit()
-        response = {'status': StatusCodes['success'], 'results': f'Inserted users {payload["username"]}'}
+            response = {'status': StatusCodes['success'], 'results': f'Inserted users {payload["username"]}'}
 
+    except PasswordPoolBusy:
+        return password_busy_response()
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'POST /users - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-        # an error occurred, rollback
-        conn.rollback()
-
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
@@ -296,18 +2595,25 @@ def add_users():
 ##
 ## User login
 ##
+## Returns a token for the access-token header, valid TOKEN_TTL seconds: a random one stored hashed
+## (TOKEN_MODE=opaque) or one signed with TOKEN_SECRET and verified without the database (TOKEN_MODE=signed).
+## Passwords are checked with scrypt on the password pool; a password stored in clear or with older
+## cost parameters is hashed again with the current ones. 503 (with Retry-After) when the pool is full,
+## 429 (with Retry-After) past RATE_LIMIT_LOGIN attempts from one address.
+##
 ## To use it, you need to use postman or curl:
 ##
 ## curl -X POST http://localhost:8080/login/ -H 'Content-Type: application/json' -d '{"username": "abc", "password": "abc"}'
 ##
 ## Status: Complete
 
-@app.route('/login/', methods=['POST'])
+@api.route('/login/', methods=['POST'])
+@rate_limited('login', by_user=False)
 def user_login():
     logger.info('POST /login')
     payload = flask.request.get_json()
 
-    logger.debug(f'POST /login - payload: {payload}')
+    logger.debug('POST /login - payload: %s', redacted(payload))
 
     # Validate every argument
     if not payload \
@@ -316,50 +2622,69 @@ def user_login():
         response = {'status': StatusCodes['unauthorized'], 'results': 'missing credentials from payload'}
         return flask.jsonify(response)
     
-    # parameterized queries
-    query = 'SELECT user_id FROM users WHERE username = %s AND password = %s'
-    values = (payload['username'], payload['password'])
-    
-
     try:
         # connecting to the database
-        conn = db_connection()
-        cur = conn.cursor()
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        # excuting the query
-        cur.execute(query, values)
-        
-        user_id = cur.fetchone()[0]
+            # excuting the query
+            execute_statement(cur, 'user_login', (payload['username'],))
+            row = cur.fetchone()
 
-        if cur.rowcount == 0:
+        # the password is checked on the password pool, with no database connection held
+        user_id, stored = row if row is not None else (None, DUMMY_PASSWORD_HASH)
+        valid, new_hash = password_pool.submit(check_password, payload['password'], stored).result(PASSWORD_TIMEOUT)
+
+        if user_id is None or not valid:
             response = ('could not verify', 401)
-        else: 
-            response = payload['username'] + \
-                str(random.randrange(111111111, 999999999))
-            
-            query  = "INSERT INTO tokens (users_user_id, token, exp_date) \
-                VALUES( %s, %s, current_timestamp + (24 * interval '1 hour'))"
-            values = (user_id, response)
+        else:
+            with db_transaction() as conn:
+                cur = conn.cursor()
 
-            cur.execute(query, values)
+                # stored in clear or with other cost parameters: replaced, unless it changed meanwhile
+                if new_hash is not None:
+                    execute_statement(cur, 'user_rehash', (new_hash, user_id, stored))
 
-        conn.commit()
+                response = token_store.issue(cur, user_id)
+
+    except PasswordPoolBusy:
+        return password_busy_response()
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'POST /login - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-
-        # an error occurred, rollback
-        conn.rollback()
-
-    finally:
-        if conn is not None:
-            conn.close()
     
     return response
 
 
 
 
+##
+## User logout
+##
+## Revokes the token used in the request
+##
+## curl -X POST http://localhost:8080/logout/ -H "access-token: abc229373448"
+##
+## Status: Complete
+
+@api.route('/logout/', methods=['POST'])
+@token_required
+def user_logout(current_user):
+    logger.info('POST /logout')
+
+    try:
+        revoke_token(flask.request.headers['access-token'])
+        response = {'status': StatusCodes['success'], 'results': 'Logged out'}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /logout - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return flask.jsonify(response)
+
+
+
+
 ##
 ## Create Auction
 ##
@@ -369,13 +2694,13 @@ def user_login():
 ##
 ## Status: Complete
 
-@app.route('/auctions/', methods=['POST'])
+@api.route('/auctions/', methods=['POST'])
 @token_required
 def create_auction(current_user):
     logger.info('POST /auctions')
     payload = flask.request.get_json()
 
-    logger.debug(f'POST /auctions - payload: {payload}')
+    logger.debug('POST /auctions - payload: %s', payload)
 
     # do not forget to validate every argument, e.g.,:
     if not payload or 'end_date_time' not in payload \
@@ -384,32 +2709,160 @@ def create_auction(current_user):
         response = {'status': StatusCodes['api_error'], 'results': 'values missing from payload'}
         return flask.jsonify(response)
     
-    # parameterized queries, good for security and performance
-    statement = 'INSERT INTO auctions (item_id, min_price, title, item_desc, end_date_time, users_user_id) VALUES (%s, %s, %s, %s, %s, %s) RETURNING auction_id'
     values = (payload['item_id'], payload['min_price'], payload['title'], payload['item_desc'], payload['end_date_time'], current_user)
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        cur.execute(statement, values)
+            execute_statement(cur, 'auction_insert', values)
 
-        auction_id = cur.fetchone()[0]
+            auction_id = cur.fetchone()[0]
 
-        # commit the transaction
-        conn.commit()
-        response = {'auction_id': auction_id}
+            response = {'auction_id': auction_id}
+
+        invalidate_responses('auctions')
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'POST /auctions - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-        # an error occurred, rollback
-        conn.rollback()
+    return flask.jsonify(response)
+
 
-    finally:
-        if conn is not None:
-            conn.close()
+
+
+##
+## Get All Auctions
+##
+## Obtain all active auctions in JSON format
+##
+## Results are paginated with ?limit=N, pass the returned next_cursor as ?cursor= (or the last
+## auction id as ?after=) to get the next page (next_cursor is null on the last page).
+## ?fields=item_desc,End_Date_and_time selects the fields returned, highest_bid and bid_count come
+## from the auction_stats summary row (bids do not invalidate the cached list, so they can lag behind
+## the auction's own endpoint by up to RESPONSE_CACHE_TTL seconds).
+## ?stream=json or ?stream=ndjson streams all active auctions (or ?limit=N of them) as they are read.
+##
+## To use it, access:
+##
+## curl -X GET "http://localhost:8080/auctions/?limit=20&after=100"  -H "Content-Type: application/json" -H "access-token: aaa257676644"
+##
+## Status: Complete
+
+AUCTION_FIELDS = {'auction id': 'auction_id', 'item_desc': 'item_desc', 'End_Date_and_time': 'end_date_time',
+                  'highest_bid': 'current_high_bid', 'bid_count': 'COALESCE(bid_count, 0)'}
+
+@api.route('/auctions/', methods=['GET'])
+@token_required
+@cached_response(lambda: ['auctions'])
+def get_all_auctions(current_user):
+    logger.info('GET /auctions')    
+
+    try:
+        fmt = stream_format()
+        after, limit = keyset_args()
+        fields = field_args(AUCTION_FIELDS)
+        if fmt is not None:
+            limit = stream_limit()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
+
+    query = field_statement('auctions_page', AUCTION_FIELDS, fields)
+
+    if fmt is not None:
+        return stream_response(fmt, [('results', query, (after, limit), lambda row: dict(zip(fields, row[1:])))])
+
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
+
+            cur.execute(query, (after, limit + 1))
+            rows = cur.fetchall()
+
+            logger.debug('GET /auctions - parse')
+            response = keyset_page(rows, limit, lambda row: dict(zip(fields, row[1:])))
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /auctions - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return flask.jsonify(response)
+
+
+
+
+##
+## Search Existing
+##
+## Search for auctions that have a matching Item_id, title or description.
+## Numeric keywords match the item_id, anything else is a ranked full-text search
+## over title and description that also matches partial words.
+##
+## Results are paginated with ?limit=N&offset=M, next_offset is null on the last page.
+## ?stream=json or ?stream=ndjson streams all matches (or ?limit=N of them) as they are read.
+## Limited per user to RATE_LIMIT_SEARCH, 429 with Retry-After beyond it.
+##
+## To use it, access:
+##
+## curl -X GET http://localhost:8080/items/<keyword>/?limit=20  -H "Content-Type: application/json" -H "access-token: corban543983361"
+##
+## Status: Complete
+
+def search_statement(keyword, limit, offset):
+    # (statement, values): numeric keywords match the item_id, anything else the text search;
+    # isdecimal() and not isdigit(), which also accepts characters int() rejects (e.g. '²')
+    if keyword.isdecimal():
+        return 'search_item', (int(keyword), limit, offset)
+    return 'search_text', (keyword, f'%{keyword}%', f'%{keyword}%', limit, offset)
+
+
+def search_content(row):
+    content = {'auction id': row[0], 'item_desc': row[1], 'title': row[2]}
+    if row[3] is not None:
+        content['rank'] = row[3]
+    return content
+
+
+@api.route('/items/<keyword>/', methods=['GET'])
+@token_required
+@rate_limited('search')
+@cached_response(lambda keyword: ['auctions'])
+def search_existing(current_user, keyword):
+    logger.info('GET /items')    
+
+    logger.debug('keyword: %s', keyword)
+
+    try:
+        fmt = stream_format()
+        limit, offset = page_args()
+        if fmt is not None:
+            limit = stream_limit()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
+
+    # one row more than requested tells if there is a next page
+    statement, values = search_statement(keyword, limit + 1 if fmt is None else limit, offset)
+
+    if fmt is not None:
+        # a server-side cursor cannot run a prepared statement, it gets the SQL text
+        return stream_response(fmt, [('results', STATEMENTS[statement], values, search_content)])
+
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
+
+            execute_statement(cur, statement, values)
+            rows = cur.fetchall()
+
+            logger.debug('GET /items - parse')
+            response = offset_page(rows, limit, offset, search_content)
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /items/<keyword> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
     return flask.jsonify(response)
 
@@ -417,160 +2870,262 @@ def create_auction(current_user):
 
 
 ##
-## Get All Auctions
+## Retrieve Auction
+##
+## Obtain all auction details in JSON format, with the highest bid, the number of bids and comments,
+## the top ?bids=N bids and the most recent ?comments=N comments, all read in a single query.
+## The highest bid (and bidder), the counts and the last activity come from the auction_stats row,
+## kept up to date by triggers, so they cost the same however many bids the auction has.
+## The remaining bids and comments are listed by the two endpoints below.
+##
+## To use it, access:
+##
+## curl -X GET http://localhost:8080/auctions/<auction_id>/  -H "Content-Type: application/json" -H "access-token: corban543983361"
+##
+## Status: Complete
+
+AUCTION_TOP_BIDS = int(os.environ.get('AUCTION_TOP_BIDS', 10))
+AUCTION_RECENT_COMMENTS = int(os.environ.get('AUCTION_RECENT_COMMENTS', 10))
+
+AUCTION_DETAIL_QUERY = STATEMENTS['auction_detail']
+
+
+def auction_content(row):
+    return {
+        'auction_id': row[0],
+        'item_id': row[1],
+        'title': row[2],
+        'min_price': row[3],
+        'end_date_time': row[4],
+        'item_desc': row[5],
+        'highest_bid': row[6],
+        'bid_count': row[7],
+        'bids': row[8],
+        'comment_count': row[9],
+        'comments': row[10],
+        'high_bidder_id': row[11],
+        'last_activity': row[12],
+        'closed_at': row[13]
+    }
+
+@api.route('/auctions/<auction_id>/', methods=['GET'])
+@token_required
+@cached_response(lambda auction_id: [auction_namespace(auction_id)])
+def retrieve_auction(current_user, auction_id):
+    logger.info('GET auctions/<auction_id>')
+
+    logger.debug('auction_id: %s', auction_id)
+
+    try:
+        top_bids = min(int(flask.request.args.get('bids', AUCTION_TOP_BIDS)), MAX_PAGE_SIZE)
+        recent_comments = min(int(flask.request.args.get('comments', AUCTION_RECENT_COMMENTS)), MAX_PAGE_SIZE)
+        if top_bids < 0 or recent_comments < 0:
+            raise ValueError('bids and comments cannot be negative')
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
+
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
+
+            execute_statement(cur, 'auction_detail', (top_bids, recent_comments, auction_id))
+            auction_info = cur.fetchone()
+
+            if auction_info is None:
+                response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+                return flask.jsonify(response)
+
+            logger.debug('GET auctions/<auction_id> - parse')
+            logger.debug('row %s', auction_info)
+
+            response = {'status': StatusCodes['success'], 'results': auction_content(auction_info)}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /auctions/<auction_id> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return flask.jsonify(response)
+
+
+##
+## List Auction Bids
 ##
-## Obtain all active auctions in JSON format
+## Obtain the bids of an auction, highest first, paginated with ?limit=N&offset=M
 ##
 ## To use it, access:
 ##
-## curl -X GET http://localhost:8080/auctions/  -H "Content-Type: application/json" -H "access-token: aaa257676644"
+## curl -X GET "http://localhost:8080/auctions/<auction_id>/bids/?limit=50&offset=10"  -H "Content-Type: application/json" -H "access-token: corban543983361"
 ##
 ## Status: Complete
 
-@app.route('/auctions/', methods=['GET'])
+def bid_content(row):
+    return {'bid_id': row[0], 'amount': row[1], 'user_id': row[2]}
+
+
+@api.route('/auctions/<int:auction_id>/bids/', methods=['GET'])
 @token_required
-def get_all_auctions(current_user):
-    logger.info('GET /auctions')    
+def list_auction_bids(current_user, auction_id):
+    logger.info('GET /auctions/<auction_id>/bids')
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        limit, offset = page_args()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
 
-        cur.execute('SELECT auction_id, item_desc, end_date_time FROM auctions WHERE end_date_time > current_timestamp')
-        rows = cur.fetchall()
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        logger.debug('GET /users - parse')
-        Results = []
-        for row in rows:
-            logger.debug(row)
-            content = {'auction id': row[0], 'item_desc': row[1], 'End_Date_and_time': row[2]}
-            Results.append(content)  # appending to the payload to be returned
+            execute_statement(cur, 'auction_bids', (auction_id, limit + 1, offset))
+            rows = cur.fetchall()
 
-        response = {'status': StatusCodes['success'], 'results': Results}
+            response = offset_page(rows, limit, offset, bid_content)
 
     except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'GET /auctions - error: {error}')
+        logger.error(f'GET /auctions/<auction_id>/bids - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
-
-
 ##
-## Search Existing
+## List Auction Comments
 ##
-## Search for auctions that have a matching Item_id or description 
+## Obtain the comments of an auction, newest first, paginated with ?limit=N&offset=M
 ##
 ## To use it, access:
 ##
-## curl -X GET http://localhost:8080/items/<keyword>/  -H "Content-Type: application/json" -H "access-token: corban543983361"
+## curl -X GET "http://localhost:8080/auctions/<auction_id>/comments/?limit=50&offset=10"  -H "Content-Type: application/json" -H "access-token: corban543983361"
 ##
 ## Status: Complete
 
-@app.route('/items/<keyword>/', methods=['GET'])
-@token_required
-def search_existing(current_user, keyword):
-    logger.info('GET /items')    
+def comment_content(row):
+    return {'comment_id': row[0], 'comm_content': row[1], 'user_id': row[2]}
 
-    logger.debug('keyword: {keyword}')
 
-    try:
-        conn = db_connection()
-        cur = conn.cursor()
+@api.route('/auctions/<int:auction_id>/comments/', methods=['GET'])
+@token_required
+def list_auction_comments(current_user, auction_id):
+    logger.info('GET /auctions/<auction_id>/comments')
 
-        if keyword.isdigit():
-            query = 'SELECT auction_id, item_desc FROM auctions WHERE item_id = %s'
-            values = (int(keyword),)
-        else:
-            query = 'SELECT auction_id, item_desc FROM auctions WHERE item_desc ILIKE %s'
-            values = (f'%{keyword}%',)
+    try:
+        limit, offset = page_args()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
 
-        cur.execute(query, values)
-        rows = cur.fetchall()
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        logger.debug('GET /items - parse')
-        Results = []
-        for row in rows:
-            logger.debug(row)
-            content = {'auction id': row[0], 'item_desc': row[1]}
-            Results.append(content)  # appending to the payload to be returned
+            execute_statement(cur, 'auction_comments', (auction_id, limit + 1, offset))
+            rows = cur.fetchall()
 
-        response = {'status': StatusCodes['success'], 'results': Results}
+            response = offset_page(rows, limit, offset, comment_content)
 
     except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'GET /items/<keyword> - error: {error}')
+        logger.error(f'GET /auctions/<auction_id>/comments - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
-
-
 ##
-## Retrieve Auction
+## Stream Auction Events
 ##
-## Obtain all auction details in JSON format
+## Server-Sent Events for one auction: a snapshot event (highest bid and bidder, counts, end and
+## closed times) followed by bid, comment and closed events as they are committed, pushed through
+## Postgres LISTEN/NOTIFY instead of polling GET /auctions/<auction_id>/. A new snapshot is sent
+## when events may have been missed (sync), ": keepalive" comments every SSE_KEEPALIVE seconds.
+## The stream ends after a closed event or SSE_MAX_DURATION seconds (EventSource clients reconnect
+## by themselves). Every open stream holds a server thread, at most SSE_MAX_STREAMS per process
+## (the async server, asgi.py, holds no thread per stream).
 ##
 ## To use it, access:
 ##
-## curl -X GET http://localhost:8080/auctions/<auction_id>/  -H "Content-Type: application/json" -H "access-token: corban543983361"
+## curl -N http://localhost:8080/auctions/<auction_id>/stream  -H "access-token: corban543983361"
 ##
 ## Status: Complete
 
-@app.route('/auctions/<auction_id>/', methods=['GET'])
-@token_required
-def retrieve_auction(current_user, auction_id):
-    logger.info('GET auctions/<auction_id>')
+SSE_KEEPALIVE = float(os.environ.get('SSE_KEEPALIVE', 15))          # seconds between keepalive comments
+SSE_MAX_DURATION = float(os.environ.get('SSE_MAX_DURATION', 300))   # seconds before the server ends a stream
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 64))         # open streams per process
 
-    logger.debug('auction_id: {auction_id}')
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
 
-    try:
-        conn = db_connection()
-        cur = conn.cursor()
 
-        cur.execute('SELECT auction_id, item_id, title, min_price, end_date_time, item_desc FROM auctions WHERE auction_id = %s', (auction_id,))
-        auction_info = cur.fetchone()
+def sse_message(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
 
-        cur.execute('SELECT amount FROM bids WHERE auctions_auction_id = %s', (auction_id,))
-        all_bids = cur.fetchall()
 
-        cur.execute('SELECT comm_content FROM comments WHERE auctions_auction_id = %s', (auction_id,))
-        all_comments = cur.fetchall()
+def snapshot_content(row):
+    return {'type': 'snapshot', 'auction_id': row[0], 'end_date_time': row[1], 'closed_at': row[2],
+            'highest_bid': row[3], 'high_bidder_id': row[4], 'bid_count': row[5], 'comment_count': row[6]}
 
-        logger.debug('GET auctions/<auction_id> - parse')
-        logger.debug(auction_info)
 
-        content = {
-            'auction_id': auction_info[0], 
-            'item_id': auction_info[1], 
-            'title': auction_info[2], 
-            'min_price': auction_info[3], 
-            'end_date_time': auction_info[4], 
-            'item_desc': auction_info[5],
-            'bids': all_bids,
-            'comments': all_comments
-        }
+def load_snapshot(auction_id):
+    with db_transaction() as conn:
+        cur = conn.cursor()
+        execute_statement(cur, 'auction_snapshot', (auction_id,))
+        row = cur.fetchone()
+    return snapshot_content(row) if row is not None else None
 
-        response = {'status': StatusCodes['success'], 'results': content}
 
+@api.route('/auctions/<int:auction_id>/stream', methods=['GET'])
+@token_required
+def stream_auction(current_user, auction_id):
+    logger.info('GET /auctions/<auction_id>/stream')
+
+    # subscribed before the snapshot is read, so no event committed after it is missed
+    subscriber = auction_events.subscribe(auction_id, limit=SSE_MAX_STREAMS)
+    if subscriber is None:
+        response = {'status': StatusCodes['unavailable'], 'results': 'too many open streams, retry later'}
+        return flask.jsonify(response), StatusCodes['unavailable']
+    try:
+        snapshot = load_snapshot(auction_id)
     except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'GET /auctions/<auction_id> - error: {error}')
+        auction_events.unsubscribe(auction_id, subscriber)
+        logger.error(f'GET /auctions/<auction_id>/stream - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response)
 
-    finally:
-        if conn is not None:
-            conn.close()
+    if snapshot is None:
+        auction_events.unsubscribe(auction_id, subscriber)
+        response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+        return flask.jsonify(response)
 
-    return flask.jsonify(response)
+    def generate():
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        try:
+            yield 'retry: 3000\n\n'
+            yield sse_message('snapshot', snapshot)
+            if snapshot['closed_at'] is not None:
+                return
+
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = subscriber.get(timeout=min(SSE_KEEPALIVE, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if event['type'] == 'sync':
+                    yield sse_message('snapshot', load_snapshot(auction_id))
+                    continue
+                yield sse_message(event['type'], event)
+                if event['type'] == 'closed':
+                    return
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'GET /auctions/<auction_id>/stream - error: {error}')
+        finally:
+            auction_events.unsubscribe(auction_id, subscriber)
+
+    return flask.Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 
 
@@ -583,58 +3138,48 @@ def retrieve_auction(current_user, auction_id):
 ## Status: Complete
 ###########################################
 
-@app.route('/auctions/<auction_id>/', methods=['PUT'])
+@api.route('/auctions/<auction_id>/', methods=['PUT'])
 @token_required
 def edit_properties(current_user, auction_id):
     logger.info('PUT /auctions/<auction_id>/')
     payload = flask.request.get_json()
 
-    logger.debug(f'PUT /auctions/<auction_id>/ - payload: {payload}')
+    logger.debug('PUT /auctions/<auction_id>/ - payload: %s', payload)
 
     # do not forget to validate every argument, e.g.,:
     if not payload or 'item_desc' not in payload:
         response = {'status': StatusCodes['api_error'], 'results': 'item_description is required to update'}
         return flask.jsonify(response)
 
-    # parameterized queries, good for security and performance
-    statement = 'UPDATE auctions SET item_desc = %s WHERE auction_id = %s'
     values = (payload['item_desc'], auction_id)
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        # Check if the auction exists
-        cur.execute("SELECT users_user_id, end_date_time FROM auctions WHERE auction_id = %s", (auction_id,))
-        auction = cur.fetchone()
+            # Check if the auction exists
+            execute_statement(cur, 'auction_owner', (auction_id,))
+            auction = cur.fetchone()
 
-        if auction is None:
-            response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
-            return flask.jsonify(response)
+            if auction is None:
+                response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+                return flask.jsonify(response)
 
-        #Check if the user is the owner of the auction
-        if not (auction[0] == current_user):
-            response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
-            return flask.jsonify(response)
+            #Check if the user is the owner of the auction
+            if not (auction[0] == current_user):
+                response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
+                return flask.jsonify(response)
         
-        # Update the item description
-        res = cur.execute(statement, values)
-        response = {'status': StatusCodes['success'], 'results': f'Updated: {cur.rowcount}'}
+            # Update the item description
+            execute_statement(cur, 'auction_describe', values)
+            response = {'status': StatusCodes['success'], 'results': f'Updated: {cur.rowcount}'}
 
-        # commit the transaction
-        conn.commit()
+        invalidate_responses('auctions', auction_namespace(auction_id))
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'PUT /auctions/<auction_id> - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-        # an error occurred, rollback
-        conn.rollback()
-
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
@@ -643,61 +3188,153 @@ def edit_properties(current_user, auction_id):
 ##
 ## curl -X GET http://localhost:8080/user/activity/  -H "Content-Type: application/json" -H "access-token: ddd796761222"
 ##
+## Every auction is listed once, with its highest bid and number of bids (from auction_stats).
+## ?stream=json or ?stream=ndjson streams both lists as they are read
+##
 ## Status: Complete
 ############################################
 
-@app.route('/user/activity/', methods=['GET'])
+@api.route('/user/activity/', methods=['GET'])
 @token_required
 def list_user_auctions(current_user):
     logger.info(f'GET /user/activity/')
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        fmt = stream_format()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
 
-        # Fetch auctions the user created
-        cur.execute("SELECT auction_id, item_id, end_date_time, title FROM auctions WHERE users_user_id = %s", (current_user,))
-        auctions_started = cur.fetchall()
-
-        # Prepare response
-        auctions_summary = []
-        for auction in auctions_started:
-            content = {
-                'auction_id': auction[0],
-                'item_id': auction[1],
-                'end_date_time': auction[2],
-                'title': auction[3]
-            }
-            auctions_summary.append(content)
+    def to_content(auction):
+        return {'auction_id': auction[0], 'item_id': auction[1], 'end_date_time': auction[2], 'title': auction[3],
+                'highest_bid': auction[4], 'bid_count': auction[5]}
+
+    if fmt is not None:
+        return stream_response(fmt, [
+            ('auctions_summary', STATEMENTS['user_auctions_created'], (current_user,), to_content),
+            ('bids_summary', STATEMENTS['user_auctions_bids'], (current_user,), to_content)
+        ])
+
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
+
+            # Fetch auctions the user created
+            execute_statement(cur, 'user_auctions_created', (current_user,))
+            auctions_started = cur.fetchall()
+
+            # Prepare response
+            auctions_summary = []
+            for auction in auctions_started:
+                auctions_summary.append(to_content(auction))
 
         
-        # Fetch auctions the user is involved in
-        cur.execute("SELECT auction_id, item_id, end_date_time, title FROM bids, auctions WHERE auctions_auction_id = auction_id AND bids.users_user_id = %s", (current_user,))
-        bids_made = cur.fetchall()
-
-        # Prepare response
-        bids_summary = []
-        for auction in bids_made:
-            content = {
-                'auction_id': auction[0],
-                'item_id': auction[1],
-                'end_date_time': auction[2],
-                'title': auction[3]
-            }
-            bids_summary.append(content)
+            # Fetch auctions the user is involved in
+            execute_statement(cur, 'user_auctions_bids', (current_user,))
+            bids_made = cur.fetchall()
+
+            # Prepare response
+            bids_summary = []
+            for auction in bids_made:
+                bids_summary.append(to_content(auction))
 
         
         
-        response = {'status': StatusCodes['success'], 'auctions_summary': auctions_summary, 'bids_summary' : bids_summary}
+            response = {'status': StatusCodes['success'], 'auctions_summary': auctions_summary, 'bids_summary' : bids_summary}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET user/<username>/auctions - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
+    return flask.jsonify(response)
+
+
+
+##
+## List Notifications
+##
+## Obtain the notifications of the user, newest first, with the number of unread ones.
+## ?unread=1 lists only the unread ones. Results are paginated with ?limit=N, pass the returned
+## next_cursor as ?cursor= to get the next page (next_cursor is null on the last page).
+## Notifications are written by the NotificationWriter, about NOTIFICATION_INTERVAL seconds after the event.
+##
+## To use it, access:
+##
+## curl -X GET "http://localhost:8080/notifications/?unread=1&limit=20"  -H "Content-Type: application/json" -H "access-token: corban543983361"
+##
+## Status: Complete
+
+def notification_content(row):
+    return {'notif_id': row[0], 'notif_content': row[1], 'auction_id': row[2], 'created_at': row[3], 'read_at': row[4]}
+
+
+@api.route('/notifications/', methods=['GET'])
+@token_required
+def list_notifications(current_user):
+    logger.info('GET /notifications')
+
+    try:
+        after, limit = keyset_args()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': str(error)}
+        return flask.jsonify(response)
+
+    # newest first: the cursor is the last id returned and the next page holds the ids below it
+    before = after or 2 ** 31 - 1
+    statement = 'notifications_unread_page' if flask.request.args.get('unread') == '1' else 'notifications_page'
+
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
+
+            execute_statement(cur, statement, (current_user, before, limit + 1))
+            rows = cur.fetchall()
+
+            execute_statement(cur, 'notifications_unread_count', (current_user,))
+            unread = cur.fetchone()[0]
+
+            response = keyset_page(rows, limit, notification_content)
+            response['unread_count'] = unread
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /notifications - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return flask.jsonify(response)
+
+##
+## Mark Notifications as Read
+##
+## Marks the notifications of the user up to notif_id (all of them when it is not given) as read
+##
+## To use it, access:
+##
+## curl -X POST http://localhost:8080/notifications/read  -H "Content-Type: application/json" -H "access-token: corban543983361" -d '{"notif_id": 120}'
+##
+## Status: Complete
+
+@api.route('/notifications/read', methods=['POST'])
+@token_required
+def read_notifications(current_user):
+    logger.info('POST /notifications/read')
+    payload = flask.request.get_json(silent=True) or {}
+
+    try:
+        up_to = int(payload.get('notif_id', 2 ** 31 - 1))
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'results': 'notif_id must be a number'}
+        return flask.jsonify(response)
+
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
+
+            execute_statement(cur, 'notifications_mark_read', (current_user, up_to))
+            response = {'status': StatusCodes['success'], 'results': {'marked_read': cur.rowcount}}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /notifications/read - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
     return flask.jsonify(response)
 
@@ -706,19 +3343,45 @@ def list_user_auctions(current_user):
 ###########################################
 ## Place a bid in an auction
 ##
+## Validation and insert run in the place_bid() database function (migrations/0003_bid_engine.sql),
+## one statement under a lock on the auction row, so concurrent bids cannot both win.
+## The response reason is accepted, not_found, ended, too_low or below_min_price.
+## Limited per user to RATE_LIMIT_BID (shared with /bids/), 429 with Retry-After beyond it.
+##
 ## curl -X POST http://localhost:8080/bid/  -H "Content-Type: application/json" -H "access-token: corban543983361" -d '{"auction_id" : "3", "bid_amount" : "8.00"}'
 ##
 ## Status: Complete
 ###########################################
 
-@app.route('/bid/', methods=['POST'])
+# reason -> (status, message) for the bids place_bid() rejects
+BID_REJECTIONS = {
+    'not_found': ('not_found', 'Auction not found'),
+    'ended': ('api_error', 'Auction has already ended'),
+    'too_low': ('api_error', 'Bid must be higher than the current highest bid'),
+    'below_min_price': ('api_error', 'Bid must be higher than the minimum price')
+}
+
+
+def bid_result(accepted, reason, bid_id, high_bid, amount):
+    if accepted:
+        return {'status': StatusCodes['success'], 'results': 'Bid placed successfully', 'reason': reason, 'bid_id': bid_id, 'amount': amount}
+
+    status, message = BID_REJECTIONS[reason]
+    result = {'status': StatusCodes[status], 'results': message, 'reason': reason}
+    if reason == 'too_low':
+        result['max_bid'] = high_bid
+    return result
+
+
+@api.route('/bid/', methods=['POST'])
 @token_required
+@rate_limited('bid')
 def place_bid(current_user):
     logger.info(f'PUT /bid')
 
     payload = flask.request.get_json()
 
-    logger.debug(f'PUT /bid - payload: {payload}')
+    logger.debug('PUT /bid - payload: %s', payload)
 
     # do not forget to validate every argument, e.g.,:
     if not payload or 'auction_id' not in payload or 'bid_amount' not in payload:
@@ -726,48 +3389,129 @@ def place_bid(current_user):
         return flask.jsonify(response)
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        auction_id = int(payload['auction_id'])
+        amount = float(payload['bid_amount'])
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'results': 'auction_id and bid_amount must be numbers'}
+        return flask.jsonify(response)
 
-        # Check if the auction exists
-        cur.execute("SELECT end_date_time, min_price FROM auctions WHERE auction_id = %s", (payload['auction_id'],))
-        auction = cur.fetchone()
-
-        if auction is None:
-            response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
-            return flask.jsonify(response)
-
-        # Check if the auction has ended
-        if auction[0] < datetime.now():  
-            response = {'status': StatusCodes['api_error'], 'results': 'Auction has already ended'}
-            return flask.jsonify(response)
-
-        # Check if the bid is higher than the current highest bid (if any)
-        cur.execute("SELECT MAX(amount) FROM bids WHERE auctions_auction_id = %s", (payload['auction_id'],))
-        max_bid = cur.fetchone()[0]
-        if max_bid is not None and float(payload['bid_amount']) <= max_bid:
-            response = {'status': StatusCodes['api_error'], 'results': 'Bid must be higher than the current highest bid', 'max_bid' : max_bid}
-            return flask.jsonify(response)
-
-        # Check if the bid is higher than the minimum price
-        if float(payload['bid_amount']) < auction[1]:
-            response = {'status': StatusCodes['api_error'], 'results': 'Bid must be higher than the minimum price'}
-            return flask.jsonify(response)
-
-        # Insert the bid into the database
-        cur.execute("INSERT INTO bids (auctions_auction_id, users_user_id, amount) VALUES (%s, %s, %s)", (payload['auction_id'], current_user, payload['bid_amount']))
-        conn.commit()
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        response = {'status': StatusCodes['success'], 'results': 'Bid placed successfully', 'amount' : payload['bid_amount']}
+            execute_statement(cur, 'place_bid', (auction_id, current_user, amount))
+            accepted, reason, bid_id, high_bid = cur.fetchone()
+
+            if accepted:
+                publish_events(cur, [{'type': 'bid', 'auction_id': auction_id, 'bid_id': bid_id, 'amount': amount, 'user_id': current_user}])
+
+            response = bid_result(accepted, reason, bid_id, high_bid, payload['bid_amount'])
+
+        if accepted:
+            invalidate_responses(auction_namespace(auction_id))
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /dbproj/bid/<int:auction_id>/<float:bid_amount> - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
+    return flask.jsonify(response)
+
+
+###########################################
+## Place bids in several auctions at once
+##
+## Takes a list of bids (for market makers and proxy bidders) and decides them all in the
+## place_bids() database function (migrations/0004_bulk_bids.sql): one statement, one multi-row
+## insert and one commit, with the same rules as placing the bids one by one in the given order.
+## Every bid gets its own result, in the order of the request, with the reason of POST /bid/
+## (or invalid for a bid without a numeric auction_id and bid_amount).
+##
+## curl -X POST http://localhost:8080/bids/  -H "Content-Type: application/json" -H "access-token: corban543983361" -d '{"bids": [{"auction_id": 3, "bid_amount": 8.00}, {"auction_id": 4, "bid_amount": 12.50}]}'
+##
+## Status: Complete
+###########################################
+
+BULK_BID_MAX = int(os.environ.get('BULK_BID_MAX', 1000))   # bids accepted in one request
+
+
+class BulkBids:
+    # The bids of one POST /bids/ request. Those with a numeric auction_id and bid_amount go to
+    # place_bids() in request order (auction_ids, amounts), the others get their result at once;
+    # positions[i] is the request slot of the i-th bid sent, so the rows of place_bids(), numbered
+    # from 1, land in the slot of their bid.
+
+    def __init__(self, count):
+        self.results = [None] * count
+        self.positions = []
+        self.auction_ids = []
+        self.amounts = []
+
+    def decide(self, rows, user_id):
+        # fills the slots from the place_bids() rows, returns the events of the accepted bids
+        events = []
+        for number, auction_id, accepted, reason, bid_id, high_bid in rows:
+            amount = self.amounts[number - 1]
+            result = self.results[self.positions[number - 1]] = bid_result(accepted, reason, bid_id, high_bid, amount)
+            result['auction_id'] = auction_id
+            if accepted:
+                events.append({'type': 'bid', 'auction_id': auction_id, 'bid_id': bid_id, 'amount': amount, 'user_id': user_id})
+        return events
+
+    def response(self):
+        accepted = sum(1 for result in self.results if result['reason'] == 'accepted')
+        return {'status': StatusCodes['success'], 'results': self.results, 'accepted': accepted, 'rejected': len(self.results) - accepted}
+
+
+def parse_bids(bids):
+    parsed = BulkBids(len(bids))
+    for position, bid in enumerate(bids):
+        try:
+            auction_id, amount = int(bid['auction_id']), float(bid['bid_amount'])
+        except (KeyError, TypeError, ValueError):
+            parsed.results[position] = {'status': StatusCodes['api_error'], 'results': 'auction_id and bid_amount must be numbers', 'reason': 'invalid'}
+            continue
+        parsed.positions.append(position)
+        parsed.auction_ids.append(auction_id)
+        parsed.amounts.append(amount)
+    return parsed
+
+
+@api.route('/bids/', methods=['POST'])
+@token_required
+@rate_limited('bid')
+def place_bids(current_user):
+    logger.info('POST /bids')
+
+    payload = flask.request.get_json(silent=True)
+
+    if not payload or not isinstance(payload.get('bids'), list) or not payload['bids']:
+        response = {'status': StatusCodes['api_error'], 'results': 'bids must be a non-empty list'}
+        return flask.jsonify(response)
+
+    if len(payload['bids']) > BULK_BID_MAX:
+        response = {'status': StatusCodes['api_error'], 'results': f'at most {BULK_BID_MAX} bids per request'}
+        return flask.jsonify(response)
+
+    # malformed bids are answered here, the others are decided together in the database
+    bids = parse_bids(payload['bids'])
+
+    try:
+        if bids.auction_ids:
+            with db_transaction() as conn:
+                cur = conn.cursor()
+
+                execute_statement(cur, 'place_bids', (current_user, bids.auction_ids, bids.amounts))
+                events = bids.decide(cur.fetchall(), current_user)
+
+                publish_events(cur, events)
+
+            invalidate_responses(*{auction_namespace(event['auction_id']) for event in events})
+
+        response = bids.response()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /bids - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
     return flask.jsonify(response)
 
@@ -782,44 +3526,41 @@ def place_bid(current_user):
 ## Status: Complete
 ##########################################################
 
-@app.route('/comments/', methods=['POST'])
+@api.route('/comments/', methods=['POST'])
 @token_required
 def auction_board(current_user):
     logger.info('POST /comments')
     payload = flask.request.get_json()
 
-    logger.debug(f'POST /comments - payload: {payload}')
+    logger.debug('POST /comments - payload: %s', payload)
 
     # do not forget to validate every argument, e.g.,:
     if not payload or 'comment_content' not in payload or 'auction_id' not in payload:
         response = {'status': StatusCodes['api_error'], 'results': 'value not in payload'}
         return flask.jsonify(response)
     
-    # parameterized queries, good for security and performance
-    statement = 'INSERT INTO comments (comm_content, auctions_auction_id, users_user_id) VALUES (%s, %s, %s)'
     values = (payload['comment_content'], payload['auction_id'], current_user)
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        cur.execute(statement, values)
+            execute_statement(cur, 'comment_insert', values)
+            comment_id, auction_id = cur.fetchone()
 
-        # commit the transaction
-        conn.commit()
-        response = {'status': StatusCodes['success'], 'results': f'Inserted comments: {payload["comment_content"]}'}
+            publish_events(cur, [{'type': 'comment', 'auction_id': auction_id, 'comment_id': comment_id,
+                                  'comm_content': payload['comment_content'], 'user_id': current_user}])
+            enqueue_notification(cur, 'comment', 'board', auction_id,
+                                 f"New comment on auction {auction_id}: {payload['comment_content']}", exclude_id=current_user)
+
+            response = {'status': StatusCodes['success'], 'results': f'Inserted comments: {payload["comment_content"]}'}
+
+        invalidate_responses(auction_namespace(payload['auction_id']))
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'POST /users - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-        # an error occurred, rollback
-        conn.rollback()
-
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
@@ -828,224 +3569,221 @@ def auction_board(current_user):
 ##########################################################
 ## Close an Auction
 ##
+## Auctions are closed by the AuctionCloser background worker shortly after they end (every
+## AUCTION_CLOSER_INTERVAL seconds), this endpoint gives the seller the recorded result.
+##
 ## curl -X GET http://localhost:8080/auctions/<int:auction_id>/close/  -H "Content-Type: application/json" -H "access-token: corban543983361"
 ##
 ## Status: Complete
 #########################################################
 
-@app.route('/auctions/<int:auction_id>/close/', methods=['GET'])
+@api.route('/auctions/<int:auction_id>/close/', methods=['GET'])
 @token_required
 def close_auction(current_user, auction_id):
     
     logger.info(f'GET /auctions/{auction_id}/close')
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-        # Check if the auction exists
-        cur.execute("SELECT users_user_id, end_date_time FROM auctions WHERE auction_id = %s", (auction_id,))
-        auction = cur.fetchone()
+            # Check if the auction exists
+            execute_statement(cur, 'auction_result', (auction_id,))
+            auction = cur.fetchone()
 
-        if auction is None:
-            response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
-            return flask.jsonify(response)
+            if auction is None:
+                response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+                return flask.jsonify(response)
         
-        #Check if the user is the owner of the auction
-        if not (auction[0] == current_user):
-            response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
-            return flask.jsonify(response)
-
-        # Check if the auction has already ended
-        end_date = auction[1]
-
-        if end_date > datetime.now(): 
-            response = {'status': StatusCodes['bad_request'], 'results': 'Auction has already ended'}
-            return flask.jsonify(response)
-
-        # Check if the current date and time is past the specified end date of the auction
-        if datetime.now() < end_date:
-            response = {'status': StatusCodes['bad_request'], 'results': 'Auction has not yet ended'}
-            return flask.jsonify(response)
-
-        # Determine the winner (assuming the highest bidder)
-        cur.execute("SELECT username, amount FROM bids, users WHERE user_id = users_user_id AND auctions_auction_id = %s ORDER BY bids DESC", (auction_id,))
-        winner_data = cur.fetchone()
-        
-        if winner_data is None:
-            response = {'status': StatusCodes['bad_request'], 'results': 'No bids found for this auction'}
-            return flask.jsonify(response)
-
-        results = {
-            'Winner Username' : winner_data[0],
-            'Winning Bid'     : winner_data[1]
-        }
+            #Check if the user is the owner of the auction
+            if not (auction[0] == current_user):
+                response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
+                return flask.jsonify(response)
+
+            # Check if the closer has closed the auction
+            if auction[1] is None:
+                response = {'status': StatusCodes['api_error'], 'results': 'Auction has not yet closed'}
+                return flask.jsonify(response)
+
+            # Canceled by the seller, closed without a winner
+            if auction[4] is not None:
+                response = {'status': StatusCodes['api_error'], 'results': 'Auction was canceled'}
+                return flask.jsonify(response)
+
+            # The winner recorded when the auction closed (the highest bidder)
+            if auction[2] is None:
+                response = {'status': StatusCodes['api_error'], 'results': 'No bids found for this auction'}
+                return flask.jsonify(response)
+
+            results = {
+                'Winner Username' : auction[2],
+                'Winning Bid'     : auction[3],
+                'Closed At'       : auction[1]
+            }
 
-        response = {'status': StatusCodes['success'], 'results': results}
+            response = {'status': StatusCodes['success'], 'results': results}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(error)
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
-
-    finally:
-        if conn is not None:
-            conn.close()
 
     return flask.jsonify(response)
 
 
 
-
 ##########################################################
-## Close an Auction
+## Cancel Auction
 ##
-## curl -X POST http://localhost:8080/auctions/<int:auction_id>/close/  -H "Content-Type: application/json" -H "access-token: corban543983361"
+## curl -X POST http://localhost:8080/auctions/<int:auction_id>/cancel  -H "Content-Type: application/json" -H "access-token: corban543983361"
 ##
-## Status: Incomplete
-#########################################################
+## Status: Complete
+##########################################################
+
+@api.route('/auctions/<int:auction_id>/cancel', methods=['POST'])
+@token_required
+def cancel_auction(current_user, auction_id):
+    logger.info(f'POST /auctions/{auction_id}/cancel')
 
-# @app.route('/auctions/<int:auction_id>/close', methods=['POST'])
-# @token_required
-# def close_auction(current_user, auction_id):
-#     return # Repetitive (Auction already closes when the end date/time is reached)
-#     logger.info(f'POST /auctions/{auction_id}/close')
+    try:
+        with db_transaction() as conn:
+            cur = conn.cursor()
 
-#     try:
-#         conn = db_connection()
-#         cur = conn.cursor()
+            # Check if the auction exists
+            execute_statement(cur, 'auction_owner', (auction_id,))
+            auction = cur.fetchone()
 
-#         # Check if the auction exists
-#         cur.execute("SELECT users_user_id, end_date_time FROM auctions WHERE auction_id = %s", (auction_id,))
-#         auction = cur.fetchone()
+            if auction is None:
+                response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
+                return flask.jsonify(response)
 
-#         if auction is None:
-#             response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
-#             return flask.jsonify(response)
-        
-#         #Check if the user is the owner of the auction
-#         if not (auction[0] == current_user):
-#             response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
-#             return flask.jsonify(response)
-
-#         # Check if the auction has already ended
-#         end_date = auction[1]
-
-#         if end_date > datetime.now(): 
-#             response = {'status': StatusCodes['bad_request'], 'results': 'Auction has already ended'}
-#             return flask.jsonify(response)
-
-#         # Check if the current date and time is past the specified end date of the auction
-#         if datetime.now() < end_date:
-#             response = {'status': StatusCodes['bad_request'], 'results': 'Auction has not yet ended'}
-#             return flask.jsonify(response)
-
-#         # Determine the winner (assuming the highest bidder)
-#         cur.execute("SELECT users_user_id, MAX(bid_amount) FROM bids WHERE auction_id = %s", (auction_id,))
-#         winner_data = cur.fetchone()
-        
-#         if winner_data is None:
-#             response = {'status': StatusCodes['bad_request'], 'results': 'No bids found for this auction'}
-#             return flask.jsonify(response)
+            #Check if the user is the owner of the auction
+            if not (auction[0] == current_user):
+                response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
+                return flask.jsonify(response)
 
-#         # Update auction details with winner and winning bid amount
-#         cur.execute("UPDATE auctions SET winner_id = %s, winning_bid = %s WHERE auction_id = %s",
-#                     (winner_data[0], winner_data[1], auction_id))
-#         conn.commit()
+            # Check if the auction has already ended (or been closed)
+            if auction[2]:
+                response = {'status': StatusCodes['api_error'], 'results': 'Auction has already ended'}
+                return flask.jsonify(response)
 
-#         response = {'status': StatusCodes['success'], 'results': 'Auction closed successfully'}
+            # Cancel the auction, the closer closes it on its next run
+            execute_statement(cur, 'auction_cancel', (auction_id,))
+            enqueue_notification(cur, 'canceled', 'bidders', auction_id, f'Auction {auction_id} was canceled by the seller')
 
-#     except (Exception, psycopg2.DatabaseError) as error:
-#         logger.error(error)
-#         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-#         conn.rollback()
+            response = {'status': StatusCodes['success'], 'results': 'Auction canceled successfully'}
 
-#     finally:
-#         if conn is not None:
-#             conn.close()
+        invalidate_responses('auctions', auction_namespace(auction_id))
 
-#     return flask.jsonify(response)
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
+    return flask.jsonify(response)
 
 
 
 ##########################################################
-## Cancel Auction
-##
-## curl -X POST http://localhost:8080/auctions/<int:auction_id>/cancel  -H "Content-Type: application/json" -H "access-token: corban543983361"
-##
-## Status: Complete
+## APPLICATION
 ##########################################################
 
-@app.route('/auctions/<int:auction_id>/cancel', methods=['POST'])
-@token_required
-def cancel_auction(current_user, auction_id):
-    logger.info(f'POST /auctions/{auction_id}/cancel')
+def setup_logging():
+    global _log_handler
+    if logger.handlers:
+        return
+
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    context = RequestContextFilter(LOG_SAMPLE_EVERY)
+
+    if LOG_ASYNC:
+        # handlers only queue the record, the file and console writes happen on the writer thread
+        _log_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _log_handler.addFilter(context)
+        logger.addHandler(_log_handler)
+        start_log_writer()
+        atexit.register(stop_log_writer)
+    else:
+        for handler in log_handlers():
+            handler.addFilter(context)
+            logger.addHandler(handler)
+
+
+def run_migrations():
+    if os.environ.get('DB_MIGRATE_ON_START', '1') != '1':
+        return
 
     try:
-        conn = db_connection()
-        cur = conn.cursor()
+        migrate.run(DB_CONFIG)
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'migrations - error: {error}')
 
-        # Check if the auction exists
-        cur.execute("SELECT users_user_id, end_date_time FROM auctions WHERE auction_id = %s", (auction_id,))
-        auction = cur.fetchone()
 
-        if auction is None:
-            response = {'status': StatusCodes['not_found'], 'results': 'Auction not found'}
-            return flask.jsonify(response)
+def create_app():
+    setup_logging()
 
-        #Check if the user is the owner of the auction
-        if not (auction[0] == current_user):
-            response = {'status': StatusCodes['unauthorized'], 'results': 'Not owner of the auction'}
-            return flask.jsonify(response)
+    app = flask.Flask(__name__)
+    app.register_blueprint(api)
+    return app
 
-        # Check if the auction has already ended
-        if auction[1] < datetime.now():  
-            response = {'status': StatusCodes['api_err'], 'results': 'Auction has already ended'}
-            return flask.jsonify(response)
 
-        # Cancel the auction
-        cur.execute("UPDATE auctions SET end_date_time = current_timestamp WHERE auction_id = %s", (auction_id,))
-        conn.commit()
+def start_background_workers():
+    if os.environ.get('BACKGROUND_WORKERS', '1') == '1':
+        token_reaper.start()
+        if token_store.mode == 'signed':
+            revocation_list.start()
+        auction_closer.start()
+        notification_writer.start()
 
-        response = {'status': StatusCodes['success'], 'results': 'Auction canceled successfully'}
 
-    except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(error)
-        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
+def stop_background_workers(timeout=5):
+    token_reaper.stop(timeout)
+    revocation_list.stop(timeout)
+    password_pool.shutdown()
+    auction_closer.stop(timeout)
+    notification_writer.stop(timeout)
+    auction_events.stop(timeout)
 
-    finally:
-        if conn is not None:
-            conn.close()
 
-    return flask.jsonify(response)
+def init_worker():
+    # Called in every server process after fork: connections and threads are never shared with the parent
+    global _pool
+    _pool = None   # a pool inherited from the parent is dropped, not closed, its sockets belong to the parent
+    start_log_writer()
+    db_pool()
+    start_background_workers()
+
+
+def shutdown_worker():
+    stop_background_workers()
+    if _pool is not None:
+        _pool.closeall()
+    stop_log_writer()
 
 
 
 ##########################################################
 ## MAIN
 ##########################################################
-if __name__ == "__main__":
 
-    # Set up the logging
-    logging.basicConfig(filename="logs/log_file.log")
-    logger = logging.getLogger('logger')
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
+## Development server, with the debugger and the reloader.
+## For production use gunicorn with the bundled configuration (see gunicorn.conf.py):
+##
+## gunicorn -c gunicorn.conf.py wsgi:app
+
+if __name__ == "__main__":
 
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s]:  %(message)s', '%H:%M:%S')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    app = create_app()
 
     time.sleep(1) # just to let the DB start before this print :-)
 
+    # the reloader runs this script twice: a process watching the sources, and the server it starts
+    # again on every change (WERKZEUG_RUN_MAIN=true), the only one that needs migrations and workers
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        run_migrations()
+
+        start_background_workers()
+
     logger.info("\n---------------------------------------------------------------\n" + 
                   "API v1.1 online: http://localhost:8080/users/\n\n")
 
     app.run(host="0.0.0.0", debug=True, threaded=True)
-
-
-
@@ -0,0 +1,160 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Query plan check
+##
+## Runs EXPLAIN on the queries issued by the endpoints (the STATEMENTS of demo-proj.py) and fails
+## (exit code 1) when any of them falls back to a sequential scan on one of the large tables.
+## Run it after migrate.py, against a database with enough rows for the planner to prefer indexes.
+##
+## To use it (inside the api container, or with DB_HOST=localhost from the host):
+##
+## python explain_check.py                 check against the current data
+## python explain_check.py --seed 100000   first load 100000 auctions (and related rows) of synthetic data
+##
+## Only use --seed on a development database.
+
+import importlib.util
+import json
+import os
+import sys
+
+import psycopg2
+
+from migrate import DB_CONFIG
+
+# the statements are the ones of the endpoints, loaded from demo-proj.py as asgi.py does
+if 'demo_proj' not in sys.modules:
+    _spec = importlib.util.spec_from_file_location('demo_proj', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo-proj.py'))
+    sys.modules['demo_proj'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['demo_proj'])
+
+from demo_proj import STATEMENTS, AUCTION_DETAIL_QUERY, AUCTION_FIELDS, USER_FIELDS, field_statement, search_statement, token_digest
+
+# Tables that grow with usage, a sequential scan on them is a regression
+LARGE_TABLES = {'auctions', 'auction_stats', 'bids', 'comments', 'tokens', 'notifications'}
+
+# (endpoint, query, parameters, allowed sequential scans)
+QUERIES = [
+    ('token_required', STATEMENTS['token_lookup'], (token_digest('user1_123456789'),), set()),
+    ('token_reaper', STATEMENTS['token_reap'], (1000,), set()),
+    ('get_all_users', field_statement('users_page', USER_FIELDS, list(USER_FIELDS)), (0, 51), set()),
+    ('get_all_auctions', field_statement('auctions_page', AUCTION_FIELDS, list(AUCTION_FIELDS)), (0, 51), set()),
+    ('search_existing (item_id)', STATEMENTS['search_item'], search_statement('42', 51, 0)[1], set()),
+    ('search_existing (text)', STATEMENTS['search_text'], search_statement('vintage', 51, 0)[1], set()),
+    ('retrieve_auction', AUCTION_DETAIL_QUERY, (10, 10, 1), set()),
+    ('list_auction_bids', STATEMENTS['auction_bids'], (1, 51, 0), set()),
+    ('list_auction_comments', STATEMENTS['auction_comments'], (1, 51, 0), set()),
+    ('list_user_auctions (created)', STATEMENTS['user_auctions_created'], (1,), set()),
+    ('list_user_auctions (bids)', STATEMENTS['user_auctions_bids'], (1,), set()),
+    ('edit_properties (owner)', STATEMENTS['auction_owner'], (1,), set()),
+    # the locks taken inside place_bid() and place_bids() (as last defined, migrations/0007_notification_pipeline.sql)
+    ('place_bid (lock)',
+     'SELECT a.end_date_time, a.min_price, a.title, s.current_high_bid, s.high_bidder_id FROM auctions a JOIN auction_stats s ON s.auctions_auction_id = a.auction_id '
+     'WHERE a.auction_id = %s FOR UPDATE',
+     (1,), set()),
+    ('place_bids (lock)',
+     'SELECT 1 FROM auctions a JOIN auction_stats s ON s.auctions_auction_id = a.auction_id '
+     'WHERE a.auction_id = ANY(%s) ORDER BY a.auction_id FOR UPDATE',
+     ([1, 2, 3],), set()),
+    ('close_auction (result)', STATEMENTS['auction_result'], (1,), set()),
+    # the due auctions claimed inside close_due_auctions() (as last defined, migrations/0009_auction_cancellation.sql)
+    ('auction_closer (due)',
+     'SELECT auction_id FROM auctions WHERE closed_at IS NULL AND end_date_time < current_timestamp '
+     'ORDER BY end_date_time LIMIT %s FOR UPDATE SKIP LOCKED',
+     (100,), set()),
+    ('auction_closer (lag)', STATEMENTS['auction_close_lag'], (), set()),
+    ('list_notifications', STATEMENTS['notifications_page'], (1, 2 ** 31 - 1, 51), set()),
+    ('list_notifications (unread)', STATEMENTS['notifications_unread_page'], (1, 2 ** 31 - 1, 51), set()),
+    ('list_notifications (unread count)', STATEMENTS['notifications_unread_count'], (1,), set()),
+    ('read_notifications', STATEMENTS['notifications_mark_read'], (1, 2 ** 31 - 1), set()),
+]
+
+
+def seed(conn, auctions):
+    # users, auctions mostly in the past (as in a long running site), ~20 bids and ~2 comments per auction
+    users = max(auctions // 10, 100)
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO users (username, email, password)
+            SELECT 'seed_user' || i, 'seed_user' || i || '@example.com', 'password'
+            FROM generate_series(1, %s) AS i
+            ON CONFLICT DO NOTHING""", (users,))
+        cur.execute("SELECT min(user_id), max(user_id) FROM users WHERE username LIKE 'seed_user%%'")
+        first, last = cur.fetchone()
+        span = last - first + 1
+
+        cur.execute("""INSERT INTO auctions (item_id, end_date_time, min_price, title, item_desc, users_user_id)
+            SELECT i, current_timestamp + ((CASE WHEN i %% 20 = 0 THEN 1 ELSE -1 END) * (i %% 1000) * interval '1 hour'),
+                   (i %% 500) + 0.99, 'seed auction ' || i, 'seeded item number ' || i || ' in good condition',
+                   %s + (i %% %s)
+            FROM generate_series(1, %s) AS i""", (first, span, auctions))
+        cur.execute("SELECT min(auction_id), max(auction_id) FROM auctions")
+        first_auction, last_auction = cur.fetchone()
+        auction_span = last_auction - first_auction + 1
+
+        cur.execute("""INSERT INTO bids (amount, users_user_id, auctions_auction_id)
+            SELECT 1 + (i %% 997), %s + (i %% %s), %s + (i %% %s)
+            FROM generate_series(1, %s) AS i""", (first, span, first_auction, auction_span, auctions * 20))
+        cur.execute("""INSERT INTO comments (comm_content, users_user_id, auctions_auction_id)
+            SELECT 'seed comment ' || i, %s + (i %% %s), %s + (i %% %s)
+            FROM generate_series(1, %s) AS i""", (first, span, first_auction, auction_span, auctions * 2))
+        cur.execute("""INSERT INTO tokens (token, exp_date, users_user_id)
+            SELECT 'seed_token' || i, current_timestamp + ((i %% 48) - 24) * interval '1 hour', %s + (i %% %s)
+            FROM generate_series(1, %s) AS i
+            ON CONFLICT DO NOTHING""", (first, span, users))
+        # ~10 notifications per user, the older nine in ten read
+        cur.execute("""INSERT INTO notifications (notif_content, users_user_id, auctions_auction_id, read_at)
+            SELECT 'seed notification ' || i, %s + (i %% %s), %s + (i %% %s),
+                   CASE WHEN i %% 10 = 0 THEN NULL ELSE current_timestamp END
+            FROM generate_series(1, %s) AS i""", (first, span, first_auction, auction_span, users * 10))
+    conn.commit()
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('ANALYZE')
+    conn.autocommit = False
+
+
+def seq_scans(plan):
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def check(conn, queries=QUERIES):
+    failures = 0
+    with conn.cursor() as cur:
+        for endpoint, query, values, allowed in queries:
+            cur.execute('EXPLAIN (FORMAT JSON) ' + query, values)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            scans = [t for t in seq_scans(plan[0]['Plan']) if t in LARGE_TABLES and t not in allowed]
+            if scans:
+                failures += 1
+                print(f"FAIL  {endpoint}: sequential scan on {', '.join(scans)}")
+            else:
+                print(f'ok    {endpoint}')
+    conn.rollback()
+    return failures
+
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        if len(sys.argv) == 3 and sys.argv[1] == '--seed':
+            seed(conn, int(sys.argv[2]))
+        elif len(sys.argv) != 1:
+            print(f'usage: python {sys.argv[0]} [--seed AUCTIONS]')
+            sys.exit(2)
+
+        failures = check(conn)
+    finally:
+        conn.close()
+
+    sys.exit(1 if failures else 0)
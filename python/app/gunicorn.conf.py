@@ -0,0 +1,75 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Production server configuration
+##
+## Pre-forked worker processes, each with a pool of threads and its own database connection pool.
+## Every setting can be overridden through the environment.
+##
+## gunicorn -c gunicorn.conf.py wsgi:app
+
+import multiprocessing
+import os
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+
+# one process per core, threads overlap the time spent waiting on the database
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread'
+
+# a thread never needs more than one connection: size each worker's pool by its threads,
+# so that workers * DB_POOL_MAX stays below the server's max_connections
+os.environ.setdefault('DB_POOL_MAX', str(threads))
+os.environ.setdefault('DB_POOL_MIN', str(min(2, threads)))
+
+# the local response cache is invalidated only in the worker that handled the write: with several
+# workers the others would serve stale auctions, so only the shared (redis) cache stays on
+if workers > 1 and os.environ.get('RESPONSE_CACHE_BACKEND', 'local') == 'local':
+    os.environ['RESPONSE_CACHE_BACKEND'] = 'off'
+
+# an open /auctions/<id>/stream holds a thread, at most half of them serve streams
+os.environ.setdefault('SSE_MAX_STREAMS', str(max(1, threads // 2)))
+
+# a login waiting for the password pool holds a thread too, at most a quarter of them wait
+os.environ.setdefault('PASSWORD_QUEUE', str(max(1, threads // 4)))
+
+# recycle workers after a number of requests (jitter avoids restarting them all at once)
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 1000))
+
+# seconds a worker has to finish its requests on shutdown/recycling before being killed
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+
+# GUNICORN_RELOAD=1 restarts the workers when the sources change (development with the app/ folder mounted);
+# otherwise the application is loaded once in the master and shared copy-on-write by the workers
+reload = os.environ.get('GUNICORN_RELOAD', '0') == '1'
+preload_app = not reload
+
+accesslog = os.environ.get('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def on_starting(server):
+    # once, in the master, before any worker exists
+    if os.environ.get('DB_MIGRATE_ON_START', '1') != '1':
+        return
+
+    import migrate
+    try:
+        migrate.run()
+    except Exception as error:
+        server.log.error(f'migrations - error: {error}')
+
+
+def post_fork(server, worker):
+    import wsgi
+    wsgi.demo_proj.init_worker()
+
+
+def worker_exit(server, worker):
+    import wsgi
+    wsgi.demo_proj.shutdown_worker()
@@ -0,0 +1,206 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Schema migrations
+##
+## postgresql/dbproj.sql creates the initial schema, every change after that is a numbered
+## SQL file in migrations/ (e.g. 0001_hot_query_indexes.sql) applied in order by this script.
+## Applied versions are recorded in the schema_migrations table.
+##
+## A migration whose first line is "-- migrate: no-transaction" runs in autocommit mode,
+## one statement at a time (needed for CREATE INDEX CONCURRENTLY). Those files must not
+## contain function bodies, since they are split on ';'. A failure half way leaves the
+## statements before it applied, so they must be idempotent (IF NOT EXISTS) and the file is
+## simply run again; an index whose concurrent build failed is left INVALID, and is dropped
+## before that re-run.
+##
+## An applied migration must never be edited: `up` refuses to run while the checksum of an
+## applied file differs from the recorded one (`status` lists them as MODIFIED).
+##
+## To use it (inside the api container, or with DB_HOST=localhost from the host):
+##
+## python migrate.py            apply pending migrations
+## python migrate.py status     list applied and pending migrations
+
+import hashlib
+import os
+import re
+import sys
+
+import psycopg2
+
+DB_CONFIG = {
+    'user': os.environ.get('DB_USER', 'scott'),
+    'password': os.environ.get('DB_PASSWORD', 'tiger'),
+    'host': os.environ.get('DB_HOST', 'db'),
+    'port': os.environ.get('DB_PORT', '5432'),
+    'database': os.environ.get('DB_NAME', 'dbproj')
+}
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# pg_advisory_lock key, so that two runners never apply migrations at the same time
+LOCK_KEY = 3160
+
+NO_TRANSACTION = '-- migrate: no-transaction'
+
+CONCURRENT_INDEX = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    migrations = []
+    for name in sorted(os.listdir(directory)):
+        match = re.match(r'^(\d+)_(\w+)\.sql$', name)
+        if not match:
+            continue
+        with open(os.path.join(directory, name)) as f:
+            sql = f.read()
+        migrations.append({
+            'version': int(match.group(1)),
+            'name': match.group(2),
+            'sql': sql,
+            'checksum': hashlib.sha256(sql.encode()).hexdigest(),
+            'transactional': not sql.startswith(NO_TRANSACTION)
+        })
+
+    versions = [m['version'] for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f'duplicate migration versions in {directory}')
+    return migrations
+
+
+def split_statements(sql):
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [stmt.strip() for stmt in '\n'.join(lines).split(';') if stmt.strip()]
+
+
+def ensure_tracking_table(conn):
+    with conn.cursor() as cur:
+        cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+            version	 INTEGER,
+            name	 VARCHAR(512) NOT NULL,
+            checksum VARCHAR(64) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+            PRIMARY KEY(version)
+        )""")
+
+
+def applied_migrations(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT version, name, checksum, applied_at FROM schema_migrations ORDER BY version')
+        return {row[0]: row for row in cur.fetchall()}
+
+
+def modified_migrations(applied, migrations):
+    return [m for m in migrations if m['version'] in applied and applied[m['version']][2] != m['checksum']]
+
+
+def drop_invalid_indexes(conn, statements):
+    # a CREATE INDEX CONCURRENTLY that failed leaves the index behind, INVALID (not used by queries,
+    # still maintained on writes), and IF NOT EXISTS would skip it on every re-run
+    names = [match.group(1) for match in map(CONCURRENT_INDEX.match, statements) if match]
+    if not names:
+        return
+
+    with conn.cursor() as cur:
+        cur.execute('SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                    'WHERE c.relname = ANY(%s) AND NOT i.indisvalid AND pg_table_is_visible(c.oid)', (names,))
+        for (name,) in cur.fetchall():
+            print(f'dropping invalid index {name} (failed concurrent build)')
+            cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def apply_migration(conn, migration):
+    record = 'INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)'
+    values = (migration['version'], migration['name'], migration['checksum'])
+
+    if migration['transactional']:
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(migration['sql'])
+                cur.execute(record, values)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        # a failure half way is re-run, after dropping the indexes it left INVALID
+        statements = split_statements(migration['sql'])
+        drop_invalid_indexes(conn, statements)
+        with conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute(record, values)
+
+
+def migrate(conn, migrations):
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_lock(%s)', (LOCK_KEY,))
+    try:
+        ensure_tracking_table(conn)
+        applied = applied_migrations(conn)
+
+        modified = modified_migrations(applied, migrations)
+        if modified:
+            labels = ', '.join(f"{m['version']:04d}_{m['name']}" for m in modified)
+            raise ValueError(f'applied migrations changed since: {labels} (restore the files, put changes in a new migration)')
+
+        count = 0
+        for migration in migrations:
+            if migration['version'] in applied:
+                continue
+            print(f"applying {migration['version']:04d}_{migration['name']}")
+            apply_migration(conn, migration)
+            count += 1
+
+        print(f'{count} migration(s) applied')
+        return count
+    finally:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_unlock(%s)', (LOCK_KEY,))
+
+
+def run(config=DB_CONFIG):
+    # connect, apply pending migrations and disconnect
+    conn = psycopg2.connect(**config)
+    try:
+        return migrate(conn, load_migrations())
+    finally:
+        conn.close()
+
+
+def status(conn, migrations):
+    conn.autocommit = True
+    ensure_tracking_table(conn)
+    applied = applied_migrations(conn)
+
+    for migration in migrations:
+        row = applied.get(migration['version'])
+        label = f"{migration['version']:04d}_{migration['name']}"
+        if row is None:
+            print(f'pending   {label}')
+        elif row[2] != migration['checksum']:
+            print(f'MODIFIED  {label} (applied {row[3]}, file changed since)')
+        else:
+            print(f'applied   {label} ({row[3]})')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'up'
+    if command not in ('up', 'status'):
+        print(f'usage: python {sys.argv[0]} [up|status]')
+        sys.exit(2)
+
+    if command == 'up':
+        run()
+    else:
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            status(conn, load_migrations())
+        finally:
+            conn.close()
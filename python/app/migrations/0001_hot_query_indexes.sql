@@ -0,0 +1,30 @@
+-- migrate: no-transaction
+--
+-- Indexes for the columns the API filters on.
+-- Built CONCURRENTLY so they can be applied to a live database without blocking writes,
+-- which is why this migration does not run inside a transaction.
+
+-- retrieve_auction, place_bid MAX(amount) and close_auction: highest bids of an auction,
+-- with the bidder included so the winner lookup is an index-only scan
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bids_auction_amount_idx
+    ON bids (auctions_auction_id, amount DESC) INCLUDE (users_user_id);
+
+-- list_user_auctions: auctions a user has bid on
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bids_user_auction_idx
+    ON bids (users_user_id, auctions_auction_id);
+
+-- list_user_auctions, and the owner checks: auctions created by a user
+CREATE INDEX CONCURRENTLY IF NOT EXISTS auctions_user_idx
+    ON auctions (users_user_id, end_date_time);
+
+-- get_all_auctions: auctions still running
+CREATE INDEX CONCURRENTLY IF NOT EXISTS auctions_end_date_time_idx
+    ON auctions (end_date_time);
+
+-- search_existing by item_id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS auctions_item_idx
+    ON auctions (item_id) INCLUDE (auction_id, item_desc);
+
+-- retrieve_auction: comments of an auction, newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_auction_idx
+    ON comments (auctions_auction_id, comment_id DESC);
@@ -0,0 +1,30 @@
+-- Full-text and substring search over auction titles and descriptions (GET /items/<keyword>/)
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Weighted document: matches in the title rank above matches in the description
+ALTER TABLE auctions ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+CREATE OR REPLACE FUNCTION auctions_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.item_desc, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS auctions_search_vector_trigger ON auctions;
+CREATE TRIGGER auctions_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, item_desc ON auctions
+    FOR EACH ROW EXECUTE FUNCTION auctions_search_vector_update();
+
+UPDATE auctions SET search_vector =
+    setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(item_desc, '')), 'B');
+
+CREATE INDEX IF NOT EXISTS auctions_search_vector_idx ON auctions USING GIN (search_vector);
+
+-- Trigram indexes keep ILIKE '%keyword%' (partial words) off a sequential scan
+CREATE INDEX IF NOT EXISTS auctions_item_desc_trgm_idx ON auctions USING GIN (item_desc gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS auctions_title_trgm_idx ON auctions USING GIN (title gin_trgm_ops);
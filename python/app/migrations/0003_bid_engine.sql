@@ -0,0 +1,52 @@
+-- Atomic bid placement (POST /bid/)
+--
+-- The highest bid is kept on the auction row, so validating a bid no longer aggregates the bids table,
+-- and place_bid() validates and inserts under a lock on that row: concurrent bidders on the same
+-- auction are serialized and can never both beat the same highest bid.
+
+ALTER TABLE auctions ADD COLUMN IF NOT EXISTS current_high_bid FLOAT(8);
+
+UPDATE auctions SET current_high_bid = b.amount
+FROM (SELECT auctions_auction_id, MAX(amount) AS amount FROM bids GROUP BY auctions_auction_id) b
+WHERE b.auctions_auction_id = auction_id;
+
+-- reason is one of accepted, not_found, ended, too_low, below_min_price
+CREATE OR REPLACE FUNCTION place_bid(p_auction_id INTEGER, p_user_id INTEGER, p_amount FLOAT(8))
+RETURNS TABLE (accepted BOOLEAN, reason VARCHAR, bid_id INTEGER, high_bid FLOAT(8)) AS $$
+DECLARE
+    auction RECORD;
+    new_bid_id INTEGER;
+BEGIN
+    SELECT end_date_time, min_price, current_high_bid INTO auction
+    FROM auctions WHERE auction_id = p_auction_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT false, 'not_found'::VARCHAR, NULL::INTEGER, NULL::FLOAT(8);
+        RETURN;
+    END IF;
+
+    IF auction.end_date_time < current_timestamp THEN
+        RETURN QUERY SELECT false, 'ended'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    IF auction.current_high_bid IS NOT NULL AND p_amount <= auction.current_high_bid THEN
+        RETURN QUERY SELECT false, 'too_low'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    IF p_amount < auction.min_price THEN
+        RETURN QUERY SELECT false, 'below_min_price'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    INSERT INTO bids (auctions_auction_id, users_user_id, amount)
+    VALUES (p_auction_id, p_user_id, p_amount)
+    RETURNING bids.bid_id INTO new_bid_id;
+
+    UPDATE auctions SET current_high_bid = p_amount WHERE auction_id = p_auction_id;
+
+    RETURN QUERY SELECT true, 'accepted'::VARCHAR, new_bid_id, p_amount;
+END
+$$ LANGUAGE plpgsql;
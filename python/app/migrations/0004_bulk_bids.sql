@@ -0,0 +1,59 @@
+-- Bulk bid placement (POST /bids/)
+--
+-- place_bids() takes the bids of one user on any number of auctions, in submission order, and
+-- decides them all in one statement with the same rules (and reasons) as place_bid() applied one
+-- after the other: a bid must beat the auction's highest bid, including the bids accepted before
+-- it in the batch. The auctions are locked in auction_id order, so concurrent batches cannot deadlock.
+--
+-- The highest bid before a bid is the current highest bid or any earlier bid of the batch on the
+-- same auction that reached the minimum price: such a bid was either accepted (it became the
+-- highest) or rejected as too low (it did not beat the highest), so the maximum is the same.
+
+CREATE OR REPLACE FUNCTION place_bids(p_user_id INTEGER, p_auction_ids INTEGER[], p_amounts FLOAT(8)[])
+RETURNS TABLE (ord BIGINT, auction_id INTEGER, accepted BOOLEAN, reason VARCHAR, bid_id INTEGER, high_bid FLOAT(8)) AS $$
+BEGIN
+    PERFORM 1 FROM auctions a WHERE a.auction_id = ANY(p_auction_ids) ORDER BY a.auction_id FOR UPDATE;
+
+    RETURN QUERY
+    WITH batch AS (
+        SELECT b.ord, b.auction_id, b.amount
+        FROM unnest(p_auction_ids, p_amounts) WITH ORDINALITY AS b(auction_id, amount, ord)
+    ),
+    ranked AS (
+        SELECT b.ord, b.auction_id, b.amount, a.auction_id IS NULL AS missing,
+               a.end_date_time < current_timestamp AS ended, a.min_price, a.current_high_bid,
+               GREATEST(a.current_high_bid,
+                        MAX(b.amount) FILTER (WHERE b.amount >= a.min_price)
+                            OVER (PARTITION BY b.auction_id ORDER BY b.ord ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)) AS prior_high
+        FROM batch b LEFT JOIN auctions a ON a.auction_id = b.auction_id
+    ),
+    decided AS (
+        SELECT r.ord, r.auction_id, r.amount, r.prior_high, r.current_high_bid,
+               CASE WHEN r.missing THEN 'not_found'
+                    WHEN r.ended THEN 'ended'
+                    WHEN r.prior_high IS NOT NULL AND r.amount <= r.prior_high THEN 'too_low'
+                    WHEN r.amount < r.min_price THEN 'below_min_price'
+                    ELSE 'accepted' END::VARCHAR AS reason
+        FROM ranked r
+    ),
+    inserted AS (
+        -- accepted amounts strictly grow within an auction, (auction, amount) identifies the bid
+        INSERT INTO bids (auctions_auction_id, users_user_id, amount)
+        SELECT d.auction_id, p_user_id, d.amount FROM decided d WHERE d.reason = 'accepted' ORDER BY d.ord
+        RETURNING bids.bid_id, bids.auctions_auction_id, bids.amount
+    ),
+    raised AS (
+        UPDATE auctions a SET current_high_bid = h.amount
+        FROM (SELECT d.auction_id, MAX(d.amount) AS amount FROM decided d WHERE d.reason = 'accepted' GROUP BY d.auction_id) h
+        WHERE a.auction_id = h.auction_id
+        RETURNING a.auction_id
+    )
+    SELECT d.ord, d.auction_id, d.reason = 'accepted', d.reason, i.bid_id,
+           CASE WHEN d.reason = 'accepted' THEN d.amount
+                WHEN d.reason = 'ended' THEN d.current_high_bid
+                ELSE d.prior_high END
+    FROM decided d
+    LEFT JOIN inserted i ON i.auctions_auction_id = d.auction_id AND i.amount = d.amount AND d.reason = 'accepted'
+    ORDER BY d.ord;
+END
+$$ LANGUAGE plpgsql;
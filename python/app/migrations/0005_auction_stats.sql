@@ -0,0 +1,226 @@
+-- Denormalized auction summary
+--
+-- auction_stats keeps, per auction, the highest bid and its bidder, the number of bids and comments
+-- and the time of the last bid or comment, so reads are a primary key lookup however many bids an
+-- auction has. Statement-level triggers keep it up to date from every write path (place_bid(),
+-- place_bids(), POST /comments/, COPY in the bench seeder): inserts are applied as increments, the
+-- rare update or delete of a bid or comment rebuilds the auctions it touched.
+--
+-- The highest bid moves here from auctions.current_high_bid: place_bid() and place_bids() lock the
+-- auction and its stats row and read the highest bid from it, the bids trigger raises it.
+--
+-- rebuild_auction_stats() recomputes the counters from bids and comments (all auctions, or the given
+-- ones), auction_stats.py in the app directory verifies and rebuilds them from the command line.
+-- last_activity cannot be recomputed (bids and comments have no timestamp), a rebuild keeps it.
+
+CREATE TABLE auction_stats (
+	auctions_auction_id INTEGER,
+	current_high_bid	 FLOAT(8),
+	high_bidder_id	 INTEGER,
+	bid_count		 BIGINT NOT NULL DEFAULT 0,
+	comment_count	 BIGINT NOT NULL DEFAULT 0,
+	last_activity	 TIMESTAMP,
+	PRIMARY KEY(auctions_auction_id)
+);
+
+ALTER TABLE auction_stats ADD CONSTRAINT auction_stats_fk1 FOREIGN KEY (auctions_auction_id) REFERENCES auctions(auction_id) ON DELETE CASCADE;
+ALTER TABLE auction_stats ADD CONSTRAINT auction_stats_fk2 FOREIGN KEY (high_bidder_id) REFERENCES users(user_id);
+
+CREATE OR REPLACE FUNCTION rebuild_auction_stats(p_auction_ids INTEGER[] DEFAULT NULL)
+RETURNS INTEGER AS $$
+DECLARE
+    rebuilt INTEGER;
+BEGIN
+    -- the rows are locked first, so the increments of concurrent bids and comments wait for the rebuild
+    -- and are applied on top of it (the aggregates below are read with a snapshot taken after the locks)
+    PERFORM 1 FROM auction_stats
+    WHERE p_auction_ids IS NULL OR auctions_auction_id = ANY(p_auction_ids)
+    ORDER BY auctions_auction_id FOR UPDATE;
+
+    INSERT INTO auction_stats AS s (auctions_auction_id, current_high_bid, high_bidder_id, bid_count, comment_count)
+    SELECT a.auction_id, top.amount, top.users_user_id, COALESCE(b.bid_count, 0), COALESCE(c.comment_count, 0)
+    FROM auctions a
+    LEFT JOIN (SELECT auctions_auction_id, COUNT(*) AS bid_count FROM bids
+               WHERE p_auction_ids IS NULL OR auctions_auction_id = ANY(p_auction_ids)
+               GROUP BY auctions_auction_id) b ON b.auctions_auction_id = a.auction_id
+    LEFT JOIN (SELECT DISTINCT ON (auctions_auction_id) auctions_auction_id, amount, users_user_id FROM bids
+               WHERE p_auction_ids IS NULL OR auctions_auction_id = ANY(p_auction_ids)
+               ORDER BY auctions_auction_id, amount DESC, bid_id) top ON top.auctions_auction_id = a.auction_id
+    LEFT JOIN (SELECT auctions_auction_id, COUNT(*) AS comment_count FROM comments
+               WHERE p_auction_ids IS NULL OR auctions_auction_id = ANY(p_auction_ids)
+               GROUP BY auctions_auction_id) c ON c.auctions_auction_id = a.auction_id
+    WHERE p_auction_ids IS NULL OR a.auction_id = ANY(p_auction_ids)
+    ORDER BY a.auction_id
+    ON CONFLICT (auctions_auction_id) DO UPDATE SET
+        current_high_bid = EXCLUDED.current_high_bid,
+        high_bidder_id = EXCLUDED.high_bidder_id,
+        bid_count = EXCLUDED.bid_count,
+        comment_count = EXCLUDED.comment_count;
+
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+    RETURN rebuilt;
+END
+$$ LANGUAGE plpgsql;
+
+-- every auction has its stats row from the start, so bids can lock it
+CREATE OR REPLACE FUNCTION auction_stats_auctions_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO auction_stats (auctions_auction_id)
+    SELECT auction_id FROM new_rows ORDER BY auction_id
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- one increment per auction for the whole statement (a multi-row insert, a COPY chunk);
+-- of equal amounts the earliest bid stays the highest
+CREATE OR REPLACE FUNCTION auction_stats_bids_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO auction_stats AS s (auctions_auction_id, current_high_bid, high_bidder_id, bid_count, last_activity)
+    SELECT n.auctions_auction_id, top.amount, top.users_user_id, n.bid_count, current_timestamp
+    FROM (SELECT auctions_auction_id, COUNT(*) AS bid_count FROM new_rows GROUP BY auctions_auction_id) n
+    JOIN (SELECT DISTINCT ON (auctions_auction_id) auctions_auction_id, amount, users_user_id FROM new_rows
+          ORDER BY auctions_auction_id, amount DESC, bid_id) top ON top.auctions_auction_id = n.auctions_auction_id
+    ORDER BY n.auctions_auction_id
+    ON CONFLICT (auctions_auction_id) DO UPDATE SET
+        current_high_bid = CASE WHEN s.current_high_bid IS NULL OR EXCLUDED.current_high_bid > s.current_high_bid
+                                THEN EXCLUDED.current_high_bid ELSE s.current_high_bid END,
+        high_bidder_id = CASE WHEN s.current_high_bid IS NULL OR EXCLUDED.current_high_bid > s.current_high_bid
+                              THEN EXCLUDED.high_bidder_id ELSE s.high_bidder_id END,
+        bid_count = s.bid_count + EXCLUDED.bid_count,
+        last_activity = EXCLUDED.last_activity;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION auction_stats_comments_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO auction_stats AS s (auctions_auction_id, comment_count, last_activity)
+    SELECT auctions_auction_id, COUNT(*), current_timestamp FROM new_rows
+    GROUP BY auctions_auction_id ORDER BY auctions_auction_id
+    ON CONFLICT (auctions_auction_id) DO UPDATE SET
+        comment_count = s.comment_count + EXCLUDED.comment_count,
+        last_activity = EXCLUDED.last_activity;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- updates and deletes of bids or comments (never done by the API) rebuild the auctions involved
+CREATE OR REPLACE FUNCTION auction_stats_rows_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        PERFORM rebuild_auction_stats(ARRAY(SELECT auctions_auction_id FROM old_rows
+                                            UNION SELECT auctions_auction_id FROM new_rows));
+    ELSE
+        PERFORM rebuild_auction_stats(ARRAY(SELECT DISTINCT auctions_auction_id FROM old_rows));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER auction_stats_auctions_insert AFTER INSERT ON auctions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION auction_stats_auctions_inserted();
+
+CREATE TRIGGER auction_stats_bids_insert AFTER INSERT ON bids
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION auction_stats_bids_inserted();
+CREATE TRIGGER auction_stats_bids_update AFTER UPDATE ON bids
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION auction_stats_rows_changed();
+CREATE TRIGGER auction_stats_bids_delete AFTER DELETE ON bids
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION auction_stats_rows_changed();
+
+CREATE TRIGGER auction_stats_comments_insert AFTER INSERT ON comments
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION auction_stats_comments_inserted();
+CREATE TRIGGER auction_stats_comments_update AFTER UPDATE ON comments
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION auction_stats_rows_changed();
+CREATE TRIGGER auction_stats_comments_delete AFTER DELETE ON comments
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION auction_stats_rows_changed();
+
+SELECT rebuild_auction_stats();
+
+-- the highest bid is read from auction_stats (locked with the auction), the bids trigger raises it
+CREATE OR REPLACE FUNCTION place_bid(p_auction_id INTEGER, p_user_id INTEGER, p_amount FLOAT(8))
+RETURNS TABLE (accepted BOOLEAN, reason VARCHAR, bid_id INTEGER, high_bid FLOAT(8)) AS $$
+DECLARE
+    auction RECORD;
+    new_bid_id INTEGER;
+BEGIN
+    SELECT a.end_date_time, a.min_price, s.current_high_bid INTO auction
+    FROM auctions a JOIN auction_stats s ON s.auctions_auction_id = a.auction_id
+    WHERE a.auction_id = p_auction_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT false, 'not_found'::VARCHAR, NULL::INTEGER, NULL::FLOAT(8);
+        RETURN;
+    END IF;
+
+    IF auction.end_date_time < current_timestamp THEN
+        RETURN QUERY SELECT false, 'ended'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    IF auction.current_high_bid IS NOT NULL AND p_amount <= auction.current_high_bid THEN
+        RETURN QUERY SELECT false, 'too_low'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    IF p_amount < auction.min_price THEN
+        RETURN QUERY SELECT false, 'below_min_price'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    INSERT INTO bids (auctions_auction_id, users_user_id, amount)
+    VALUES (p_auction_id, p_user_id, p_amount)
+    RETURNING bids.bid_id INTO new_bid_id;
+
+    RETURN QUERY SELECT true, 'accepted'::VARCHAR, new_bid_id, p_amount;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION place_bids(p_user_id INTEGER, p_auction_ids INTEGER[], p_amounts FLOAT(8)[])
+RETURNS TABLE (ord BIGINT, auction_id INTEGER, accepted BOOLEAN, reason VARCHAR, bid_id INTEGER, high_bid FLOAT(8)) AS $$
+BEGIN
+    PERFORM 1 FROM auctions a JOIN auction_stats s ON s.auctions_auction_id = a.auction_id
+    WHERE a.auction_id = ANY(p_auction_ids) ORDER BY a.auction_id FOR UPDATE;
+
+    RETURN QUERY
+    WITH batch AS (
+        SELECT b.ord, b.auction_id, b.amount
+        FROM unnest(p_auction_ids, p_amounts) WITH ORDINALITY AS b(auction_id, amount, ord)
+    ),
+    ranked AS (
+        SELECT b.ord, b.auction_id, b.amount, a.auction_id IS NULL AS missing,
+               a.end_date_time < current_timestamp AS ended, a.min_price, s.current_high_bid,
+               GREATEST(s.current_high_bid,
+                        MAX(b.amount) FILTER (WHERE b.amount >= a.min_price)
+                            OVER (PARTITION BY b.auction_id ORDER BY b.ord ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)) AS prior_high
+        FROM batch b
+        LEFT JOIN auctions a ON a.auction_id = b.auction_id
+        LEFT JOIN auction_stats s ON s.auctions_auction_id = b.auction_id
+    ),
+    decided AS (
+        SELECT r.ord, r.auction_id, r.amount, r.prior_high, r.current_high_bid,
+               CASE WHEN r.missing THEN 'not_found'
+                    WHEN r.ended THEN 'ended'
+                    WHEN r.prior_high IS NOT NULL AND r.amount <= r.prior_high THEN 'too_low'
+                    WHEN r.amount < r.min_price THEN 'below_min_price'
+                    ELSE 'accepted' END::VARCHAR AS reason
+        FROM ranked r
+    ),
+    inserted AS (
+        -- accepted amounts strictly grow within an auction, (auction, amount) identifies the bid
+        INSERT INTO bids (auctions_auction_id, users_user_id, amount)
+        SELECT d.auction_id, p_user_id, d.amount FROM decided d WHERE d.reason = 'accepted' ORDER BY d.ord
+        RETURNING bids.bid_id, bids.auctions_auction_id, bids.amount
+    )
+    SELECT d.ord, d.auction_id, d.reason = 'accepted', d.reason, i.bid_id,
+           CASE WHEN d.reason = 'accepted' THEN d.amount
+                WHEN d.reason = 'ended' THEN d.current_high_bid
+                ELSE d.prior_high END
+    FROM decided d
+    LEFT JOIN inserted i ON i.auctions_auction_id = d.auction_id AND i.amount = d.amount AND d.reason = 'accepted'
+    ORDER BY d.ord;
+END
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE auctions DROP COLUMN current_high_bid;
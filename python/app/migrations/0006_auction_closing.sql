@@ -0,0 +1,72 @@
+-- Auction closing
+--
+-- An auction is closed once, by the AuctionCloser background worker of demo-proj.py: closed_at,
+-- winner_id and winning_bid record the result, and the winner, the seller and the other bidders get
+-- a notification in the same transaction. Closed auctions are never picked again, so closing is
+-- idempotent across restarts.
+--
+-- close_due_auctions() takes up to p_batch due auctions (ended, not closed) from a partial index on
+-- end_date_time that only holds open auctions, and locks them with SKIP LOCKED: any number of server
+-- processes can run it at the same time, each closes different auctions. An auction locked by a bid
+-- still in flight is skipped and picked up by the next run, after that bid.
+--
+-- Auctions that ended before this migration are marked closed without notifications.
+
+ALTER TABLE auctions ADD COLUMN IF NOT EXISTS closed_at TIMESTAMP;
+ALTER TABLE auctions ADD COLUMN IF NOT EXISTS winner_id INTEGER;
+ALTER TABLE auctions ADD COLUMN IF NOT EXISTS winning_bid FLOAT(8);
+
+ALTER TABLE auctions ADD CONSTRAINT auctions_fk2 FOREIGN KEY (winner_id) REFERENCES users(user_id);
+
+UPDATE auctions a SET closed_at = a.end_date_time, winner_id = s.high_bidder_id, winning_bid = s.current_high_bid
+FROM auction_stats s
+WHERE s.auctions_auction_id = a.auction_id AND a.closed_at IS NULL AND a.end_date_time < current_timestamp;
+
+CREATE INDEX IF NOT EXISTS auctions_due_idx ON auctions (end_date_time) WHERE closed_at IS NULL;
+
+CREATE OR REPLACE FUNCTION close_due_auctions(p_batch INTEGER)
+RETURNS TABLE (auction_id INTEGER, winner_id INTEGER, winning_bid FLOAT(8)) AS $$
+DECLARE
+    due INTEGER[];
+BEGIN
+    SELECT array_agg(d.auction_id) INTO due
+    FROM (SELECT a.auction_id FROM auctions a
+          WHERE a.closed_at IS NULL AND a.end_date_time < current_timestamp
+          ORDER BY a.end_date_time
+          LIMIT p_batch
+          FOR UPDATE SKIP LOCKED) d;
+
+    IF due IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- a new statement, so the highest bids are read after the locks (a bid that held one has committed)
+    RETURN QUERY
+    WITH closed AS (
+        UPDATE auctions a SET closed_at = current_timestamp, winner_id = s.high_bidder_id, winning_bid = s.current_high_bid
+        FROM auction_stats s
+        WHERE a.auction_id = ANY(due) AND s.auctions_auction_id = a.auction_id
+        RETURNING a.auction_id, a.title, a.users_user_id, a.winner_id, a.winning_bid
+    ),
+    notified AS (
+        INSERT INTO notifications (notif_content, users_user_id)
+        SELECT left(n.content, 512), n.user_id FROM (
+            SELECT format('You won auction %s (%s) with a bid of %s', c.auction_id, c.title, c.winning_bid) AS content,
+                   c.winner_id AS user_id
+            FROM closed c WHERE c.winner_id IS NOT NULL
+            UNION ALL
+            SELECT CASE WHEN c.winner_id IS NULL THEN format('Your auction %s (%s) ended without bids', c.auction_id, c.title)
+                        ELSE format('Your auction %s (%s) was won by %s with a bid of %s', c.auction_id, c.title, u.username, c.winning_bid) END,
+                   c.users_user_id
+            FROM closed c LEFT JOIN users u ON u.user_id = c.winner_id
+            UNION ALL
+            SELECT format('Auction %s (%s) ended, the winning bid was %s', c.auction_id, c.title, c.winning_bid), b.users_user_id
+            FROM closed c
+            JOIN (SELECT DISTINCT auctions_auction_id, users_user_id FROM bids WHERE auctions_auction_id = ANY(due)) b
+              ON b.auctions_auction_id = c.auction_id
+            WHERE b.users_user_id <> c.winner_id
+        ) n
+    )
+    SELECT c.auction_id, c.winner_id, c.winning_bid FROM closed c ORDER BY c.auction_id;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,218 @@
+-- Notification pipeline
+--
+-- Write paths never write notifications themselves: they queue one event in notification_queue, in
+-- their own transaction, naming an audience instead of the recipients. The NotificationWriter
+-- background worker of demo-proj.py drains the queue in batches with deliver_notifications(), which
+-- resolves the audiences (an auction's bidders can be thousands of users) and writes every
+-- notification of the batch with one multi-row INSERT ... SELECT, in the transaction that deletes
+-- the events: each event is delivered exactly once, by any number of workers (SKIP LOCKED).
+--
+-- Audiences: user (recipient_id), seller (of the auction), bidders (everyone who bid on it),
+-- board (the seller and everyone who commented on it). exclude_id (the author) is left out.
+--
+-- Events queued here: outbid (place_bid(), place_bids()) and won/sold/ended (close_due_auctions()).
+-- The API queues comment and canceled events (POST /comments/, POST /auctions/<id>/cancel).
+--
+-- Notifications get the auction they are about, a creation time and a read time, an index for
+-- paging a user's notifications newest first and a partial one over the unread ones.
+
+CREATE TABLE notification_queue (
+	event_id		 BIGSERIAL,
+	kind		 VARCHAR(32) NOT NULL,
+	audience		 VARCHAR(16) NOT NULL,
+	auctions_auction_id INTEGER,
+	recipient_id	 INTEGER,
+	exclude_id		 INTEGER,
+	content		 VARCHAR(512) NOT NULL,
+	created_at		 TIMESTAMP NOT NULL DEFAULT current_timestamp,
+	PRIMARY KEY(event_id)
+);
+
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS auctions_auction_id INTEGER;
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT current_timestamp;
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS read_at TIMESTAMP;
+
+ALTER TABLE notifications ADD CONSTRAINT notifications_fk2 FOREIGN KEY (auctions_auction_id) REFERENCES auctions(auction_id);
+
+CREATE INDEX IF NOT EXISTS notifications_user_idx ON notifications (users_user_id, notif_id);
+CREATE INDEX IF NOT EXISTS notifications_unread_idx ON notifications (users_user_id, notif_id) WHERE read_at IS NULL;
+
+CREATE OR REPLACE FUNCTION deliver_notifications(p_batch INTEGER)
+RETURNS TABLE (events BIGINT, delivered BIGINT) AS $$
+BEGIN
+    RETURN QUERY
+    WITH claimed AS (
+        DELETE FROM notification_queue q
+        WHERE q.event_id IN (SELECT n.event_id FROM notification_queue n ORDER BY n.event_id LIMIT p_batch FOR UPDATE SKIP LOCKED)
+        RETURNING q.event_id, q.audience, q.auctions_auction_id, q.recipient_id, q.exclude_id, q.content
+    ),
+    recipients AS (
+        SELECT c.event_id, c.recipient_id AS user_id FROM claimed c WHERE c.audience = 'user'
+        UNION
+        SELECT c.event_id, a.users_user_id FROM claimed c JOIN auctions a ON a.auction_id = c.auctions_auction_id
+        WHERE c.audience IN ('seller', 'board')
+        UNION
+        SELECT c.event_id, b.users_user_id FROM claimed c JOIN bids b ON b.auctions_auction_id = c.auctions_auction_id
+        WHERE c.audience = 'bidders'
+        UNION
+        SELECT c.event_id, m.users_user_id FROM claimed c JOIN comments m ON m.auctions_auction_id = c.auctions_auction_id
+        WHERE c.audience = 'board'
+    ),
+    inserted AS (
+        INSERT INTO notifications (notif_content, users_user_id, auctions_auction_id)
+        SELECT c.content, r.user_id, c.auctions_auction_id
+        FROM recipients r JOIN claimed c ON c.event_id = r.event_id
+        WHERE r.user_id IS NOT NULL AND r.user_id IS DISTINCT FROM c.exclude_id
+        ORDER BY r.event_id, r.user_id
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM claimed), (SELECT COUNT(*) FROM inserted);
+END
+$$ LANGUAGE plpgsql;
+
+-- as in 0005, and the bidder who held the highest bid is told about the new one
+CREATE OR REPLACE FUNCTION place_bid(p_auction_id INTEGER, p_user_id INTEGER, p_amount FLOAT(8))
+RETURNS TABLE (accepted BOOLEAN, reason VARCHAR, bid_id INTEGER, high_bid FLOAT(8)) AS $$
+DECLARE
+    auction RECORD;
+    new_bid_id INTEGER;
+BEGIN
+    SELECT a.end_date_time, a.min_price, a.title, s.current_high_bid, s.high_bidder_id INTO auction
+    FROM auctions a JOIN auction_stats s ON s.auctions_auction_id = a.auction_id
+    WHERE a.auction_id = p_auction_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT false, 'not_found'::VARCHAR, NULL::INTEGER, NULL::FLOAT(8);
+        RETURN;
+    END IF;
+
+    IF auction.end_date_time < current_timestamp THEN
+        RETURN QUERY SELECT false, 'ended'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    IF auction.current_high_bid IS NOT NULL AND p_amount <= auction.current_high_bid THEN
+        RETURN QUERY SELECT false, 'too_low'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    IF p_amount < auction.min_price THEN
+        RETURN QUERY SELECT false, 'below_min_price'::VARCHAR, NULL::INTEGER, auction.current_high_bid;
+        RETURN;
+    END IF;
+
+    INSERT INTO bids (auctions_auction_id, users_user_id, amount)
+    VALUES (p_auction_id, p_user_id, p_amount)
+    RETURNING bids.bid_id INTO new_bid_id;
+
+    IF auction.high_bidder_id IS NOT NULL AND auction.high_bidder_id <> p_user_id THEN
+        INSERT INTO notification_queue (kind, audience, auctions_auction_id, recipient_id, content)
+        VALUES ('outbid', 'user', p_auction_id, auction.high_bidder_id,
+                left(format('You were outbid on auction %s (%s), the highest bid is now %s', p_auction_id, auction.title, p_amount), 512));
+    END IF;
+
+    RETURN QUERY SELECT true, 'accepted'::VARCHAR, new_bid_id, p_amount;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION place_bids(p_user_id INTEGER, p_auction_ids INTEGER[], p_amounts FLOAT(8)[])
+RETURNS TABLE (ord BIGINT, auction_id INTEGER, accepted BOOLEAN, reason VARCHAR, bid_id INTEGER, high_bid FLOAT(8)) AS $$
+BEGIN
+    PERFORM 1 FROM auctions a JOIN auction_stats s ON s.auctions_auction_id = a.auction_id
+    WHERE a.auction_id = ANY(p_auction_ids) ORDER BY a.auction_id FOR UPDATE;
+
+    RETURN QUERY
+    WITH batch AS (
+        SELECT b.ord, b.auction_id, b.amount
+        FROM unnest(p_auction_ids, p_amounts) WITH ORDINALITY AS b(auction_id, amount, ord)
+    ),
+    ranked AS (
+        SELECT b.ord, b.auction_id, b.amount, a.auction_id IS NULL AS missing,
+               a.end_date_time < current_timestamp AS ended, a.min_price, a.title, s.current_high_bid, s.high_bidder_id,
+               GREATEST(s.current_high_bid,
+                        MAX(b.amount) FILTER (WHERE b.amount >= a.min_price)
+                            OVER (PARTITION BY b.auction_id ORDER BY b.ord ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)) AS prior_high
+        FROM batch b
+        LEFT JOIN auctions a ON a.auction_id = b.auction_id
+        LEFT JOIN auction_stats s ON s.auctions_auction_id = b.auction_id
+    ),
+    decided AS (
+        SELECT r.ord, r.auction_id, r.amount, r.prior_high, r.current_high_bid, r.high_bidder_id, r.title,
+               CASE WHEN r.missing THEN 'not_found'
+                    WHEN r.ended THEN 'ended'
+                    WHEN r.prior_high IS NOT NULL AND r.amount <= r.prior_high THEN 'too_low'
+                    WHEN r.amount < r.min_price THEN 'below_min_price'
+                    ELSE 'accepted' END::VARCHAR AS reason
+        FROM ranked r
+    ),
+    inserted AS (
+        -- accepted amounts strictly grow within an auction, (auction, amount) identifies the bid
+        INSERT INTO bids (auctions_auction_id, users_user_id, amount)
+        SELECT d.auction_id, p_user_id, d.amount FROM decided d WHERE d.reason = 'accepted' ORDER BY d.ord
+        RETURNING bids.bid_id, bids.auctions_auction_id, bids.amount
+    ),
+    outbid AS (
+        -- all the bids of a batch are of one user, only the highest bidder before it is outbid
+        INSERT INTO notification_queue (kind, audience, auctions_auction_id, recipient_id, content)
+        SELECT 'outbid', 'user', d.auction_id, d.high_bidder_id,
+               left(format('You were outbid on auction %s (%s), the highest bid is now %s', d.auction_id, d.title, MAX(d.amount)), 512)
+        FROM decided d
+        WHERE d.reason = 'accepted' AND d.high_bidder_id IS NOT NULL AND d.high_bidder_id <> p_user_id
+        GROUP BY d.auction_id, d.high_bidder_id, d.title
+    )
+    SELECT d.ord, d.auction_id, d.reason = 'accepted', d.reason, i.bid_id,
+           CASE WHEN d.reason = 'accepted' THEN d.amount
+                WHEN d.reason = 'ended' THEN d.current_high_bid
+                ELSE d.prior_high END
+    FROM decided d
+    LEFT JOIN inserted i ON i.auctions_auction_id = d.auction_id AND i.amount = d.amount AND d.reason = 'accepted'
+    ORDER BY d.ord;
+END
+$$ LANGUAGE plpgsql;
+
+-- as in 0006, with the notifications queued (three events per auction) instead of written
+CREATE OR REPLACE FUNCTION close_due_auctions(p_batch INTEGER)
+RETURNS TABLE (auction_id INTEGER, winner_id INTEGER, winning_bid FLOAT(8)) AS $$
+DECLARE
+    due INTEGER[];
+BEGIN
+    SELECT array_agg(d.auction_id) INTO due
+    FROM (SELECT a.auction_id FROM auctions a
+          WHERE a.closed_at IS NULL AND a.end_date_time < current_timestamp
+          ORDER BY a.end_date_time
+          LIMIT p_batch
+          FOR UPDATE SKIP LOCKED) d;
+
+    IF due IS NULL THEN
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+    WITH closed AS (
+        UPDATE auctions a SET closed_at = current_timestamp, winner_id = s.high_bidder_id, winning_bid = s.current_high_bid
+        FROM auction_stats s
+        WHERE a.auction_id = ANY(due) AND s.auctions_auction_id = a.auction_id
+        RETURNING a.auction_id, a.title, a.winner_id, a.winning_bid
+    ),
+    queued AS (
+        INSERT INTO notification_queue (kind, audience, auctions_auction_id, recipient_id, exclude_id, content)
+        SELECT e.kind, e.audience, e.auction_id, e.recipient_id, e.exclude_id, left(e.content, 512) FROM (
+            SELECT 'won' AS kind, 'user' AS audience, c.auction_id, c.winner_id AS recipient_id, NULL::INTEGER AS exclude_id,
+                   format('You won auction %s (%s) with a bid of %s', c.auction_id, c.title, c.winning_bid) AS content
+            FROM closed c WHERE c.winner_id IS NOT NULL
+            UNION ALL
+            SELECT 'sold', 'seller', c.auction_id, NULL, NULL,
+                   CASE WHEN c.winner_id IS NULL THEN format('Your auction %s (%s) ended without bids', c.auction_id, c.title)
+                        ELSE format('Your auction %s (%s) was won by %s with a bid of %s', c.auction_id, c.title, u.username, c.winning_bid) END
+            FROM closed c LEFT JOIN users u ON u.user_id = c.winner_id
+            UNION ALL
+            SELECT 'ended', 'bidders', c.auction_id, NULL, c.winner_id,
+                   format('Auction %s (%s) ended, the winning bid was %s', c.auction_id, c.title, c.winning_bid)
+            FROM closed c WHERE c.winner_id IS NOT NULL
+        ) e
+        ORDER BY e.auction_id
+    )
+    SELECT c.auction_id, c.winner_id, c.winning_bid FROM closed c ORDER BY c.auction_id;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,23 @@
+-- Token storage
+--
+-- Opaque tokens (TOKEN_MODE=opaque) are stored as the hex SHA-256 of the token: whoever reads the
+-- tokens table cannot use what they read. Tokens issued before this migration are hashed in place,
+-- so the sessions they belong to survive it.
+--
+-- Signed tokens (TOKEN_MODE=signed) are never stored. Logging out revokes the token id until the
+-- token expires: token_revocations holds those ids, every server process keeps them in memory and
+-- loads the new ones (revocation_id above the last one it saw) every TOKEN_REVOCATION_REFRESH
+-- seconds. The TokenReaper deletes the expired ones.
+
+UPDATE tokens SET token = encode(sha256(convert_to(token, 'UTF8')), 'hex');
+
+CREATE TABLE token_revocations (
+	revocation_id BIGSERIAL,
+	token_id	 VARCHAR(64) NOT NULL,
+	users_user_id INTEGER NOT NULL,
+	expires_at	 BIGINT NOT NULL,
+	PRIMARY KEY(revocation_id)
+);
+
+ALTER TABLE token_revocations ADD UNIQUE (token_id);
+ALTER TABLE token_revocations ADD CONSTRAINT token_revocations_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
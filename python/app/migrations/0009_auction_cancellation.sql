@@ -0,0 +1,60 @@
+-- Auction cancellation
+--
+-- POST /auctions/<id>/cancel sets canceled_at, and end_date_time to the same time so that the
+-- auction stops taking bids and is due for the AuctionCloser like one that ended. The closer closes
+-- a canceled auction without a winner: winner_id and winning_bid stay NULL whatever was bid, and
+-- queues none of the won/sold/ended events, the bidders already got the canceled one.
+--
+-- Auctions canceled before this migration cannot be told apart from those that ended and are left
+-- as they were closed.
+
+ALTER TABLE auctions ADD COLUMN IF NOT EXISTS canceled_at TIMESTAMP;
+
+-- as in 0007, with no winner recorded and no events queued for canceled auctions
+CREATE OR REPLACE FUNCTION close_due_auctions(p_batch INTEGER)
+RETURNS TABLE (auction_id INTEGER, winner_id INTEGER, winning_bid FLOAT(8)) AS $$
+DECLARE
+    due INTEGER[];
+BEGIN
+    SELECT array_agg(d.auction_id) INTO due
+    FROM (SELECT a.auction_id FROM auctions a
+          WHERE a.closed_at IS NULL AND a.end_date_time < current_timestamp
+          ORDER BY a.end_date_time
+          LIMIT p_batch
+          FOR UPDATE SKIP LOCKED) d;
+
+    IF due IS NULL THEN
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+    WITH closed AS (
+        UPDATE auctions a SET closed_at = current_timestamp,
+                              winner_id = CASE WHEN a.canceled_at IS NULL THEN s.high_bidder_id END,
+                              winning_bid = CASE WHEN a.canceled_at IS NULL THEN s.current_high_bid END
+        FROM auction_stats s
+        WHERE a.auction_id = ANY(due) AND s.auctions_auction_id = a.auction_id
+        RETURNING a.auction_id, a.title, a.winner_id, a.winning_bid, a.canceled_at
+    ),
+    queued AS (
+        INSERT INTO notification_queue (kind, audience, auctions_auction_id, recipient_id, exclude_id, content)
+        SELECT e.kind, e.audience, e.auction_id, e.recipient_id, e.exclude_id, left(e.content, 512) FROM (
+            SELECT 'won' AS kind, 'user' AS audience, c.auction_id, c.winner_id AS recipient_id, NULL::INTEGER AS exclude_id,
+                   format('You won auction %s (%s) with a bid of %s', c.auction_id, c.title, c.winning_bid) AS content
+            FROM closed c WHERE c.winner_id IS NOT NULL AND c.canceled_at IS NULL
+            UNION ALL
+            SELECT 'sold', 'seller', c.auction_id, NULL, NULL,
+                   CASE WHEN c.winner_id IS NULL THEN format('Your auction %s (%s) ended without bids', c.auction_id, c.title)
+                        ELSE format('Your auction %s (%s) was won by %s with a bid of %s', c.auction_id, c.title, u.username, c.winning_bid) END
+            FROM closed c LEFT JOIN users u ON u.user_id = c.winner_id
+            WHERE c.canceled_at IS NULL
+            UNION ALL
+            SELECT 'ended', 'bidders', c.auction_id, NULL, c.winner_id,
+                   format('Auction %s (%s) ended, the winning bid was %s', c.auction_id, c.title, c.winning_bid)
+            FROM closed c WHERE c.winner_id IS NOT NULL AND c.canceled_at IS NULL
+        ) e
+        ORDER BY e.auction_id
+    )
+    SELECT c.auction_id, c.winner_id, c.winning_bid FROM closed c ORDER BY c.auction_id;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,22 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## WSGI entry point for production servers
+##
+## demo-proj.py cannot be imported by name (it has a dash), this module loads it and
+## builds the application with its create_app() factory.
+##
+## gunicorn -c gunicorn.conf.py wsgi:app
+
+import importlib.util
+import os
+import sys
+
+_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo-proj.py')
+_spec = importlib.util.spec_from_file_location('demo_proj', _path)
+demo_proj = importlib.util.module_from_spec(_spec)
+sys.modules['demo_proj'] = demo_proj
+_spec.loader.exec_module(demo_proj)
+
+app = demo_proj.create_app()
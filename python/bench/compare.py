@@ -0,0 +1,64 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Compare two loadtest.py results
+##
+## Prints the change of p50/p95/p99 latency and throughput per endpoint and exits with 1
+## when the p95 latency of any endpoint grew by more than --threshold percent.
+##
+## To use it:
+##
+## python compare.py results/baseline.json results/candidate.json --threshold 10
+
+import argparse
+import json
+import sys
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return 100.0 * (after - before) / before
+
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    print(f"{'endpoint':<40} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>9}")
+
+    names = sorted(set(baseline['endpoints']) | set(candidate['endpoints'])) + ['TOTAL']
+    for name in names:
+        before = baseline['total'] if name == 'TOTAL' else baseline['endpoints'].get(name)
+        after = candidate['total'] if name == 'TOTAL' else candidate['endpoints'].get(name)
+        if before is None or after is None:
+            print(f"{name:<40} {'only in ' + ('candidate' if before is None else 'baseline'):>39}")
+            continue
+
+        deltas = [change(before[key], after[key]) for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput')]
+        print(f'{name:<40} ' + ' '.join(f'{d:>+8.1f}%' if d is not None else f"{'-':>9}" for d in deltas))
+
+        if name != 'TOTAL' and deltas[1] is not None and deltas[1] > threshold:
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two load test results')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed p95 increase, in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    if baseline.get('mix') != candidate.get('mix'):
+        print(f"warning: comparing different mixes ({baseline.get('mix')} and {candidate.get('mix')})")
+
+    regressions = compare(baseline, candidate, args.threshold)
+    if regressions:
+        print(f"p95 regression above {args.threshold}% in: {', '.join(regressions)}")
+        sys.exit(1)
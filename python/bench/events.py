@@ -0,0 +1,124 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Bid stream latency
+##
+## Opens --watchers Server-Sent Events streams (GET /auctions/<id>/stream) on the hot auctions of
+## seed.json, places --bids bids on them from one client and reports, per bid, the time from sending
+## POST /bid/ to each watcher receiving the bid event, next to the latency of the POST itself.
+## A client polling GET /auctions/<id>/ every N seconds sees a bid N/2 seconds late on average.
+##
+## To use it (after seed.py, with the API running):
+##
+## python events.py --watchers 4 --bids 200
+
+import argparse
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from loadtest import Client, percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def watch(base_url, token, auction_id, received, ready, stop):
+    # reads the stream line by line, records the arrival time of every bid event by bid_id
+    url = urllib.parse.urlsplit(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    conn.request('GET', f'/auctions/{auction_id}/stream', headers={'access-token': token, 'Accept': 'text/event-stream'})
+    response = conn.getresponse()
+    if response.status != 200:
+        ready.release()
+        raise RuntimeError(f'stream of auction {auction_id}: {response.status} {response.read()[:200]}')
+
+    event = None
+    while not stop.is_set():
+        line = response.fp.readline()
+        if not line:
+            break
+        line = line.decode().rstrip('\n')
+        if line.startswith('event: '):
+            event = line[7:]
+        elif line.startswith('data: '):
+            if event == 'snapshot':
+                ready.release()
+            elif event == 'bid':
+                received.append((json.loads(line[6:])['bid_id'], time.perf_counter()))
+    conn.close()
+
+
+def run(base_url, manifest, watchers, bids):
+    client = Client(base_url)
+    client.login(manifest['usernames'][0], manifest['password'])
+    hot = manifest['hot_auctions']
+
+    highest = 0.0
+    for auction_id in hot:
+        status, data = client.request('GET', f'/auctions/{auction_id}/?bids=1&comments=0')
+        if status == 200:
+            highest = max(highest, json.loads(data).get('results', {}).get('highest_bid') or 0.0)
+
+    received = []
+    ready = threading.Semaphore(0)
+    stop = threading.Event()
+    threads = [threading.Thread(target=watch, args=(base_url, client.token, hot[i % len(hot)], received, ready, stop), daemon=True)
+               for i in range(watchers)]
+    for thread in threads:
+        thread.start()
+    for _ in threads:
+        ready.acquire()
+
+    sent = {}
+    requests = []
+    for i in range(bids):
+        auction_id = hot[i % min(len(hot), watchers)]
+        start = time.perf_counter()
+        status, data = client.request('POST', '/bid/', {'auction_id': auction_id, 'bid_amount': round(highest + 1 + i * 0.01, 2)})
+        requests.append(time.perf_counter() - start)
+        result = json.loads(data)
+        if result.get('bid_id') is not None:
+            sent[result['bid_id']] = start
+        time.sleep(0.01)
+
+    time.sleep(1)
+    stop.set()
+
+    delivery = sorted(arrived - sent[bid_id] for bid_id, arrived in list(received) if bid_id in sent)
+    requests.sort()
+    return {
+        'watchers': watchers,
+        'bids_accepted': len(sent),
+        'events_received': len(delivery),
+        'post_p50_ms': 1000 * percentile(requests, 50),
+        'post_p95_ms': 1000 * percentile(requests, 95),
+        'event_p50_ms': 1000 * percentile(delivery, 50) if delivery else None,
+        'event_p95_ms': 1000 * percentile(delivery, 95) if delivery else None,
+        'event_p99_ms': 1000 * percentile(delivery, 99) if delivery else None
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the delivery latency of the bid stream')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--watchers', type=int, default=4)
+    parser.add_argument('--bids', type=int, default=200)
+    parser.add_argument('--manifest', default=os.path.join(HERE, 'seed.json'))
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    result = run(args.url, manifest, args.watchers, args.bids)
+    for key, value in result.items():
+        print(f'{key:<18} {value:.1f}' if isinstance(value, float) else f'{key:<18} {value}')
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
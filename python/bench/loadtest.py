@@ -0,0 +1,329 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Load generator
+##
+## Drives a workload mix against the running API from concurrent clients (threads with
+## keep-alive connections) and reports latency percentiles and throughput per endpoint.
+## Results are written as JSON so that runs can be compared with compare.py.
+##
+## Mixes:
+##   browse    listing and reading auctions, some searches, a few bids
+##   bidstorm  most clients bidding on the hot auctions of seed.json
+##   search    keyword and item id searches
+##   postman   replays the requests of postman/itcs3160_demo.postman_collection.json
+##
+## To use it (after seed.py, with the API running):
+##
+## python loadtest.py --mix browse --clients 32 --duration 60 --output results/browse.json
+
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+POSTMAN_COLLECTION = os.path.join(HERE, '..', '..', 'postman', 'itcs3160_demo.postman_collection.json')
+
+
+class Client:
+    # One keep-alive HTTP connection, owned by a single worker thread
+
+    def __init__(self, base_url, timeout=30):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+        self.token = None
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers['access-token'] = self.token
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                return response.status, data
+            except (http.client.HTTPException, OSError):
+                # the server may close idle keep-alive connections, retry once on a new one
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+
+    def login(self, username, password):
+        status, data = self.request('POST', '/login/', {'username': username, 'password': password})
+        token = data.decode().strip()
+        if status != 200 or token.startswith('{'):
+            raise RuntimeError(f'login failed for {username}: {status} {token[:200]}')
+        self.token = token
+
+
+class Recorder:
+    # Latencies per endpoint label, shared by all workers
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, label, latency, outcome):
+        with self.lock:
+            entry = self.samples.setdefault(label, {'latencies': [], 'ok': 0, 'rejected': 0, 'limited': 0, 'errors': 0})
+            entry['latencies'].append(latency)
+            entry[outcome] += 1
+
+
+def percentile(values, p):
+    # nearest rank on sorted values
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else None,
+        'p50_ms': 1000 * percentile(latencies, 50) if latencies else None,
+        'p95_ms': 1000 * percentile(latencies, 95) if latencies else None,
+        'p99_ms': 1000 * percentile(latencies, 99) if latencies else None,
+        'max_ms': 1000 * latencies[-1] if latencies else None
+    }
+
+
+class Workload:
+    # Builds the requests of a mix, each operation returns (label, method, path, body)
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.hot = manifest.get('hot_auctions') or [1]
+        self.words = manifest.get('words') or ['vintage']
+        self.auction_ids = []
+        self.bid_counter = itertools.count()
+        self.bid_base = 0.0
+        self.postman = []
+
+    def prepare(self, client):
+        # running auctions to browse, and a starting amount above the hot auctions' highest bids
+        status, data = client.request('GET', '/auctions/?limit=500&fields=auction%20id')
+        if status == 200:
+            self.auction_ids = [row['auction id'] for row in json.loads(data).get('results', [])]
+        if not self.auction_ids:
+            self.auction_ids = list(self.hot)
+
+        highest = 0.0
+        for auction_id in self.hot:
+            status, data = client.request('GET', f'/auctions/{auction_id}/?bids=1&comments=0')
+            if status == 200:
+                highest = max(highest, json.loads(data).get('results', {}).get('highest_bid') or 0.0)
+        self.bid_base = highest + 1
+
+        if os.path.exists(POSTMAN_COLLECTION):
+            with open(POSTMAN_COLLECTION) as f:
+                self.postman = list(postman_requests(json.load(f)['item']))
+
+    def next_amount(self):
+        # strictly increasing across all workers, most bids are accepted even on a hot auction
+        return round(self.bid_base + next(self.bid_counter) * 0.01, 2)
+
+    def browse_list(self, rng):
+        return 'GET /auctions/', 'GET', '/auctions/?limit=50', None
+
+    def browse_detail(self, rng):
+        return 'GET /auctions/<auction_id>/', 'GET', f'/auctions/{rng.choice(self.auction_ids)}/', None
+
+    def activity(self, rng):
+        return 'GET /user/activity/', 'GET', '/user/activity/', None
+
+    def search_word(self, rng):
+        return 'GET /items/<keyword>/', 'GET', f'/items/{rng.choice(self.words)}/?limit=20', None
+
+    def search_item(self, rng):
+        return 'GET /items/<item_id>/', 'GET', f'/items/{rng.randint(1, 1000)}/?limit=20', None
+
+    def bid_any(self, rng):
+        return 'POST /bid/', 'POST', '/bid/', {'auction_id': rng.choice(self.auction_ids), 'bid_amount': self.next_amount()}
+
+    def bid_hot(self, rng):
+        return 'POST /bid/ (hot)', 'POST', '/bid/', {'auction_id': rng.choice(self.hot), 'bid_amount': self.next_amount()}
+
+    def bid_batch(self, rng):
+        # up to 20 bids (15 auctions at random and 5 hot ones) in a single request
+        auctions = rng.sample(self.auction_ids, min(len(self.auction_ids), 15)) + list(self.hot)[:5]
+        bids = [{'auction_id': auction_id, 'bid_amount': self.next_amount()} for auction_id in auctions]
+        return 'POST /bids/', 'POST', '/bids/', {'bids': bids}
+
+    def hot_detail(self, rng):
+        return 'GET /auctions/<auction_id>/ (hot)', 'GET', f'/auctions/{rng.choice(self.hot)}/', None
+
+    def postman_replay(self, rng):
+        name, method, path, body = rng.choice(self.postman)
+        return f'{method} {name}', method, path, body
+
+    def mix(self, name):
+        mixes = {
+            'browse': [(self.browse_list, 30), (self.browse_detail, 40), (self.activity, 10), (self.search_word, 15), (self.bid_any, 5)],
+            'bidstorm': [(self.bid_hot, 80), (self.hot_detail, 20)],
+            'bulkbid': [(self.bid_batch, 80), (self.hot_detail, 20)],
+            'search': [(self.search_word, 70), (self.search_item, 10), (self.browse_detail, 20)],
+            'postman': [(self.postman_replay, 1)]
+        }
+        return mixes[name]
+
+
+def postman_requests(items):
+    # (name, method, path, body) for every request of a postman collection, folders included
+    for item in items:
+        if 'item' in item:
+            yield from postman_requests(item['item'])
+            continue
+        request = item['request']
+        url = request['url'] if isinstance(request['url'], str) else request['url']['raw']
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        raw = request.get('body', {}).get('raw')
+        yield item['name'], request['method'], path, json.loads(raw) if raw else None
+
+
+def worker(base_url, credentials, operations, weights, recorder, deadline, seed):
+    rng = random.Random(seed)
+    client = Client(base_url)
+    if credentials:
+        client.login(*credentials)
+
+    while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        label, method, path, body = operation(rng)
+
+        start = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body)
+            latency = time.perf_counter() - start
+            if status >= 500:
+                outcome = 'errors'
+            elif status == 429:
+                # rate limited (RATE_LIMIT_*), raise the limits for throughput runs
+                outcome = 'limited'
+            elif status >= 400:
+                outcome = 'rejected'
+            else:
+                # the API reports errors in the body with an HTTP 200
+                try:
+                    body_status = json.loads(data).get('status', 200) if data[:1] == b'{' else 200
+                except ValueError:
+                    body_status = 200
+                outcome = 'ok' if body_status == 200 else ('errors' if body_status >= 500 else 'rejected')
+        except (http.client.HTTPException, OSError):
+            latency = time.perf_counter() - start
+            outcome = 'errors'
+
+        recorder.record(label, latency, outcome)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(base_url, mix, clients, duration, manifest, label=None):
+    setup = Client(base_url)
+    credentials = []
+    if mix != 'postman':
+        usernames = manifest['usernames']
+        credentials = [(usernames[i % len(usernames)], manifest['password']) for i in range(clients)]
+        setup.login(*credentials[0])
+
+    workload = Workload(manifest)
+    workload.prepare(setup)
+    operations, weights = zip(*workload.mix(mix))
+
+    recorder = Recorder()
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [threading.Thread(target=worker,
+                                args=(base_url, credentials[i] if credentials else None, operations, weights, recorder, deadline, i))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    endpoints = {}
+    everything = []
+    for name, entry in sorted(recorder.samples.items()):
+        endpoints[name] = summarize(entry['latencies'], elapsed)
+        endpoints[name].update(ok=entry['ok'], rejected=entry['rejected'], limited=entry['limited'], errors=entry['errors'])
+        everything.extend(entry['latencies'])
+
+    return {
+        'label': label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'target': base_url,
+        'mix': mix,
+        'clients': clients,
+        'duration_s': elapsed,
+        'total': summarize(everything, elapsed),
+        'endpoints': endpoints
+    }
+
+
+def print_report(result):
+    print(f"{result['mix']}: {result['clients']} clients, {result['duration_s']:.1f}s")
+    print(f"{'endpoint':<40} {'req':>8} {'req/s':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'limited':>7} {'errors':>7}")
+    rows = list(result['endpoints'].items()) + [('TOTAL', result['total'])]
+    for name, stats in rows:
+        if not stats['requests']:
+            continue
+        print(f"{name:<40} {stats['requests']:>8} {stats['throughput']:>9.1f} {stats['p50_ms']:>8.1f} "
+              f"{stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats.get('limited', ''):>7} {stats.get('errors', ''):>7}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive a workload mix against the API')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--mix', choices=['browse', 'bidstorm', 'bulkbid', 'search', 'postman'], default='browse')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--manifest', default=os.path.join(HERE, 'seed.json'))
+    parser.add_argument('--label', help='free text stored with the results, e.g. the configuration tested')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    manifest = {}
+    if os.path.exists(args.manifest):
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+    elif args.mix != 'postman':
+        parser.error(f'{args.manifest} not found, run seed.py first')
+
+    result = run(args.url, args.mix, args.clients, args.duration, manifest, args.label)
+    print_report(result)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
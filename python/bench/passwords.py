@@ -0,0 +1,136 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Login throughput benchmark
+##
+## In process (default): for every scrypt cost N in --costs, the time of one hash and the password
+## checks per second of a PasswordPool with --workers threads (demo-proj.py), i.e. the login ceiling
+## of one server process at that cost.
+##
+## Against the API (--url): --clients clients log in as the seeded users for --duration seconds and
+## report logins per second, latency and 503 answers (password pool full). The cost is the server's
+## PASSWORD_SCRYPT_N, run it once per setting. Meanwhile watch browse/bid latency with loadtest.py.
+##
+## To use it:
+##
+## python passwords.py --costs 4096,16384,65536 --workers 2
+## python passwords.py --url http://localhost:8080 --clients 16 --duration 30
+
+import argparse
+import json
+import os
+import threading
+import time
+
+from loadtest import Client, percentile
+from prepared import load_api
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_local(api, costs, workers, seconds):
+    results = []
+    for n in costs:
+        # the cost the pool checks against, a stored hash at another cost would be hashed again
+        api.PASSWORD_SCRYPT_N = n
+        stored = api.hash_password('benchmark', n=n)
+        start = time.perf_counter()
+        api.hash_password('benchmark', n=n)
+        hash_ms = (time.perf_counter() - start) * 1000
+
+        # keeps the pool full for `seconds`, as a login surge would
+        pool = api.PasswordPool(workers, workers)
+        checks = 0
+        pending = []
+        deadline = time.monotonic() + seconds
+        start = time.perf_counter()
+        while time.monotonic() < deadline:
+            try:
+                pending.append(pool.submit(api.check_password, 'benchmark', stored))
+            except api.PasswordPoolBusy:
+                pending.pop(0).result()
+                checks += 1
+        for future in pending:
+            future.result()
+            checks += 1
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+
+        results.append({
+            'n': n,
+            'memory_mb': 128 * n * api.PASSWORD_SCRYPT_R / 2 ** 20,
+            'hash_ms': hash_ms,
+            'workers': workers,
+            'checks_per_s': checks / elapsed
+        })
+    return results
+
+
+def run_http(base_url, manifest, clients, duration):
+    lock = threading.Lock()
+    latencies = []
+    outcomes = {'ok': 0, 'busy': 0, 'failed': 0}
+    deadline = time.monotonic() + duration
+
+    def worker(i):
+        client = Client(base_url)
+        username = manifest['usernames'][i % len(manifest['usernames'])]
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            status, data = client.request('POST', '/login/', {'username': username, 'password': manifest['password']})
+            latency = time.perf_counter() - start
+            outcome = 'ok' if status == 200 and not data.startswith(b'{') else 'busy' if status == 503 else 'failed'
+            with lock:
+                latencies.append(latency)
+                outcomes[outcome] += 1
+            if outcome == 'busy':
+                time.sleep(0.05)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'clients': clients,
+        'logins_per_s': outcomes['ok'] / elapsed,
+        'p50_ms': 1000 * percentile(latencies, 50),
+        'p95_ms': 1000 * percentile(latencies, 95),
+        'p99_ms': 1000 * percentile(latencies, 99),
+        **outcomes
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure login throughput at different password hashing costs')
+    parser.add_argument('--costs', default='4096,16384,32768,65536', help='scrypt N values, comma separated')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--seconds', type=float, default=3, help='seconds per cost (in process)')
+    parser.add_argument('--url', help='log in against this API instead of hashing in process')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--manifest', default=os.path.join(HERE, 'seed.json'))
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.url:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+        result = run_http(args.url, manifest, args.clients, args.duration)
+        for key, value in result.items():
+            print(f'{key:<14} {value:.1f}' if isinstance(value, float) else f'{key:<14} {value}')
+    else:
+        result = run_local(load_api(), [int(n) for n in args.costs.split(',')], args.workers, args.seconds)
+        print(f"{'n':>8} {'memory':>9} {'hash':>9} {'checks/s':>9}")
+        for r in result:
+            print(f"{r['n']:>8} {r['memory_mb']:>7.1f}MB {r['hash_ms']:>7.1f}ms {r['checks_per_s']:>9.1f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,126 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Prepared statement benchmark
+##
+## For the read statements of the registry (STATEMENTS in demo-proj.py), measures the planning time
+## reported by EXPLAIN ANALYZE and the mean round trip of the SQL text versus EXECUTE of the
+## prepared statement, on one connection. Uses the data and manifest of seed.py.
+##
+## To use it (from the host, with the database container running, needs flask to load demo-proj.py):
+##
+## DB_HOST=localhost python prepared.py --iterations 500
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import psycopg2
+
+from seed import DB_CONFIG
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_api():
+    # demo-proj.py imports migrate.py from its own directory
+    sys.path.insert(0, os.path.join(HERE, '..', 'app'))
+    spec = importlib.util.spec_from_file_location('demo_proj', os.path.join(HERE, '..', 'app', 'demo-proj.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def samples(cur, manifest):
+    # values for every read statement, taken from the seeded data
+    auction = manifest['hot_auctions'][0]
+    username = manifest['usernames'][0]
+    word = manifest['words'][0]
+    cur.execute('SELECT user_id FROM users WHERE username = %s', (username,))
+    user_id = cur.fetchone()[0]
+    return {
+        'token_lookup': ('no-such-token',),
+        'user_login': (username,),
+        'auction_owner': (auction,),
+        'auction_detail': (10, 10, auction),
+        'auction_bids': (auction, 51, 0),
+        'auction_comments': (auction, 51, 0),
+        'auction_result': (auction,),
+        'search_item': (42, 51, 0),
+        'search_text': (word, f'%{word}%', f'%{word}%', 51, 0),
+        'user_auctions_created': (user_id,),
+        'user_auctions_bids': (user_id,),
+        'notifications_page': (user_id, 2 ** 31 - 1, 51),
+        'notifications_unread_page': (user_id, 2 ** 31 - 1, 51),
+        'notifications_unread_count': (user_id,)
+    }
+
+
+def planning_time(cur, query, values):
+    cur.execute('EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) ' + query, values)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time']
+
+
+def mean_ms(cur, query, values, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        cur.execute(query, values)
+        cur.fetchall()
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def run(conn, api, manifest, iterations):
+    results = []
+    with conn.cursor() as cur:
+        for name, values in samples(cur, manifest).items():
+            query = api.STATEMENTS[name]
+            cur.execute(f'PREPARE {name} AS {api.positional(query)}')
+            execute = f"EXECUTE {name} ({', '.join(['%s'] * len(values))})"
+
+            # warm up both (caches, and the generic plan of the prepared statement after 5 executions)
+            mean_ms(cur, query, values, 10)
+            mean_ms(cur, execute, values, 10)
+
+            results.append({
+                'statement': name,
+                'planning_ms': planning_time(cur, query, values),
+                'text_ms': mean_ms(cur, query, values, iterations),
+                'prepared_ms': mean_ms(cur, execute, values, iterations)
+            })
+            cur.execute(f'DEALLOCATE {name}')
+    conn.rollback()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare SQL text and prepared statements')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--manifest', default=os.path.join(HERE, 'seed.json'))
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        results = run(conn, load_api(), manifest, args.iterations)
+    finally:
+        conn.close()
+
+    print(f"{'statement':<24} {'planning':>9} {'text':>9} {'prepared':>9} {'saved':>7}")
+    for r in results:
+        saved = 100 * (r['text_ms'] - r['prepared_ms']) / r['text_ms'] if r['text_ms'] else 0.0
+        print(f"{r['statement']:<24} {r['planning_ms']:>9.3f} {r['text_ms']:>9.3f} {r['prepared_ms']:>9.3f} {saved:>6.1f}%")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,76 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Rate limiter overhead
+##
+## Measures, in process, what the rate limiter adds to a limited request (RateLimiter.take() of
+## demo-proj.py): on the local sharded store with --threads threads taking tokens for --keys
+## different clients at once, and with --redis on the shared store. Limits are set high enough
+## that no request is refused, the cost measured is the one every request pays.
+##
+## To use it (from the host, needs flask to load demo-proj.py; --redis needs the redis package and a server):
+##
+## python ratelimit.py --threads 8 --keys 1000
+## python ratelimit.py --redis redis://localhost:6379/1
+
+import argparse
+import json
+import os
+import threading
+import time
+
+from prepared import load_api
+
+
+def mean_us(limiter, threads, keys, iterations):
+    # every thread takes `iterations` tokens, cycling over its share of the keys
+    def worker(t):
+        for i in range(iterations):
+            limiter.take(f'bench:user:{(t + i * threads) % keys}', 1e9, 1e9)
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return (time.perf_counter() - start) * 1e6 / (threads * iterations)
+
+
+def run(api, threads, keys, iterations, shards, redis_url=None):
+    results = {}
+    results['local_1_thread_us'] = mean_us(api.RateLimiter(api.LocalRateLimitBackend(shards, keys * 2)), 1, keys, iterations)
+    results[f'local_{threads}_threads_us'] = mean_us(api.RateLimiter(api.LocalRateLimitBackend(shards, keys * 2)), threads, keys, iterations)
+    # one lock for all keys, what the shards save under contention
+    results[f'local_1_shard_{threads}_threads_us'] = mean_us(api.RateLimiter(api.LocalRateLimitBackend(1, keys * 2)), threads, keys, iterations)
+
+    if redis_url:
+        import redis
+        limiter = api.RateLimiter(api.RedisRateLimitBackend(redis.Redis.from_url(redis_url)))
+        results[f'redis_{threads}_threads_us'] = mean_us(limiter, threads, keys, max(iterations // 100, 100))
+        assert limiter.stats()['errors'] == 0, 'redis backend errors'
+
+    results['shards'] = shards
+    results['keys'] = keys
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the overhead of the rate limiter')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--keys', type=int, default=1000, help='distinct clients')
+    parser.add_argument('--iterations', type=int, default=50000, help='tokens taken per thread')
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--redis', help='also measure the shared backend at this URL')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    result = run(load_api(), args.threads, args.keys, args.iterations, args.shards, args.redis)
+    for key, value in result.items():
+        print(f'{key:<28} {value:.2f}' if isinstance(value, float) else f'{key:<28} {value}')
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
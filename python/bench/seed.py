@@ -0,0 +1,163 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Benchmark data seeder
+##
+## Bulk loads users, auctions, bids and comments into the dbproj schema with COPY,
+## including a few "hot" auctions that receive a large share of the bids.
+## Writes seed.json (user names, password, hot auction ids) for loadtest.py.
+##
+## To use it (from the host, with the database container running):
+##
+## DB_HOST=localhost python seed.py --users 10000 --auctions 100000 --bids 2000000
+##
+## Only use it on a development database.
+
+import argparse
+import io
+import json
+import os
+import random
+import time
+
+import psycopg2
+
+DB_CONFIG = {
+    'user': os.environ.get('DB_USER', 'scott'),
+    'password': os.environ.get('DB_PASSWORD', 'tiger'),
+    'host': os.environ.get('DB_HOST', 'db'),
+    'port': os.environ.get('DB_PORT', '5432'),
+    'database': os.environ.get('DB_NAME', 'dbproj')
+}
+
+PASSWORD = 'bench'
+
+WORDS = ['vintage', 'guitar', 'camera', 'lamp', 'chair', 'watch', 'bicycle', 'painting', 'vinyl', 'record',
+         'antique', 'table', 'laptop', 'phone', 'jacket', 'leather', 'wooden', 'silver', 'gold', 'ceramic',
+         'signed', 'rare', 'mint', 'boxed', 'original', 'handmade', 'poster', 'book', 'first', 'edition']
+
+CHUNK = 100000
+
+
+def copy_rows(cur, table, columns, rows):
+    # COPY in chunks, so millions of rows never sit in memory at once
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write('\t'.join(str(v) for v in row) + '\n')
+        count += 1
+        if count % CHUNK == 0:
+            buffer.seek(0)
+            cur.copy_from(buffer, table, columns=columns)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cur.copy_from(buffer, table, columns=columns)
+    return count
+
+
+def text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed(conn, users, auctions, bids, comments, hot, seed_value):
+    rng = random.Random(seed_value)
+    run = int(time.time())
+    prefix = f'bench{run}_'
+
+    with conn.cursor() as cur:
+        start = time.monotonic()
+        copy_rows(cur, 'users', ('username', 'email', 'password'),
+                  ((f'{prefix}{i}', f'{prefix}{i}@example.com', PASSWORD) for i in range(users)))
+        cur.execute('SELECT user_id FROM users WHERE username LIKE %s ORDER BY user_id', (prefix + '%',))
+        user_ids = [row[0] for row in cur.fetchall()]
+        print(f'users      {len(user_ids):>10}  {time.monotonic() - start:.1f}s')
+
+        # 10% of the auctions are still running, ending within the next 30 days
+        start = time.monotonic()
+        cur.execute('SELECT COALESCE(MAX(auction_id), 0) FROM auctions')
+        last_auction = cur.fetchone()[0]
+        def auction_rows():
+            for i in range(auctions):
+                running = i < hot or rng.random() < 0.1
+                hours = rng.randint(1, 720) * (1 if running else -1)
+                end = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + hours * 3600))
+                title = ('HOT ' if i < hot else '') + text(rng, 3)
+                yield (rng.randint(1, auctions // 10 + 1), end, round(rng.uniform(1, 100), 2), title, text(rng, 12), rng.choice(user_ids))
+        copy_rows(cur, 'auctions', ('item_id', 'end_date_time', 'min_price', 'title', 'item_desc', 'users_user_id'), auction_rows())
+        cur.execute('SELECT auction_id FROM auctions WHERE auction_id > %s ORDER BY auction_id', (last_auction,))
+        auction_ids = [row[0] for row in cur.fetchall()]
+        hot_ids = auction_ids[:hot]
+        print(f'auctions   {len(auction_ids):>10}  {time.monotonic() - start:.1f}s')
+
+        # half of the bids go to the hot auctions, amounts grow with every bid of an auction
+        start = time.monotonic()
+        def bid_rows():
+            for i in range(bids):
+                auction = rng.choice(hot_ids) if hot_ids and i % 2 == 0 else rng.choice(auction_ids)
+                yield (100 + i * 0.01, rng.choice(user_ids), auction)
+        copy_rows(cur, 'bids', ('amount', 'users_user_id', 'auctions_auction_id'), bid_rows())
+        print(f'bids       {bids:>10}  {time.monotonic() - start:.1f}s')
+
+        start = time.monotonic()
+        copy_rows(cur, 'comments', ('comm_content', 'users_user_id', 'auctions_auction_id'),
+                  ((text(rng, 8), rng.choice(user_ids), rng.choice(auction_ids)) for _ in range(comments)))
+        print(f'comments   {comments:>10}  {time.monotonic() - start:.1f}s')
+
+        # keep the denormalized columns of the migrations consistent with the loaded bids
+        start = time.monotonic()
+        refresh_derived(cur)
+        print(f'derived               {time.monotonic() - start:.1f}s')
+    conn.commit()
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('ANALYZE')
+    conn.autocommit = False
+
+    return {
+        'usernames': [f'{prefix}{i}' for i in range(users)],
+        'password': PASSWORD,
+        'hot_auctions': hot_ids,
+        'auctions': len(auction_ids),
+        'words': WORDS
+    }
+
+
+def refresh_derived(cur):
+    # auction_stats (migration 0005) is kept up to date by triggers, COPY included; on older
+    # schemas the highest bid is the auctions.current_high_bid column of migration 0003
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'auctions' AND column_name = 'current_high_bid'")
+    if cur.fetchone():
+        cur.execute("""UPDATE auctions SET current_high_bid = b.amount
+            FROM (SELECT auctions_auction_id, MAX(amount) AS amount FROM bids GROUP BY auctions_auction_id) b
+            WHERE b.auctions_auction_id = auction_id""")
+
+    # seeded auctions that already ended are history: closed as the migration does, without notifications
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'auctions' AND column_name = 'closed_at'")
+    if cur.fetchone():
+        cur.execute("""UPDATE auctions a SET closed_at = a.end_date_time, winner_id = s.high_bidder_id, winning_bid = s.current_high_bid
+            FROM auction_stats s
+            WHERE s.auctions_auction_id = a.auction_id AND a.closed_at IS NULL AND a.end_date_time < current_timestamp""")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load benchmark data')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--auctions', type=int, default=100000)
+    parser.add_argument('--bids', type=int, default=1000000)
+    parser.add_argument('--comments', type=int, default=200000)
+    parser.add_argument('--hot', type=int, default=10, help='auctions receiving half of the bids')
+    parser.add_argument('--seed', type=int, default=3160, help='random seed')
+    parser.add_argument('--manifest', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed.json'))
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        manifest = seed(conn, args.users, args.auctions, args.bids, args.comments, args.hot, args.seed)
+    finally:
+        conn.close()
+
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f)
+    print(f'manifest written to {args.manifest}')
@@ -0,0 +1,89 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Token verification benchmark
+##
+## Measures, in process, what token_required pays per request to verify a token (demo-proj.py):
+## a signed token (HMAC check and revocation list lookup, with --revoked ids in the list), a
+## forged one, an opaque token found in the token cache and, with --db, an opaque token looked up
+## in the database (a cache miss, once per token every TOKEN_CACHE_TTL seconds).
+##
+## To use it (from the host, needs flask to load demo-proj.py; --db needs the database container and seed.py):
+##
+## python tokens.py --iterations 100000
+## DB_HOST=localhost python tokens.py --db
+
+import argparse
+import json
+import os
+import time
+
+from prepared import load_api
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def mean_us(f, token, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        f(token)
+    return (time.perf_counter() - start) * 1e6 / iterations
+
+
+def run(api, iterations, revoked, manifest=None):
+    results = {}
+
+    revocations = api.RevocationList(api.TOKEN_REVOCATION_REFRESH)
+    signed = api.SignedTokens('benchmark secret', revocations)
+    expires_at = time.time() + 3600
+    for i in range(revoked):
+        revocations.add(f'revoked-{i}', expires_at)
+
+    token = signed.issue(None, 1)
+    assert signed.verify(token) == 1
+    results['signed_us'] = mean_us(signed.verify, token, iterations)
+    results['signed_forged_us'] = mean_us(signed.verify, token[:-2] + 'AA', iterations)
+
+    opaque = api.OpaqueTokens()
+    token = 'x' * 43
+    api.token_cache.put(token, 1, 3600)
+    results['opaque_cached_us'] = mean_us(opaque.verify, token, iterations)
+    results['opaque_digest_us'] = mean_us(api.token_digest, token, iterations)
+
+    if manifest is not None:
+        with api.db_transaction() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT user_id FROM users WHERE username = %s', (manifest['usernames'][0],))
+            token = opaque.issue(cur, cur.fetchone()[0])
+        # every lookup is a miss, as for a token this process has not seen in TOKEN_CACHE_TTL seconds
+        results['opaque_lookup_us'] = mean_us(api.load_token, token, max(iterations // 100, 100))
+        opaque.revoke(token)
+
+    results['revoked_ids'] = revoked
+    results['iterations'] = iterations
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the cost of verifying a token')
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--revoked', type=int, default=1000, help='revoked token ids in the revocation list')
+    parser.add_argument('--db', action='store_true', help='also measure the database lookup of an opaque token')
+    parser.add_argument('--manifest', default=os.path.join(HERE, 'seed.json'))
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    manifest = None
+    if args.db:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+
+    result = run(load_api(), args.iterations, args.revoked, manifest)
+    for key, value in result.items():
+        print(f'{key:<18} {value:.2f}' if isinstance(value, float) else f'{key:<18} {value}')
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,135 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Unit tests of the API building blocks that need no database
+##
+## To use them (from the host, needs flask and psycopg2 to load demo-proj.py):
+##
+## python -m pytest -q python/tests
+##
+## The few tests of the SQL functions use the postgres fixture and are skipped without a database,
+## to run them against the database container (migrations applied):
+##
+## DB_HOST=localhost python -m pytest -q python/tests
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+# demo-proj.py imports migrate.py from its own directory
+sys.path.insert(0, APP)
+os.environ.setdefault('DB_MIGRATE_ON_START', '0')
+
+
+class Clock:
+    # stands in for time.monotonic, moves only when a test advances it
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class Database:
+    # stands in for db_transaction/execute_statement: records the statements run by name and
+    # answers fetchone()/fetchall() from rows[name]
+
+    def __init__(self):
+        self.executed = []
+        self.rows = {}
+        self.rowcount = 1
+
+    def transaction(self):
+        return Transaction(self)
+
+
+class Transaction:
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return Cursor(self.database)
+
+
+class Cursor:
+    def __init__(self, database):
+        self.database = database
+        self.name = None
+
+    def execute(self, name, values=()):
+        self.name = name
+        self.database.executed.append((name, tuple(values)))
+
+    def fetchone(self):
+        return self.database.rows.get(self.name)
+
+    def fetchall(self):
+        return self.database.rows.get(self.name, [])
+
+    @property
+    def rowcount(self):
+        return self.database.rowcount
+
+
+@pytest.fixture(scope='session')
+def api():
+    # loaded once under the name asgi.py gives it
+    if 'demo_proj' not in sys.modules:
+        spec = importlib.util.spec_from_file_location('demo_proj', os.path.join(APP, 'demo-proj.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['demo_proj'] = module
+        spec.loader.exec_module(module)
+    return sys.modules['demo_proj']
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def database(api, monkeypatch):
+    database = Database()
+    monkeypatch.setattr(api, 'db_transaction', database.transaction)
+    monkeypatch.setattr(api, 'execute_statement', lambda cur, name, values=(): cur.execute(name, values))
+    return database
+
+
+@pytest.fixture
+def client(api, monkeypatch):
+    # the blueprint on a bare app: no logging setup, no background workers, no rate limits
+    import flask
+    monkeypatch.setattr(api, 'rate_limiter', None)
+    app = flask.Flask('tests')
+    app.register_blueprint(api.api)
+    return app.test_client()
+
+
+@pytest.fixture
+def postgres(api):
+    # a connection to the database of DB_CONFIG, everything a test writes is rolled back
+    import psycopg2
+    try:
+        conn = psycopg2.connect(connect_timeout=2, **api.DB_CONFIG)
+    except psycopg2.OperationalError as error:
+        pytest.skip(f'no database: {error}')
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        conn.close()
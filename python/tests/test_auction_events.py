@@ -0,0 +1,53 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## AuctionEvents: the open stream cap, fan out to the subscribers of an auction
+
+import threading
+
+
+def events(api, monkeypatch):
+    auction_events = api.AuctionEvents(1, 4)
+    # no LISTEN connection in the tests
+    monkeypatch.setattr(auction_events, 'start', lambda: None)
+    return auction_events
+
+
+def test_subscribe_stops_at_the_limit(api, monkeypatch):
+    auction_events = events(api, monkeypatch)
+    first = auction_events.subscribe(1, limit=2)
+    assert auction_events.subscribe(2, limit=2) is not None
+    assert auction_events.subscribe(1, limit=2) is None
+
+    auction_events.unsubscribe(1, first)
+    assert auction_events.subscribe(1, limit=2) is not None
+    assert auction_events.stats()['subscribers'] == 2
+
+
+def test_concurrent_subscribers_never_go_over_the_limit(api, monkeypatch):
+    auction_events = events(api, monkeypatch)
+    barrier = threading.Barrier(16)
+    subscribed = []
+
+    def connect():
+        barrier.wait()
+        subscribed.append(auction_events.subscribe(1, limit=5))
+
+    threads = [threading.Thread(target=connect) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len([s for s in subscribed if s is not None]) == 5
+    assert auction_events.stats()['subscribers'] == 5
+
+
+def test_dispatch_to_the_auction_subscribers(api, monkeypatch):
+    auction_events = events(api, monkeypatch)
+    one, other = auction_events.subscribe(1), auction_events.subscribe(2)
+
+    auction_events.dispatch({'type': 'bid'}, 1)
+    assert one.get_nowait() == {'type': 'bid'}
+    assert other.empty()
@@ -0,0 +1,81 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## GET /auctions/<id>/close/ and POST /auctions/<id>/cancel: the seller's view of how an auction ended
+
+import pytest
+
+
+@pytest.fixture
+def seller(api, monkeypatch):
+    # requests with access-token 'token' come from user 7
+    monkeypatch.setattr(api, 'token_store', api.OpaqueTokens())
+    monkeypatch.setattr(api, 'token_cache', api.TokenCache(10, 60))
+    api.token_cache.put('token', 7, 3600)
+    return {'access-token': 'token'}
+
+
+def test_close_gives_the_recorded_result(api, client, database, seller):
+    database.rows['auction_result'] = (7, '2024-05-01 12:00:00', 'bidder', 50.0, None)
+
+    response = client.get('/auctions/3/close/', headers=seller).get_json()
+
+    assert database.executed == [('auction_result', (3,))]
+    assert response['status'] == api.StatusCodes['success']
+    assert response['results']['Winner Username'] == 'bidder'
+
+
+def test_close_before_the_closer_ran(api, client, database, seller):
+    database.rows['auction_result'] = (7, None, None, None, None)
+
+    response = client.get('/auctions/3/close/', headers=seller).get_json()
+    assert response['results'] == 'Auction has not yet closed'
+
+
+def test_close_of_someone_elses_auction(api, client, database, seller):
+    database.rows['auction_result'] = (8, '2024-05-01 12:00:00', 'bidder', 50.0, None)
+
+    response = client.get('/auctions/3/close/', headers=seller).get_json()
+    assert response['status'] == api.StatusCodes['unauthorized']
+
+
+def test_close_of_a_canceled_auction(api, client, database, seller):
+    # closed without a winner, whatever was bid
+    database.rows['auction_result'] = (7, '2024-05-01 12:00:00', None, None, '2024-05-01 11:59:58')
+
+    response = client.get('/auctions/3/close/', headers=seller).get_json()
+    assert response['results'] == 'Auction was canceled'
+
+
+def test_cancel_marks_the_auction(api, client, database, seller, monkeypatch):
+    monkeypatch.setattr(api, 'invalidate_responses', lambda *namespaces: None)
+    database.rows['auction_owner'] = (7, '2024-06-01 12:00:00', False)
+
+    response = client.post('/auctions/3/cancel', headers=seller).get_json()
+
+    assert response['status'] == api.StatusCodes['success']
+    assert [name for name, values in database.executed] == ['auction_owner', 'auction_cancel', 'notification_enqueue']
+
+
+def test_canceled_auction_only_notifies_the_cancellation(api, postgres):
+    cur = postgres.cursor()
+    cur.execute("INSERT INTO users (username, email, password) VALUES ('cancel-seller', 'cancel-seller@test', 'x'), "
+                "('cancel-bidder', 'cancel-bidder@test', 'x') RETURNING user_id")
+    seller_id, bidder_id = [row[0] for row in cur.fetchall()]
+    api.execute_statement(cur, 'auction_insert', (1, 5, 'canceled', 'canceled', '2999-01-01 00:00:00', seller_id))
+    auction_id = cur.fetchone()[0]
+    api.execute_statement(cur, 'place_bid', (auction_id, bidder_id, 10))
+    assert cur.fetchone()[0]
+
+    # what POST /auctions/<id>/cancel runs
+    api.execute_statement(cur, 'auction_cancel', (auction_id,))
+    api.enqueue_notification(cur, 'canceled', 'bidders', auction_id, f'Auction {auction_id} was canceled by the seller')
+    # the closer's next run, in a later transaction, sees it as due
+    cur.execute("UPDATE auctions SET end_date_time = end_date_time - interval '1 second' WHERE auction_id = %s", (auction_id,))
+
+    api.execute_statement(cur, 'auction_close_due', (10000,))
+    assert (auction_id, None, None) in cur.fetchall()
+
+    cur.execute('SELECT kind FROM notification_queue WHERE auctions_auction_id = %s', (auction_id,))
+    assert [row[0] for row in cur.fetchall()] == ['canceled']
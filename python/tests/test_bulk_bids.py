@@ -0,0 +1,86 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## POST /bids/: malformed bids answered in place, place_bids() rows mapped back to their request slot
+
+
+def row(number, auction_id, reason, bid_id=None, high_bid=None):
+    # a row of place_bids(): (number, auction_id, accepted, reason, bid_id, high_bid)
+    return number, auction_id, reason == 'accepted', reason, bid_id, high_bid
+
+
+def test_only_valid_bids_are_sent(api):
+    bids = api.parse_bids([
+        {'auction_id': 'x', 'bid_amount': 5},
+        {'auction_id': 3, 'bid_amount': '8.5'},
+        {'auction_id': 4},
+        None,
+        {'auction_id': '5', 'bid_amount': 12},
+        {'auction_id': 6, 'bid_amount': 'a lot'},
+    ])
+
+    assert bids.auction_ids == [3, 5]
+    assert bids.amounts == [8.5, 12.0]
+    assert bids.positions == [1, 4]
+    assert [result and result['reason'] for result in bids.results] == ['invalid', None, 'invalid', 'invalid', None, 'invalid']
+
+
+def test_rows_land_in_the_slot_of_their_bid(api):
+    # an invalid auction_id right after a valid one must not shift the bids that follow
+    bids = api.parse_bids([
+        {'auction_id': 3, 'bid_amount': 8},
+        {'auction_id': 'x', 'bid_amount': 9},
+        {'auction_id': 4, 'bid_amount': 'y'},
+        {'auction_id': 5, 'bid_amount': 10},
+        {'auction_id': 6, 'bid_amount': 11},
+    ])
+    assert bids.auction_ids == [3, 5, 6]
+
+    events = bids.decide([row(1, 3, 'accepted', 101), row(2, 5, 'too_low', high_bid=15.0), row(3, 6, 'accepted', 102)], 7)
+
+    results = bids.results
+    assert [result['reason'] for result in results] == ['accepted', 'invalid', 'invalid', 'too_low', 'accepted']
+    assert (results[0]['auction_id'], results[0]['bid_id'], results[0]['amount']) == (3, 101, 8.0)
+    assert (results[3]['auction_id'], results[3]['max_bid']) == (5, 15.0)
+    assert (results[4]['auction_id'], results[4]['bid_id'], results[4]['amount']) == (6, 102, 11.0)
+    assert events == [
+        {'type': 'bid', 'auction_id': 3, 'bid_id': 101, 'amount': 8.0, 'user_id': 7},
+        {'type': 'bid', 'auction_id': 6, 'bid_id': 102, 'amount': 11.0, 'user_id': 7},
+    ]
+
+    response = bids.response()
+    assert (response['accepted'], response['rejected']) == (2, 3)
+    assert response['results'] is results
+
+
+def test_rows_in_any_order(api):
+    bids = api.parse_bids([{'auction_id': 3, 'bid_amount': 8}, None, {'auction_id': 4, 'bid_amount': 9}])
+    bids.decide([row(2, 4, 'ended'), row(1, 3, 'accepted', 101)], 7)
+
+    assert [result['reason'] for result in bids.results] == ['accepted', 'invalid', 'ended']
+    assert bids.results[2]['auction_id'] == 4
+
+
+def test_all_invalid(api):
+    bids = api.parse_bids([{}, {'bid_amount': 3}])
+
+    assert bids.auction_ids == []
+    response = bids.response()
+    assert (response['accepted'], response['rejected']) == (0, 2)
+
+
+def test_endpoint_sends_the_valid_bids(api, client, database, monkeypatch):
+    monkeypatch.setattr(api, 'token_store', api.OpaqueTokens())
+    monkeypatch.setattr(api, 'token_cache', api.TokenCache(10, 60))
+    api.token_cache.put('token', 7, 3600)
+
+    database.rows['place_bids'] = [row(1, 5, 'accepted', 101)]
+    monkeypatch.setattr(api, 'publish_events', lambda cur, events: database.executed.append(('events', tuple(events))))
+    monkeypatch.setattr(api, 'invalidate_responses', lambda *namespaces: None)
+
+    response = client.post('/bids/', json={'bids': [{'auction_id': 'x'}, {'auction_id': 5, 'bid_amount': 10}]}, headers={'access-token': 'token'})
+
+    assert response.status_code == 200
+    assert database.executed[0] == ('place_bids', (7, [5], [10.0]))
+    assert [result['reason'] for result in response.get_json()['results']] == ['invalid', 'accepted']
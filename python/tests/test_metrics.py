@@ -0,0 +1,66 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Request metrics: recorded per route template, rendered in the Prometheus text format
+
+
+def test_request_is_recorded_by_route_template(api, client):
+    client.get('/')
+    body = client.get('/metrics').get_data(as_text=True)
+
+    assert 'http_requests_total{method="GET",route="/",status="200"}' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="/"}' in body
+
+
+def test_observe_request(api, monkeypatch):
+    registry = api.MetricsRegistry()
+    registry.histogram('http_request_duration_seconds', '', ('method', 'route'), api.LATENCY_BUCKETS)
+    registry.histogram('http_request_db_seconds', '', ('method', 'route'), api.LATENCY_BUCKETS)
+    registry.histogram('http_request_python_seconds', '', ('method', 'route'), api.LATENCY_BUCKETS)
+    registry.histogram('http_request_queries', '', ('method', 'route'), api.QUERY_BUCKETS)
+    registry.histogram('http_response_size_bytes', '', ('method', 'route'), api.SIZE_BUCKETS)
+    registry.counter('http_requests_total', '', ('method', 'route', 'status'))
+    registry.counter('db_connections_opened_total', '', ('route',))
+
+    current = api.new_request_metrics('api.retrieve_auction')
+    current['queries'] = 3
+    monkeypatch.setattr(api, 'metrics', registry)
+    api.observe_request(current, 'BREW', '/auctions/<int:auction_id>/', 418, None)
+
+    body = registry.render()
+    # unknown methods are folded into "other", a body of unknown size is not observed
+    assert 'http_requests_total{method="other",route="/auctions/<int:auction_id>/",status="418"} 1' in body
+    assert 'http_request_queries_sum{method="other",route="/auctions/<int:auction_id>/"} 3' in body
+    assert 'http_response_size_bytes_count' not in body
+
+
+def test_query_is_profiled_under_its_endpoint(api, monkeypatch):
+    class Cursor:
+        rowcount = 2
+
+    profiler = api.QueryProfiler(1000, 10, 2, 100)
+    monkeypatch.setattr(api, 'query_profiler', profiler)
+
+    current = api.new_request_metrics('api.list_auction_bids')
+    for auction_id in (1, 2):
+        api.record_query(current, Cursor(), f'SELECT * FROM bids WHERE auction_id = {auction_id}', 0.002)
+    api.record_query(None, Cursor(), 'DELETE FROM tokens WHERE expires_at < 5', 0.001)
+
+    assert current['queries'] == 2
+    assert current['db_time'] == 0.004
+    statements = {(entry['endpoint'], entry['statement']): entry['calls'] for entry in profiler.top(10, 'calls')}
+    assert statements[('api.list_auction_bids', 'SELECT * FROM bids WHERE auction_id = ?')] == 2
+    assert ('MainThread', 'DELETE FROM tokens WHERE expires_at < ?') in statements
+
+    # the same statement twice in one request reaches the repeat threshold of 2
+    profiler.check_repeats(current['endpoint'], current['statements'])
+    assert profiler.repeats()[0]['max_executions'] == 2
+
+
+def test_debug_queries_needs_debug_endpoints(api, client, monkeypatch):
+    assert client.get('/debug/queries/').status_code == 404
+
+    monkeypatch.setattr(api, 'DEBUG_ENDPOINTS', True)
+    response = client.get('/debug/queries/?order=wrong')
+    assert response.get_json()['status'] == api.StatusCodes['api_error']
@@ -0,0 +1,70 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## migrate.py: applied files that changed, re-runs of a failed no-transaction migration
+
+import pytest
+
+import migrate
+
+
+class Connection:
+    # answers the pg_index query with `invalid` and records every statement run
+    def __init__(self, applied=(), invalid=()):
+        self.applied = list(applied)
+        self.invalid = list(invalid)
+        self.executed = []
+        self.autocommit = True
+
+    def cursor(self):
+        return Cursor(self)
+
+
+class Cursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, values=()):
+        self.conn.executed.append(sql)
+        if 'FROM schema_migrations' in sql:
+            self.rows = self.conn.applied
+        elif 'FROM pg_index' in sql:
+            self.rows = [(name,) for name in self.conn.invalid if name in values[0]]
+
+    def fetchall(self):
+        return self.rows
+
+
+def migration(version, sql):
+    return {'version': version, 'name': f'm{version}', 'sql': sql, 'checksum': f'sum-{sql}',
+            'transactional': not sql.startswith(migrate.NO_TRANSACTION)}
+
+
+def test_up_refuses_changed_files():
+    migrations = [migration(1, 'SELECT 1'), migration(2, 'SELECT 2')]
+    conn = Connection(applied=[(1, 'm1', 'sum-SELECT 0', None)])
+
+    with pytest.raises(ValueError, match='0001_m1'):
+        migrate.migrate(conn, migrations)
+    assert 'SELECT 2' not in conn.executed
+
+
+def test_rerun_drops_the_invalid_indexes_first():
+    sql = (f'{migrate.NO_TRANSACTION}\n'
+           'CREATE INDEX CONCURRENTLY IF NOT EXISTS a_idx ON a (x);\n'
+           'CREATE UNIQUE INDEX CONCURRENTLY b_idx ON b (y);\n')
+    conn = Connection(invalid=['b_idx', 'other_idx'])
+
+    migrate.apply_migration(conn, migration(1, sql))
+
+    drops = [sql for sql in conn.executed if sql.startswith('DROP')]
+    assert drops == ['DROP INDEX CONCURRENTLY IF EXISTS b_idx']
+    assert conn.executed.index(drops[0]) < conn.executed.index('CREATE UNIQUE INDEX CONCURRENTLY b_idx ON b (y)')
@@ -0,0 +1,41 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Statements and page responses shared by demo-proj.py and asgi.py
+
+
+def test_keyset_page(api):
+    rows = [(1, 'a'), (2, 'b'), (3, 'c')]
+
+    page = api.keyset_page(rows, 2, lambda row: {'name': row[1]})
+    assert page['results'] == [{'name': 'a'}, {'name': 'b'}]
+    # the next page starts after the last row returned, not after the extra one
+    assert api.decode_cursor(page['next_cursor']) == 2
+
+    assert api.keyset_page(rows, 3, lambda row: row[1])['next_cursor'] is None
+
+
+def test_offset_page(api):
+    rows = [(1, 9.5, 7), (2, 9.0, 8)]
+
+    page = api.offset_page(rows, 1, 20, api.bid_content)
+    assert page['results'] == [{'bid_id': 1, 'amount': 9.5, 'user_id': 7}]
+    assert page['next_offset'] == 21
+    assert api.offset_page(rows, 2, 20, api.bid_content)['next_offset'] is None
+
+
+def test_field_statement_lists_the_columns_of_the_fields(api):
+    query = api.field_statement('auctions_page', api.AUCTION_FIELDS, ['item_desc', 'bid_count'])
+
+    assert query.startswith('SELECT auction_id, item_desc, COALESCE(bid_count, 0) FROM auctions')
+    assert '{columns}' not in query
+
+
+def test_search_statement(api):
+    assert api.search_statement('42', 11, 0) == ('search_item', (42, 11, 0))
+    assert api.search_statement('red bike', 11, 10) == ('search_text', ('red bike', '%red bike%', '%red bike%', 11, 10))
+    assert api.search_statement('²', 11, 0) == ('search_text', ('²', '%²%', '%²%', 11, 0))
+    assert api.search_content((1, 'desc', 'title', None)) == {'auction id': 1, 'item_desc': 'desc', 'title': 'title'}
+    assert api.search_content((1, 'desc', 'title', 0.5))['rank'] == 0.5
+
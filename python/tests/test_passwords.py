@@ -0,0 +1,139 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Passwords: scrypt hashes, rehash on login, unknown users and what reaches the logs
+
+import logging
+from concurrent.futures import Future
+
+import pytest
+
+FAST_N = 2 ** 10   # the tests hash with a low cost
+
+
+@pytest.fixture
+def fast(api, monkeypatch):
+    monkeypatch.setattr(api, 'PASSWORD_SCRYPT_N', FAST_N)
+    return api
+
+
+class InlinePool:
+    # runs the password work in the calling thread, records what was checked
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, f, *args):
+        self.calls.append((f.__name__, args))
+        future = Future()
+        future.set_result(f(*args))
+        return future
+
+
+@pytest.fixture
+def pool(api, monkeypatch):
+    pool = InlinePool()
+    monkeypatch.setattr(api, 'password_pool', pool)
+    return pool
+
+
+def test_hash_carries_its_parameters(fast):
+    stored = fast.hash_password('secret')
+    scheme, n, r, p, salt, key = stored.split('$')
+
+    assert (scheme, int(n), int(r), int(p)) == ('scrypt', FAST_N, fast.PASSWORD_SCRYPT_R, fast.PASSWORD_SCRYPT_P)
+    # salted: the same password never hashes the same
+    assert fast.hash_password('secret') != stored
+
+
+def test_current_hash_is_not_rehashed(fast):
+    stored = fast.hash_password('secret')
+
+    assert fast.check_password('secret', stored) == (True, None)
+    assert fast.check_password('wrong', stored) == (False, None)
+
+
+def test_weaker_hash_is_rehashed_on_login(fast):
+    stored = fast.hash_password('secret', n=FAST_N // 2)
+
+    valid, new_hash = fast.check_password('secret', stored)
+    assert valid
+    assert new_hash.startswith(f'scrypt${FAST_N}$')
+    assert fast.check_password('secret', new_hash) == (True, None)
+    # a wrong password never rehashes
+    assert fast.check_password('wrong', stored) == (False, None)
+
+
+def test_plaintext_password_is_rehashed_on_login(fast):
+    valid, new_hash = fast.check_password('secret', 'secret')
+    assert valid
+    assert new_hash.startswith(f'scrypt${FAST_N}$')
+    assert fast.check_password('secret', new_hash) == (True, None)
+
+    assert fast.check_password('wrong', 'secret') == (False, None)
+
+
+def test_dummy_hash_has_the_current_cost(api):
+    # an unknown username costs a full check at the current parameters, and never matches
+    scheme, n, r, p, salt, key = api.DUMMY_PASSWORD_HASH.split('$')
+    assert (int(n), int(r), int(p)) == (api.PASSWORD_SCRYPT_N, api.PASSWORD_SCRYPT_R, api.PASSWORD_SCRYPT_P)
+    assert api.check_password('secret', api.DUMMY_PASSWORD_HASH) == (False, None)
+
+
+def test_unknown_user_is_checked_against_the_dummy_hash(api, client, database, pool):
+    response = client.post('/login/', json={'username': 'nobody', 'password': 'secret'})
+
+    assert response.status_code == 401
+    assert pool.calls == [('check_password', ('secret', api.DUMMY_PASSWORD_HASH))]
+    assert [name for name, _ in database.executed] == ['user_login']
+
+
+def test_login_rehashes_a_plaintext_password(fast, client, database, pool, monkeypatch):
+    monkeypatch.setattr(fast, 'token_store', fast.OpaqueTokens())
+    database.rows['user_login'] = (7, 'secret')
+
+    response = client.post('/login/', json={'username': 'alice', 'password': 'secret'})
+
+    assert response.status_code == 200
+    names = [name for name, _ in database.executed]
+    assert names == ['user_login', 'user_rehash', 'token_insert']
+    new_hash, user_id, stored = database.executed[1][1]
+    assert (user_id, stored) == (7, 'secret')
+    assert fast.check_password('secret', new_hash) == (True, None)
+
+
+def test_wrong_password_is_refused(fast, client, database, pool):
+    database.rows['user_login'] = (7, fast.hash_password('secret'))
+
+    response = client.post('/login/', json={'username': 'alice', 'password': 'wrong'})
+
+    assert response.status_code == 401
+    assert [name for name, _ in database.executed] == ['user_login']
+
+
+def test_passwords_are_not_logged(fast, client, database, pool, caplog):
+    caplog.set_level(logging.DEBUG, logger='logger')
+
+    client.post('/users/', json={'username': 'alice', 'email': 'alice@example.com', 'password': 'secret'})
+    client.post('/login/', json={'username': 'alice', 'password': 'secret'})
+
+    assert 'alice@example.com' in caplog.text
+    assert 'secret' not in caplog.text
+    assert fast.redacted({'username': 'alice', 'password': 'secret'}) == {'username': 'alice', 'password': '***'}
+    assert fast.redacted(None) is None
+
+
+def test_pool_gives_the_slot_back_when_submit_fails(api):
+    pool = api.PasswordPool(1, 0)
+    pool.submit(lambda: None).result()
+    # shut down behind submit's back, as a concurrent stop_background_workers() would
+    pool._executor.shutdown()
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            pool.submit(lambda: None)
+    assert pool.stats()['in_use'] == 0
+
+    pool._executor = None
+    assert pool.submit(lambda: 'ok').result() == 'ok'
+    pool.shutdown()
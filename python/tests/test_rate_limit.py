@@ -0,0 +1,131 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Rate limiter: token buckets of the local backend on an injected clock, RateLimiter counters
+
+import pytest
+
+
+def take(limiter, key, n, rate=2, burst=3):
+    return [limiter.take(key, rate, burst) for _ in range(n)]
+
+
+def test_burst_then_limited(api, clock):
+    backend = api.LocalRateLimitBackend(4, 100, clock)
+
+    assert take(backend, 'user:1', 3) == [(True, 0.0)] * 3
+    allowed, retry_after = backend.take('user:1', 2, 3)
+    assert not allowed
+    # one whole token at 2 per second
+    assert retry_after == pytest.approx(0.5)
+
+
+def test_refill_after_one_over_rate(api, clock):
+    backend = api.LocalRateLimitBackend(4, 100, clock)
+    take(backend, 'user:1', 3)
+
+    clock.advance(0.25)
+    allowed, retry_after = backend.take('user:1', 2, 3)
+    assert not allowed
+    assert retry_after == pytest.approx(0.25)
+
+    clock.advance(0.25)
+    assert backend.take('user:1', 2, 3) == (True, 0.0)
+    assert not backend.take('user:1', 2, 3)[0]
+
+
+def test_refill_stops_at_burst(api, clock):
+    backend = api.LocalRateLimitBackend(4, 100, clock)
+    take(backend, 'user:1', 3)
+
+    clock.advance(3600)
+    assert [allowed for allowed, _ in take(backend, 'user:1', 4)] == [True, True, True, False]
+
+
+def test_keys_have_their_own_bucket(api, clock):
+    backend = api.LocalRateLimitBackend(4, 100, clock)
+    # two keys on different shards and two on the same one
+    keys = [f'user:{i}' for i in range(100)]
+    other_shard = next(key for key in keys if hash(key) % 4 != hash(keys[0]) % 4)
+    same_shard = next(key for key in keys[1:] if hash(key) % 4 == hash(keys[0]) % 4)
+
+    take(backend, keys[0], 3)
+    assert not backend.take(keys[0], 2, 3)[0]
+    assert take(backend, other_shard, 3) == [(True, 0.0)] * 3
+    assert take(backend, same_shard, 3) == [(True, 0.0)] * 3
+    assert backend.size() == 3
+
+
+def test_full_shard_drops_idle_buckets_first(api, clock):
+    backend = api.LocalRateLimitBackend(1, 2, clock)
+    take(backend, 'idle', 3)
+    clock.advance(61)
+    take(backend, 'busy', 3)
+    take(backend, 'new', 1)
+
+    # the idle bucket was dropped without counting as an eviction, busy is still empty
+    assert backend.evictions == 0
+    assert backend.size() == 2
+    assert not backend.take('busy', 2, 3)[0]
+
+
+def test_full_shard_evicts_the_oldest_bucket(api, clock):
+    backend = api.LocalRateLimitBackend(1, 2, clock)
+    take(backend, 'a', 3)
+    take(backend, 'b', 3)
+    take(backend, 'c', 1)
+
+    assert backend.evictions == 1
+    # an evicted bucket starts full again
+    assert take(backend, 'a', 3) == [(True, 0.0)] * 3
+
+
+def test_full_shard_keeps_the_recently_used_bucket(api, clock):
+    # a busy client created first must not be the one evicted, its empty bucket would come back full
+    backend = api.LocalRateLimitBackend(1, 2, clock)
+    take(backend, 'busy', 3)
+    take(backend, 'other', 1)
+    take(backend, 'busy', 1)
+    take(backend, 'new', 1)
+
+    assert backend.evictions == 1
+    assert not backend.take('busy', 2, 3)[0]
+    assert take(backend, 'other', 3) == [(True, 0.0)] * 3
+
+
+def test_slow_bucket_is_not_idle_before_it_is_full(api, clock):
+    # one token every two minutes: a minute later the bucket is still far from full
+    backend = api.LocalRateLimitBackend(1, 2, clock)
+    take(backend, 'slow', 3, rate=1 / 120)
+    take(backend, 'fast', 3)
+    clock.advance(61)
+    take(backend, 'new', 1)
+
+    # only the full bucket was dropped, the slow client is still limited
+    assert backend.evictions == 0
+    assert not backend.take('slow', 1 / 120, 3)[0]
+
+
+def test_rate_limiter_counts_decisions(api, clock):
+    limiter = api.RateLimiter(api.LocalRateLimitBackend(4, 100, clock))
+    take(limiter, 'user:1', 4)
+
+    stats = limiter.stats()
+    assert (stats['allowed'], stats['limited'], stats['errors']) == (3, 1, 0)
+    assert stats['backend'] == 'LocalRateLimitBackend'
+
+
+def test_backend_error_lets_the_request_through(api):
+    class Broken:
+        evictions = 0
+
+        def take(self, key, rate, burst):
+            raise ConnectionError('redis down')
+
+        def size(self):
+            return None
+
+    limiter = api.RateLimiter(Broken())
+    assert limiter.take('user:1', 2, 3) == (True, 0.0)
+    assert limiter.stats()['errors'] == 1
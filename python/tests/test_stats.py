@@ -0,0 +1,29 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## /stats/<component>/: one debug route over the stats of every component
+
+
+def test_stats_need_debug_endpoints(api, client):
+    assert client.get('/stats/passwords/').status_code == 404
+
+
+def test_component_stats(api, client, monkeypatch):
+    monkeypatch.setattr(api, 'DEBUG_ENDPOINTS', True)
+
+    response = client.get('/stats/passwords/').get_json()
+    assert response['status'] == api.StatusCodes['success']
+    assert response['results']['cost']['n'] == api.PASSWORD_SCRYPT_N
+
+    # providers look the component up on every call
+    monkeypatch.setattr(api, 'rate_limiter', None)
+    assert client.get('/stats/ratelimit/').get_json()['results'] == {'backend': 'off'}
+
+
+def test_unknown_component(api, client, monkeypatch):
+    monkeypatch.setattr(api, 'DEBUG_ENDPOINTS', True)
+
+    response = client.get('/stats/everything/').get_json()
+    assert response['status'] == api.StatusCodes['not_found']
+    assert 'pool' in response['results']
@@ -0,0 +1,160 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## TokenCache: hits, single-flight misses, LRU eviction, TTL expiry and invalidation
+
+import threading
+
+import pytest
+
+
+def test_miss_loads_once_then_hits(api, clock):
+    cache = api.TokenCache(10, 60, clock)
+    calls = []
+
+    def loader(token):
+        calls.append(token)
+        return 7, 3600
+
+    assert cache.get('a', loader) == 7
+    assert cache.get('a', loader) == 7
+    assert calls == ['a']
+    stats = cache.stats()
+    assert (stats['misses'], stats['hits']) == (1, 1)
+
+
+def test_unknown_token_is_not_cached(api, clock):
+    cache = api.TokenCache(10, 60, clock)
+    calls = []
+
+    def loader(token):
+        calls.append(token)
+        return None
+
+    assert cache.get('a', loader) is None
+    assert cache.get('a', loader) is None
+    assert len(calls) == 2
+    assert cache.stats()['size'] == 0
+
+
+def test_concurrent_misses_are_coalesced(api, clock):
+    cache = api.TokenCache(10, 60, clock)
+    release = threading.Event()
+    calls = []
+
+    def loader(token):
+        calls.append(token)
+        release.wait(5)
+        return 7, 3600
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('a', loader))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    # every follower has joined the lookup of the leader before it is answered
+    for _ in range(500):
+        if cache.stats()['coalesced'] == 4:
+            break
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == ['a']
+    assert results == [7] * 5
+    stats = cache.stats()
+    assert (stats['misses'], stats['coalesced']) == (5, 4)
+
+
+def test_coalesced_misses_share_the_error(api, clock):
+    cache = api.TokenCache(10, 60, clock)
+    started = threading.Event()
+    release = threading.Event()
+
+    def loader(token):
+        started.set()
+        release.wait(5)
+        raise RuntimeError('database down')
+
+    errors = []
+
+    def get():
+        try:
+            cache.get('a', loader)
+        except RuntimeError as error:
+            errors.append(error)
+
+    leader = threading.Thread(target=get)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=get)
+    follower.start()
+    for _ in range(500):
+        if cache.stats()['coalesced'] == 1:
+            break
+        threading.Event().wait(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 2
+    # the failed lookup is not left behind, the next miss tries again
+    assert cache.get('a', lambda token: (7, 3600)) == 7
+
+
+def test_least_recently_used_is_evicted(api, clock):
+    cache = api.TokenCache(2, 60, clock)
+    cache.put('a', 1, 3600)
+    cache.put('b', 2, 3600)
+    # a becomes the most recently used, b is the one evicted
+    assert cache.get('a', pytest.fail) == 1
+    cache.put('c', 3, 3600)
+
+    assert cache.get('a', pytest.fail) == 1
+    assert cache.get('c', pytest.fail) == 3
+    assert cache.get('b', lambda token: None) is None
+    stats = cache.stats()
+    assert (stats['size'], stats['evictions']) == (2, 1)
+
+
+def test_entry_expires_after_ttl(api, clock):
+    cache = api.TokenCache(10, 60, clock)
+    cache.put('a', 1, 3600)
+
+    clock.advance(59)
+    assert cache.get('a', pytest.fail) == 1
+    clock.advance(1)
+    assert cache.get('a', lambda token: (2, 3600)) == 2
+    assert cache.stats()['expirations'] == 1
+
+
+def test_entry_expires_with_the_token(api, clock):
+    # a token with 10 seconds left is not trusted for the full ttl
+    cache = api.TokenCache(10, 60, clock)
+    cache.put('a', 1, 10)
+
+    clock.advance(10)
+    assert cache.get('a', lambda token: None) is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_invalidate(api, clock):
+    cache = api.TokenCache(10, 60, clock)
+    cache.put('a', 1, 3600)
+    cache.invalidate('a')
+    cache.invalidate('unknown')
+
+    assert cache.get('a', lambda token: None) is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_logout_invalidates_the_cached_token(api, database, monkeypatch):
+    # OpaqueTokens.revoke deletes the row and drops the token from the cache of this process
+    cache = api.TokenCache(10, 60)
+    monkeypatch.setattr(api, 'token_cache', cache)
+
+    cache.put('a', 1, 3600)
+    assert api.OpaqueTokens().revoke('a')
+    assert database.executed == [('token_delete', (api.token_digest('a'),))]
+    assert cache.get('a', lambda token: None) is None